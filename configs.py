@@ -32,6 +32,7 @@ precise_fps = False
 
 """ Miscellaneous """
 start_in_compat_mode = False
+compat_dirty_rects = False  # whether compat mode only redraws the parts of the screen that changed each frame
 do_crash_reporting = True  # whether to produce a crash file when the program exits via an exception.
 
 is_dev = os.path.exists(".gitignore")  # yikes
@@ -39,6 +40,10 @@ is_dev = os.path.exists(".gitignore")  # yikes
 key_repeat_delay = 30  # keys held for longer than this many ticks will start to be typed repeatedly
 key_repeat_period = 5  # after the delay has passed, the key will be typed every X ticks until released
 
+atlas_cache_dir = None  # where the packed sprite atlas is saved between launches (e.g. ".cache"), None = rebuild it every time
+mesh_cache_dir = None  # where parsed 3D models are saved between launches (e.g. ".cache"), None = parse them every time
+max_atlas_page_size = None  # the atlas is split into multiple textures past this size (or the GPU's limit), None = no limit
+
 
 """ 3D Debug """
 wireframe_3d = False
@@ -0,0 +1,333 @@
+"""
+Runs synthetic stress scenes through the engine as fast as it'll go (there's no vsync or clock.tick wait) and
+saves how long each phase of a frame took (mean, median, p95, and max) as JSON:
+    update  - Game.update
+    submit  - passing every sprite to RenderEngine.update
+    rebuild - Layer.rebuild, summed over all layers (as recorded by src.engine.frametimers)
+    render  - Layer.render, summed over all layers
+    render_layers - all of RenderEngine.render_layers (includes rebuild and render, plus clearing, eviction, etc.)
+    present - RenderEngine.present
+    frame   - everything above
+
+Engines:
+    headless - HeadlessRenderEngine. Its rebuild and submit costs match the OpenGL engines' (the data arrays are
+               the same), but its software rasterizer makes render far slower than a GPU would be, so it's
+               best used with small sprite counts.
+    compat   - PurePygameRenderEngine, the default (with SDL_VIDEODRIVER=dummy unless it's already set).
+    opengl   - the best OpenGL engine the system supports. Needs a real display.
+
+3D layers are only drawn by the opengl engine, so the 3D scene (crowd3d) is skipped on the other engines.
+
+Usage: python -m src.benchmarks.frametime [scene ...] [--sprites N ...] [--ticks N] [--engine NAME] [--out FILE]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+
+import pygame
+
+import src.engine.frametimers as frametimers
+import src.engine.game as game
+import src.engine.globaltimer as globaltimer
+import src.engine.layers as layers
+import src.engine.renderengine as renderengine
+import src.engine.sprites as sprites
+import src.engine.spritesheets as spritesheets
+import src.engine.threedee as threedee
+import src.engine.window as window
+import src.example.demogame as demogame
+
+
+WINDOW_SIZE = (800, 600)
+PIXEL_SCALE = 2
+
+PHASES = ("update", "submit", "rebuild", "render", "render_layers", "present", "frame")
+
+
+class StressScene(game.Game):
+    """
+        A Game that fills its layers with n_sprites sprites scattered across the screen. Subclasses decide what
+        the sprites are and how they change each tick. Randomness is seeded, so runs are repeatable.
+    """
+
+    name = None
+    gl_only = False  # whether the scene can only be drawn by the opengl engine
+
+    def __init__(self, n_sprites, seed=12345):
+        super().__init__()
+        self.n_sprites = n_sprites
+        self.rand = random.Random(seed)
+        self.sprite_list = []
+        self.screen_size = (WINDOW_SIZE[0] // PIXEL_SCALE, WINDOW_SIZE[1] // PIXEL_SCALE)
+
+    def get_sheets(self):
+        yield demogame.DemoGame.demo_sheet
+
+    def get_layers(self):
+        yield layers.ImageLayer("stress", 0)
+
+    def initialize(self):
+        self.sprite_list = [self.create_sprite(i) for i in range(0, self.n_sprites)]
+
+    def create_sprite(self, idx):
+        raise NotImplementedError()
+
+    def random_xy(self, margin=16):
+        return (self.rand.randint(-margin, self.screen_size[0]), self.rand.randint(-margin, self.screen_size[1]))
+
+    def update(self):
+        return True
+
+    def all_sprites(self):
+        return self.sprite_list
+
+
+class StaticScene(StressScene):
+    """Opaque ImageSprites that never change, so rebuilding should be almost free."""
+
+    name = "static"
+
+    def create_sprite(self, idx):
+        sheet = demogame.DemoGame.demo_sheet
+        x, y = self.random_xy()
+        model = self.rand.choice([sheet.floor_model, sheet.wall_model] + sheet.player_models + sheet.tv_models)
+        return sprites.ImageSprite(model, x, y, "stress", depth=self.rand.randint(-100, 100))
+
+
+class MovingScene(StaticScene):
+    """Like the static scene, but 90% of the sprites move every tick."""
+
+    name = "moving"
+
+    def initialize(self):
+        super().initialize()
+        self.velocities = [(self.rand.choice((-1, 1)), self.rand.choice((-1, 1))) for _ in self.sprite_list]
+
+    def update(self):
+        w, h = self.screen_size
+        for i in range(0, len(self.sprite_list)):
+            if i % 10 != 0:
+                spr = self.sprite_list[i]
+                vel = self.velocities[i]
+                self.sprite_list[i] = spr.update(new_x=(spr.x() + vel[0]) % w, new_y=(spr.y() + vel[1]) % h)
+        return True
+
+
+class TextScene(StressScene):
+    """TextSprites whose text is replaced every tick. There are n_sprites characters in total, about 10 per sprite."""
+
+    name = "text"
+
+    def initialize(self):
+        self.sprite_list = [self.create_sprite(i) for i in range(0, max(1, self.n_sprites // 10))]
+
+    def create_sprite(self, idx):
+        x, y = self.random_xy()
+        return sprites.TextSprite("stress", x, y, self._get_text(idx), depth=self.rand.randint(-100, 100))
+
+    def _get_text(self, idx):
+        return "{:>5}:{:04}".format(idx % 100000, (globaltimer.tick_count() * 7 + idx) % 10000)
+
+    def update(self):
+        for i in range(0, len(self.sprite_list)):
+            self.sprite_list[i] = self.sprite_list[i].update(new_text=self._get_text(i))
+        return True
+
+
+class TranslucentScene(StressScene):
+    """Overlapping translucent sprites, which are sorted by depth. A quarter of them change depth every tick."""
+
+    name = "translucent"
+
+    def create_sprite(self, idx):
+        x, y = self.random_xy(margin=32)
+        return sprites.ImageSprite(demogame.DemoGame.demo_sheet.shadow_model, x, y, "stress", scale=2,
+                                   depth=self.rand.randint(-1000, 1000))
+
+    def update(self):
+        for i in range(globaltimer.tick_count() % 4, len(self.sprite_list), 4):
+            self.sprite_list[i] = self.sprite_list[i].update(new_depth=self.rand.randint(-1000, 1000))
+        return True
+
+
+class Crowd3DScene(StressScene):
+    """Flat Sprite3Ds spread out in front of the camera, all of them spinning."""
+
+    name = "crowd3d"
+    gl_only = True
+
+    def get_layers(self):
+        yield threedee.ThreeDeeLayer("stress", 0)
+
+    def initialize(self):
+        self.models = [threedee.ThreeDeeModel.build_from_2d_model(m) for m in demogame.DemoGame.demo_sheet.player_models]
+        super().initialize()
+
+    def create_sprite(self, idx):
+        pos = (self.rand.uniform(-20, 20), self.rand.uniform(-10, 10), self.rand.uniform(-60, -10))
+        return threedee.Sprite3D(self.rand.choice(self.models), "stress", position=pos,
+                                 rotation=(0, self.rand.uniform(0, 2 * math.pi), 0))
+
+    def update(self):
+        for i in range(0, len(self.sprite_list)):
+            spr = self.sprite_list[i]
+            self.sprite_list[i] = spr.update(new_yrot=spr.rotation()[1] + 0.05)
+        return True
+
+
+SCENES = {scene.name: scene for scene in (StaticScene, MovingScene, TextScene, TranslucentScene, Crowd3DScene)}
+
+
+def create_engine(engine_name):
+    """sets up the window (if needed) and the RenderEngine singleton, like _GameLoop does."""
+    if engine_name in ("headless", "compat") and "SDL_VIDEODRIVER" not in os.environ:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pygame.init()
+
+    if engine_name == "headless":
+        eng = renderengine.create_headless_instance()
+    elif engine_name in ("compat", "opengl"):
+        window.create_instance(window_size=WINDOW_SIZE, opengl_mode=(engine_name == "opengl"))
+        window.get_instance().set_caption("frametime benchmark")
+        window.get_instance().set_icon(pygame.Surface((16, 16)))
+        window.get_instance().show()
+        glsl_version = renderengine.check_system_glsl_version() if engine_name == "opengl" else None
+        eng = renderengine.create_instance(glsl_version)
+    else:
+        raise ValueError("unrecognized engine: {}".format(engine_name))
+
+    eng.init(*WINDOW_SIZE)
+    return eng
+
+
+def build_atlas(eng, scene_types):
+    atlas = spritesheets.create_instance()
+    sheets = {}
+    for scene_type in scene_types:
+        for sheet in scene_type(0).get_sheets():
+            sheets[sheet.get_sheet_id()] = sheet
+    for sheet_id in sheets:
+        atlas.add_sheet(sheets[sheet_id])
+
+    page_size_limits = [lim for lim in (eng.get_max_texture_size(),) if lim is not None]
+    eng.set_texture_atlas_pages(atlas.create_atlas_pages(cache_dir=None,
+                                                         max_page_size=min(page_size_limits, default=None)))
+
+
+def run_scene(eng, scene_type, n_sprites, n_ticks, warmup_ticks=5):
+    """
+    :return: map of phase -> list of how long it took in each tick (in milliseconds), not counting the warmup ticks.
+    """
+    scene = scene_type(n_sprites)
+    scene_layers = list(scene.get_layers())
+    for layer in scene_layers:
+        eng.add_layer(layer)
+
+    eng.set_pixel_scale(PIXEL_SCALE)
+    scene.initialize()
+
+    timers = frametimers.get_instance()
+    timers.begin_frame()
+
+    res = {phase: [] for phase in PHASES}
+    for tick in range(0, warmup_ticks + n_ticks):
+        scene.update()
+        timers.mark(frametimers.UPDATE)
+
+        for spr in scene.all_sprites():
+            eng.update(spr)
+        timers.mark(frametimers.SUBMIT)
+
+        eng.set_clear_color(scene.get_clear_color())
+        eng.render_layers()
+        timers.mark(frametimers.RENDER_LAYERS)
+
+        eng.present()
+        timers.mark(frametimers.PRESENT)
+
+        globaltimer.inc_tick_count()
+        timers.begin_frame()  # finishes this tick's frame
+
+        if tick >= warmup_ticks:
+            frame = timers.get_last_frame()
+            for phase in (frametimers.UPDATE, frametimers.SUBMIT, frametimers.RENDER_LAYERS, frametimers.PRESENT):
+                res[phase].append(frame["phases"][phase][1])
+            for phase in frametimers.LAYER_PHASES:
+                res[phase].append(sum(frame["layers"][layer_id].get(phase, (0, 0))[1] for layer_id in frame["layers"]))
+            res["frame"].append(sum(frame["phases"][phase][1] for phase in frame["phases"]))
+
+    # two empty frames evict all the scene's sprites, so the next scene starts from nothing
+    for _ in range(0, 2):
+        eng.render_layers()
+        globaltimer.inc_tick_count()
+    for layer in scene_layers:
+        eng.remove_layer(layer.get_layer_id())
+    scene.cleanup()
+
+    return res
+
+
+def summarize(times):
+    """:return: stats for a list of times (in milliseconds)."""
+    ordered = sorted(times)
+    n = len(ordered)
+    return {
+        "mean": round(sum(ordered) / n, 4),
+        "median": round(ordered[n // 2], 4),
+        "p95": round(ordered[min(n - 1, math.ceil(0.95 * n) - 1)], 4),
+        "max": round(ordered[-1], 4)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measures per-phase frame times for synthetic stress scenes.")
+    parser.add_argument("scenes", nargs="*", metavar="scene",
+                        help="any of: {} (default: all)".format(", ".join(SCENES.keys())))
+    parser.add_argument("--sprites", type=int, nargs="+", default=[1000, 10000, 100000], help="sprite counts to try")
+    parser.add_argument("--ticks", type=int, default=60, help="ticks to measure, after 5 warmup ticks")
+    parser.add_argument("--engine", default="compat", choices=("headless", "compat", "opengl"))
+    parser.add_argument("--out", default="frametime.json", help="file to write the JSON to")
+    args = parser.parse_args(argv)
+
+    for name in args.scenes:
+        if name not in SCENES:
+            parser.error("unrecognized scene: {}".format(name))
+    scene_types = [SCENES[name] for name in (args.scenes if len(args.scenes) > 0 else SCENES)]
+    if args.engine != "opengl":
+        for scene_type in [s for s in scene_types if s.gl_only]:
+            print("INFO: skipping {}, it can only be drawn by the opengl engine".format(scene_type.name))
+        scene_types = [s for s in scene_types if not s.gl_only]
+    eng = create_engine(args.engine)
+    build_atlas(eng, scene_types)
+
+    results = []
+    for scene_type in scene_types:
+        for n_sprites in args.sprites:
+            print("INFO: running {} with {} sprites...".format(scene_type.name, n_sprites))
+            times = run_scene(eng, scene_type, n_sprites, args.ticks)
+            results.append({
+                "scene": scene_type.name,
+                "sprites": n_sprites,
+                "ticks": args.ticks,
+                "phases_ms": {phase: summarize(times[phase]) for phase in PHASES}
+            })
+
+    with open(args.out, "w") as f:
+        json.dump({"engine": type(eng).__name__, "results": results}, f, indent=2)
+
+    print("\nmean ms per tick:")
+    print("{:<12} {:>8}".format("scene", "sprites") + "".join(" {:>13}".format(p) for p in PHASES))
+    for res in results:
+        print("{:<12} {:>8}".format(res["scene"], res["sprites"])
+              + "".join(" {:>13.3f}".format(res["phases_ms"][p]["mean"]) for p in PHASES))
+    print("INFO: saved full results to {}".format(args.out))
+
+    eng.cleanup()
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compares the time and atlas area of the rect packers on random sprite sheet sizes.
+
+Sheets are packed with pack_pages, with pages limited to MAX_PAGE_SIZE (like the atlas is limited by the GPU's
+max texture size), so larger inputs spill onto multiple pages. The legacy packer is roughly O(n^3), so it's
+skipped for inputs where it would take minutes.
+
+Usage: python -m src.benchmarks.rectpacking
+"""
+
+import random
+import time
+
+import src.utils.rectpacking as rectpacking
+
+
+LEGACY_MAX_RECTS = 200
+MAX_PAGE_SIZE = (4096, 4096)  # a common GL_MAX_TEXTURE_SIZE
+
+
+def random_sheet_sizes(n, seed=12345):
+    rand = random.Random(seed)
+    sizes = {}
+    for i in range(0, n):
+        if rand.random() < 0.2:
+            # the occasional big sheet
+            sizes["sheet_{}".format(i)] = (rand.randint(128, 512), rand.randint(128, 512))
+        else:
+            sizes["sheet_{}".format(i)] = (rand.randint(8, 128), rand.randint(8, 128))
+    return sizes
+
+
+def run(packer, sizes):
+    """returns: (seconds taken, list of page sizes, fraction of the pages' area that's used)"""
+    start = time.perf_counter()
+    pages = packer.pack_pages(sizes)
+    elapsed = time.perf_counter() - start
+
+    page_sizes = [bound for _, bound in pages]
+    for bound in page_sizes:
+        if bound[0] > MAX_PAGE_SIZE[0] or bound[1] > MAX_PAGE_SIZE[1]:
+            raise ValueError("page is larger than {}: {}".format(MAX_PAGE_SIZE, bound))
+    if sum(len(rects) for rects, _ in pages) != len(sizes):
+        raise ValueError("not every rect was packed")
+
+    used_area = sum(s[0] * s[1] for s in sizes.values())
+    return elapsed, page_sizes, used_area / max(1, sum(w * h for w, h in page_sizes))
+
+
+if __name__ == "__main__":
+    packers = [rectpacking.LegacyPacker(max_size=MAX_PAGE_SIZE), rectpacking.SkylinePacker(max_size=MAX_PAGE_SIZE)]
+
+    print("{:<14} {:>6} {:>10} {:>6} {:>12} {:>10}".format("packer", "sheets", "time (ms)", "pages", "largest",
+                                                            "fill (%)"))
+    for n in (10, 100, 1000, 3000):
+        sizes = random_sheet_sizes(n)
+        for packer in packers:
+            name = type(packer).__name__
+            if isinstance(packer, rectpacking.LegacyPacker) and n > LEGACY_MAX_RECTS:
+                print("{:<14} {:>6} {:>10}".format(name, n, "skipped"))
+                continue
+            elapsed, page_sizes, fill = run(packer, sizes)
+            largest = max(page_sizes, key=lambda size: size[0] * size[1])
+            print("{:<14} {:>6} {:>10.1f} {:>6} {:>12} {:>10.1f}".format(
+                name, n, elapsed * 1000, len(page_sizes), "{}x{}".format(*largest), fill * 100))
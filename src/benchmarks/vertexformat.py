@@ -0,0 +1,42 @@
+"""
+Compares the number of bytes each sprite occupies in a layer's data arrays between the old layout and
+ImageDataArray's current one.
+
+The old layout used separate float64 arrays for vertices, texture coords, colors, and indices. Layers no
+longer hold indices at all (they come from the engine's shared index buffers). What they hold now is the
+vertex data, which is also what gets uploaded to the GPU when a sprite changes, and each sprite's atlas
+page, which stays on the CPU. Both are counted, and the upload size is shown separately.
+
+Usage: python -m src.benchmarks.vertexformat
+"""
+
+import numpy
+
+import src.engine.layers as layers
+
+
+def legacy_bytes_per_sprite(layer):
+    vps = layer.vertices_per_sprite()
+    n_floats = vps * 3 + vps * 2 + vps * 3 + layer.index_stride()  # xyz, uv, rgb, indices
+    return n_floats * numpy.dtype(float).itemsize
+
+
+def current_bytes_per_sprite(layer, n_sprites):
+    """returns: (bytes per sprite in all of the layer's arrays, bytes per sprite that get uploaded)"""
+    data_arrays = layers.ImageDataArray(layer)
+    data_arrays._ensure_capacity(n_sprites)
+    capacity = data_arrays.vertex_data.shape[0]
+    return ((data_arrays.vertex_data.nbytes + data_arrays.pages.nbytes) / capacity,
+            data_arrays.vertex_data.nbytes / capacity)
+
+
+if __name__ == "__main__":
+    all_layers = [layers.ImageLayer("images", 0), layers.PolygonLayer("polygons", 0)]
+
+    print("{:<14} {:>9} {:>14} {:>14} {:>17}".format("layer", "sprites", "before (B/spr)", "after (B/spr)",
+                                                     "uploaded (B/spr)"))
+    for lay in all_layers:
+        for n in (1000, 10000, 100000):
+            before = legacy_bytes_per_sprite(lay)
+            after, uploaded = current_bytes_per_sprite(lay, n)
+            print("{:<14} {:>9} {:>14} {:>14.0f} {:>17.0f}".format(type(lay).__name__, n, before, after, uploaded))
@@ -0,0 +1,213 @@
+import json
+import time
+
+import numpy
+
+import src.engine.globaltimer as globaltimer
+
+
+# phases of _GameLoop.run, in the order they happen
+EVENTS = "events"                # input events, window resizing, sounds
+UPDATE = "update"                # Game.update
+SUBMIT = "submit"                # passing sprites to RenderEngine.update
+RENDER_LAYERS = "render_layers"  # RenderEngine.render_layers (rebuilding and drawing the layers)
+PRESENT = "present"              # RenderEngine.present (flipping the display)
+WAIT = "wait"                    # waiting until it's time for the next frame
+
+PHASES = (EVENTS, UPDATE, SUBMIT, RENDER_LAYERS, PRESENT, WAIT)
+
+# per-layer timings, which happen inside RENDER_LAYERS
+REBUILD = "rebuild"
+RENDER = "render"
+
+LAYER_PHASES = (REBUILD, RENDER)
+
+_PHASE_IDXS = {phase: idx for idx, phase in enumerate(PHASES)}
+_LAYER_PHASE_IDXS = {phase: idx for idx, phase in enumerate(LAYER_PHASES)}
+
+_instance = None
+
+
+def get_instance() -> 'FrameTimers':
+    global _instance
+    if _instance is None:
+        _instance = FrameTimers()
+
+    return _instance
+
+
+class FrameTimers:
+    """
+        Times the phases of each frame, and each layer's rebuild and render, with time.perf_counter. The most recent
+        frames are kept in a fixed-size ring buffer, so recording never allocates and old frames fall off the end.
+
+        The game loop calls begin_frame at the top of each frame and then mark after each phase, so every phase
+        starts where the previous one ended and only one clock read is needed per phase.
+    """
+
+    def __init__(self, capacity=600):
+        """
+        :param capacity: how many frames to keep (including the one in progress).
+        """
+        self.capacity = max(2, capacity)
+
+        self._frame_starts = numpy.zeros(self.capacity, dtype=numpy.float64)
+        self._ticks = numpy.zeros(self.capacity, dtype=numpy.int64)
+        self._phase_starts = numpy.zeros((self.capacity, len(PHASES)), dtype=numpy.float64)
+        self._phase_times = numpy.zeros((self.capacity, len(PHASES)), dtype=numpy.float64)
+
+        self._layer_idxs = {}  # layer_id -> column in the layer arrays
+        self._layer_starts = numpy.zeros((self.capacity, 0, len(LAYER_PHASES)), dtype=numpy.float64)
+        self._layer_times = numpy.zeros((self.capacity, 0, len(LAYER_PHASES)), dtype=numpy.float64)
+
+        self._row = 0            # row of the frame in progress
+        self._n_frames = 0       # number of frames begun so far
+        self._last_mark = time.perf_counter()
+
+    def begin_frame(self):
+        """starts recording a new frame, which finishes the previous one."""
+        now = time.perf_counter()
+        self._n_frames += 1
+        self._row = (self._row + 1) % self.capacity
+
+        row = self._row
+        self._frame_starts[row] = now
+        self._ticks[row] = globaltimer.tick_count()
+        self._phase_starts[row] = 0
+        self._phase_times[row] = 0
+        self._layer_starts[row] = 0
+        self._layer_times[row] = 0
+
+        self._last_mark = now
+
+    def mark(self, phase):
+        """ends a phase of the current frame. It's considered to have started when the previous phase ended."""
+        now = time.perf_counter()
+        idx = _PHASE_IDXS[phase]
+        if self._phase_times[self._row, idx] == 0:
+            self._phase_starts[self._row, idx] = self._last_mark
+        self._phase_times[self._row, idx] += now - self._last_mark
+        self._last_mark = now
+
+    def add_layer_time(self, layer_id, phase, start_time):
+        """
+            records that a layer spent from start_time (from time.perf_counter) until now in a phase (REBUILD or
+            RENDER). Multiple calls in the same frame are added together.
+        """
+        now = time.perf_counter()
+        if layer_id not in self._layer_idxs:
+            self._add_layer_column(layer_id)
+        col = self._layer_idxs[layer_id]
+        idx = _LAYER_PHASE_IDXS[phase]
+        if self._layer_times[self._row, col, idx] == 0:
+            self._layer_starts[self._row, col, idx] = start_time
+        self._layer_times[self._row, col, idx] += now - start_time
+
+    def _add_layer_column(self, layer_id):
+        self._layer_idxs[layer_id] = len(self._layer_idxs)
+        empty_col = numpy.zeros((self.capacity, 1, len(LAYER_PHASES)), dtype=numpy.float64)
+        self._layer_starts = numpy.concatenate([self._layer_starts, empty_col], axis=1)
+        self._layer_times = numpy.concatenate([self._layer_times, empty_col], axis=1)
+
+    def num_frames(self):
+        """returns: how many finished frames are available (at most capacity - 1)."""
+        return max(0, min(self._n_frames - 1, self.capacity - 1))
+
+    def _get_rows(self, n=None):
+        """returns: the rows of the last n finished frames (or all of them), oldest first."""
+        n = self.num_frames() if n is None else max(0, min(n, self.num_frames()))
+        return [(self._row - n + i) % self.capacity for i in range(0, n)]
+
+    def get_frames(self, n=None):
+        """
+        :param n: how many of the most recent finished frames to return, or None for all of them.
+        returns: list of dicts, oldest first, like:
+            {
+                "tick": tick count when the frame began,
+                "start": time.perf_counter() when the frame began, in seconds,
+                "phases": map of phase -> (start offset from the frame's start, duration), in milliseconds,
+                "layers": map of layer_id -> (map of layer phase -> (start offset, duration)) for the layers
+                          that rebuilt or rendered that frame.
+            }
+        """
+        return [self._get_frame_info(row) for row in self._get_rows(n)]
+
+    def _get_frame_info(self, row):
+        frame_start = self._frame_starts[row]
+
+        phases = {}
+        for phase, idx in _PHASE_IDXS.items():
+            start_offs = self._phase_starts[row, idx] - frame_start if self._phase_times[row, idx] > 0 else 0
+            phases[phase] = (1000 * float(start_offs), 1000 * float(self._phase_times[row, idx]))
+
+        layer_info = {}
+        for layer_id, col in self._layer_idxs.items():
+            for phase, idx in _LAYER_PHASE_IDXS.items():
+                if self._layer_times[row, col, idx] > 0:
+                    if layer_id not in layer_info:
+                        layer_info[layer_id] = {}
+                    layer_info[layer_id][phase] = (1000 * float(self._layer_starts[row, col, idx] - frame_start),
+                                                   1000 * float(self._layer_times[row, col, idx]))
+
+        return {"tick": int(self._ticks[row]), "start": float(frame_start), "phases": phases, "layers": layer_info}
+
+    def get_current_frame(self):
+        """returns: the frame in progress (see get_frames), with whatever phases have been marked so far."""
+        return self._get_frame_info(self._row)
+
+    def get_last_frame(self):
+        """returns: the most recent finished frame (see get_frames), or None if there isn't one yet."""
+        frames = self.get_frames(1)
+        return frames[0] if len(frames) > 0 else None
+
+    def get_average_times(self, n=None):
+        """returns: map of phase -> average duration in milliseconds, over the last n finished frames (or all)."""
+        rows = self._get_rows(n)
+        if len(rows) == 0:
+            return {phase: 0 for phase in PHASES}
+        avgs = self._phase_times[rows].mean(axis=0)
+        return {phase: 1000 * float(avgs[idx]) for phase, idx in _PHASE_IDXS.items()}
+
+    def get_average_layer_times(self, n=None):
+        """returns: map of layer_id -> (map of layer phase -> average duration in milliseconds)."""
+        rows = self._get_rows(n)
+        res = {}
+        for layer_id, col in self._layer_idxs.items():
+            res[layer_id] = {}
+            for phase, idx in _LAYER_PHASE_IDXS.items():
+                res[layer_id][phase] = 1000 * float(self._layer_times[rows, col, idx].mean()) if len(rows) > 0 else 0
+        return res
+
+    def dump(self, filepath=None, n=None):
+        """
+            Writes out the last n finished frames (or all of them). With a filepath they're saved as JSON (see
+            get_frames), otherwise a summary is printed.
+        """
+        if filepath is not None:
+            with open(filepath, "w") as f:
+                json.dump({"phases": PHASES, "layer_phases": LAYER_PHASES, "frames": self.get_frames(n)}, f)
+            print("INFO: saved {} frame timing(s) to {}".format(len(self._get_rows(n)), filepath))
+            return
+
+        rows = self._get_rows(n)
+        if len(rows) == 0:
+            print("INFO: no frame timings recorded yet")
+            return
+
+        totals = 1000 * self._phase_times[rows].sum(axis=1)
+        worst_row = rows[int(numpy.argmax(totals))]
+        avgs = self.get_average_times(n)
+
+        print("INFO: frame timings over the last {} frame(s), in ms:".format(len(rows)))
+        print("  {:<16} {:>9} {:>9}".format("phase", "avg", "worst"))
+        for phase, idx in _PHASE_IDXS.items():
+            print("  {:<16} {:>9.3f} {:>9.3f}".format(phase, avgs[phase], 1000 * self._phase_times[worst_row, idx]))
+        print("  {:<16} {:>9.3f} {:>9.3f}".format("total", float(totals.mean()), float(totals.max())))
+
+        layer_avgs = self.get_average_layer_times(n)
+        for layer_id in layer_avgs:
+            col = self._layer_idxs[layer_id]
+            print("  layer {:<10} {:>9.3f} {:>9.3f}  (rebuild)".format(
+                str(layer_id), layer_avgs[layer_id][REBUILD], 1000 * self._layer_times[worst_row, col, 0]))
+            print("  {:<16} {:>9.3f} {:>9.3f}  (render)".format(
+                "", layer_avgs[layer_id][RENDER], 1000 * self._layer_times[worst_row, col, 1]))
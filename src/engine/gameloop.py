@@ -9,6 +9,7 @@ import src.engine.keybinds as keybinds
 import src.engine.renderengine as renderengine
 import src.engine.spritesheets as spritesheets
 import src.engine.globaltimer as globaltimer
+import src.engine.frametimers as frametimers
 import configs
 
 
@@ -31,6 +32,7 @@ class _GameLoop:
         self._clock = pygame.time.Clock()
         self._requested_fullscreen_toggle_this_tick = False
         self._slo_mo_timer = 0
+        self._spike_profiler = None
 
         print("INFO: pygame version: " + pygame.version.ver)
         print("INFO: initializing sounds...")
@@ -73,16 +75,21 @@ class _GameLoop:
         for sheet in self._game.get_sheets():
             sprite_atlas.add_sheet(sheet)
 
-        atlas_surface = sprite_atlas.create_atlas_surface()
+        page_size_limits = [lim for lim in (render_eng.get_max_texture_size(), configs.max_atlas_page_size)
+                            if lim is not None]
+        atlas_pages = sprite_atlas.create_atlas_pages(cache_dir=configs.atlas_cache_dir,
+                                                      max_page_size=min(page_size_limits, default=None))
 
         # uncomment for fun
         # import src.utils.artutils as artutils
-        # artutils.rainbowfill(atlas_surface)
+        # for page in atlas_pages:
+        #     artutils.rainbowfill(page)
 
         # uncomment to save out the full texture atlas
-        # pygame.image.save(atlas_surface, "texture_atlas.png")
+        # for i, page in enumerate(atlas_pages):
+        #     pygame.image.save(page, "texture_atlas_{}.png".format(i))
 
-        render_eng.set_texture_atlas(atlas_surface)
+        render_eng.set_texture_atlas_pages(atlas_pages)
 
         for layer in self._game.get_layers():
             renderengine.get_instance().add_layer(layer)
@@ -94,6 +101,10 @@ class _GameLoop:
 
         if configs.is_dev:
             keybinds.get_instance().set_global_action(pygame.K_F1, "toggle profiling", lambda: self._toggle_profiling())
+            keybinds.get_instance().set_global_action(pygame.K_F2, "dump frame timings",
+                                                      lambda: frametimers.get_instance().dump())
+            keybinds.get_instance().set_global_action(pygame.K_F3, "toggle spike profiling",
+                                                      lambda: self._toggle_spike_profiling())
 
         if configs.allow_fullscreen:
             keybinds.get_instance().set_global_action(pygame.K_F4, "fullscreen",
@@ -102,8 +113,28 @@ class _GameLoop:
     def _toggle_profiling(self):
         # used to help find performance bottlenecks
         import src.utils.profiling as profiling
+        if profiling.get_instance().is_capturing_spikes:
+            self._stop_spike_profiling()
         profiling.get_instance().toggle()
 
+    def _toggle_spike_profiling(self):
+        # profiles only the frames that take too long
+        import src.utils.profiling as profiling
+        self._spike_profiler = profiling.get_instance()
+        if not self._spike_profiler.is_capturing_spikes:
+            self._spike_profiler.start_spike_capture(1000 / configs.target_fps, threshold=1.5)
+        else:
+            self._stop_spike_profiling()
+
+    def _stop_spike_profiling(self):
+        # stops capturing spikes, and saves a timeline of the recent frames (including the spikes)
+        import src.utils.profiling as profiling
+        profiler = profiling.get_instance()
+        profiler.stop_spike_capture()
+        frames = frametimers.get_instance().get_frames()
+        profiling.export_chrome_trace("frame_trace.json", frames, spikes=profiler.spikes)
+        profiling.export_speedscope("frame_trace.speedscope.json", frames, spikes=profiler.spikes)
+
     def _request_fullscreen_toggle(self):
         self._requested_fullscreen_toggle_this_tick = True
 
@@ -112,7 +143,11 @@ class _GameLoop:
 
         ignore_resize_events_next_tick = False
 
+        timers = frametimers.get_instance()
+
         while running:
+            timers.begin_frame()
+
             # processing user input events
             all_resize_events = []
 
@@ -179,9 +214,11 @@ class _GameLoop:
 
             input_state.update()
             sounds.update()
+            timers.mark(frametimers.EVENTS)
 
             # updates the actual game state
             still_running = self._game.update()
+            timers.mark(frametimers.UPDATE)
 
             if still_running is False:
                 running = False
@@ -190,16 +227,23 @@ class _GameLoop:
             for spr in self._game.all_sprites():
                 if spr is not None:
                     renderengine.get_instance().update(spr)
+            timers.mark(frametimers.SUBMIT)
 
             renderengine.get_instance().set_clear_color(self._game.get_clear_color())
             renderengine.get_instance().render_layers()
+            timers.mark(frametimers.RENDER_LAYERS)
 
-            pygame.display.flip()
+            renderengine.get_instance().present()
+            timers.mark(frametimers.PRESENT)
 
             slo_mo_mode = configs.is_dev and input_state.is_held(pygame.K_TAB)
             target_fps = configs.target_fps if not slo_mo_mode else configs.target_fps // 4
 
             dt = self._wait_until_next_frame(target_fps)
+            timers.mark(frametimers.WAIT)
+
+            if self._spike_profiler is not None and self._spike_profiler.is_capturing_spikes:
+                self._spike_profiler.end_frame(timers.get_current_frame())
 
             globaltimer.set_dt(dt, target_dt=1000 / target_fps)
             globaltimer.inc_tick_count()
@@ -219,6 +263,8 @@ class _GameLoop:
                 self._slo_mo_timer = 0
 
         self._game.cleanup()
+        renderengine.get_instance().cleanup()
+        globaltimer.stop_frame_log()
 
         print("INFO: quitting game")
         pygame.quit()
@@ -1,5 +1,13 @@
+import json
+import math
+import queue
 import time
 
+import numpy
+
+import configs
+import src.utils.threadutils as threadutils
+
 _TICK_COUNT = 0
 
 _DT = 0  # delta time of the current frame, in milliseconds
@@ -11,6 +19,22 @@ _TICK_TIME_IDX = 0
 
 _SHOW_FPS = False  # if true, current FPS will be shown in the window caption.
 
+# frame time stats (see set_dt)
+_FRAME_TIMES = numpy.zeros(600, dtype=numpy.float64)  # ring buffer of the most recent frames' dts, in milliseconds
+_FRAME_DROPPED = numpy.zeros(600, dtype=numpy.int64)  # how many frames each of those dropped
+_FRAME_TIME_IDX = 0
+_N_FRAMES_RECORDED = 0
+_TOTAL_DROPPED_FRAMES = 0
+
+# a frame only counts as dropping another if it runs over the target dt by more than this fraction of it, so that
+# timing jitter around the target doesn't register as a stream of dropped frames
+_DROPPED_FRAME_TOLERANCE = 0.05
+
+_HITCH_RATIO = 2.0  # frames that take this many times longer than the target dt count as hitches
+_HITCH_LISTENERS = []
+
+_FRAME_LOG = None  # a _FrameLog while frames are being written to a file
+
 
 def tick_count():
     """returns: How many 'ticks' the game has been running for. This number will never decrease on subsequent calls."""
@@ -40,11 +64,40 @@ def dt():
 
 
 def set_dt(dt_millis, target_dt=None):
-    """Sets the delta time for the current frame, in milliseconds."""
+    """Sets the delta time for the current frame, in milliseconds. This also records it in the frame time stats."""
     global _DT, _DT_RATIO
     _DT = dt_millis
     _DT_RATIO = 1 if target_dt is None else dt_millis / target_dt
 
+    _record_frame_time(dt_millis, target_dt if target_dt is not None else 1000 / configs.target_fps)
+
+
+def _record_frame_time(dt_millis, target_dt):
+    global _FRAME_TIME_IDX, _N_FRAMES_RECORDED, _TOTAL_DROPPED_FRAMES
+    dropped = _count_dropped_frames(dt_millis, target_dt)
+    _TOTAL_DROPPED_FRAMES += dropped
+
+    _FRAME_TIMES[_FRAME_TIME_IDX] = dt_millis
+    _FRAME_DROPPED[_FRAME_TIME_IDX] = dropped
+    _FRAME_TIME_IDX = (_FRAME_TIME_IDX + 1) % len(_FRAME_TIMES)
+    _N_FRAMES_RECORDED += 1
+
+    if _FRAME_LOG is not None and _check_frame_log_writer():
+        _FRAME_LOG.add({"tick": _TICK_COUNT, "time": time.time(), "dt": dt_millis, "target_dt": target_dt,
+                        "dropped": dropped})
+
+    if dt_millis > _HITCH_RATIO * target_dt:
+        for listener in _HITCH_LISTENERS:
+            listener(_TICK_COUNT, dt_millis, target_dt)
+
+
+def _count_dropped_frames(dt_millis, target_dt):
+    """
+        returns: how many frame deadlines (e.g. vsyncs) were missed while showing this frame, i.e. a frame that takes
+            anywhere from 1 to 2 times the target dt drops one (see _DROPPED_FRAME_TOLERANCE).
+    """
+    return max(0, math.ceil(dt_millis / target_dt - _DROPPED_FRAME_TOLERANCE) - 1)
+
 
 def dt_ratio():
     """Returns the ratio between dt and the target delta time.
@@ -71,3 +124,163 @@ def get_show_fps():
 def set_show_fps(val):
     global _SHOW_FPS
     _SHOW_FPS = val
+
+
+def set_frame_history_length(n):
+    """sets how many of the most recent frames are used for the frame time stats. This clears them."""
+    global _FRAME_TIMES, _FRAME_DROPPED, _FRAME_TIME_IDX, _N_FRAMES_RECORDED
+    _FRAME_TIMES = numpy.zeros(max(1, n), dtype=numpy.float64)
+    _FRAME_DROPPED = numpy.zeros(max(1, n), dtype=numpy.int64)
+    _FRAME_TIME_IDX = 0
+    _N_FRAMES_RECORDED = 0
+
+
+def _get_recent(ring):
+    """returns: the recorded part of one of the frame ring buffers, oldest first (as a copy)."""
+    n = min(_N_FRAMES_RECORDED, len(ring))
+    if n < len(ring):
+        return ring[:n].copy()
+    else:
+        return numpy.concatenate([ring[_FRAME_TIME_IDX:], ring[:_FRAME_TIME_IDX]])
+
+
+def get_frame_time_percentile(pct):
+    """returns: the given percentile (0 - 100) of the recent frame times, in milliseconds, or 0 if there aren't any."""
+    return _percentile(numpy.sort(_get_recent(_FRAME_TIMES)), pct)
+
+
+def _percentile(sorted_times, pct):
+    if len(sorted_times) == 0:
+        return 0
+    return float(sorted_times[min(len(sorted_times) - 1, max(0, math.ceil(pct / 100 * len(sorted_times)) - 1))])
+
+
+def get_frame_time_stats():
+    """
+        returns: summary of the recent frame times (see set_frame_history_length), in milliseconds, like:
+            {"frames": n, "mean": ms, "p50": ms, "p95": ms, "p99": ms, "max": ms,
+             "dropped": frames missed (see _count_dropped_frames),
+             "total_dropped": frames missed since the game started}
+            Dropped frames are counted against each frame's own target dt as it's recorded (which changes
+            with slow motion, for example), so "dropped" and "total_dropped" always agree.
+    """
+    times = numpy.sort(_get_recent(_FRAME_TIMES))
+    if len(times) == 0:
+        return {"frames": 0, "mean": 0, "p50": 0, "p95": 0, "p99": 0, "max": 0, "dropped": 0,
+                "total_dropped": _TOTAL_DROPPED_FRAMES}
+
+    return {
+        "frames": len(times),
+        "mean": float(times.mean()),
+        "p50": _percentile(times, 50),
+        "p95": _percentile(times, 95),
+        "p99": _percentile(times, 99),
+        "max": float(times[-1]),
+        "dropped": int(_get_recent(_FRAME_DROPPED).sum()),
+        "total_dropped": _TOTAL_DROPPED_FRAMES
+    }
+
+
+def get_frame_time_histogram(bucket_ms=1.0):
+    """returns: map of bucket start (in milliseconds) -> how many of the recent frames took that long, in order."""
+    buckets, counts = numpy.unique(numpy.floor(_get_recent(_FRAME_TIMES) / bucket_ms), return_counts=True)
+    return {float(bucket) * bucket_ms: int(count) for bucket, count in zip(buckets, counts)}
+
+
+def set_hitch_ratio(ratio):
+    """sets how many times longer than the target dt a frame has to take to count as a hitch."""
+    global _HITCH_RATIO
+    _HITCH_RATIO = ratio
+
+
+def add_hitch_listener(listener):
+    """
+    :param listener: lambda (tick, dt_millis, target_dt) -> None, called on the main thread after each frame
+                     that was a hitch (see set_hitch_ratio).
+    """
+    _HITCH_LISTENERS.append(listener)
+
+
+def remove_hitch_listener(listener):
+    if listener in _HITCH_LISTENERS:
+        _HITCH_LISTENERS.remove(listener)
+
+
+def start_frame_log(filepath):
+    """
+        Starts writing a JSON record for every frame (its tick, time, dt, target dt, and dropped frames) to the given
+        file, one per line. Writing happens on a background thread, so the game loop only has to queue the records.
+    """
+    global _FRAME_LOG
+    stop_frame_log()
+    _FRAME_LOG = _FrameLog(filepath)
+    print("INFO: logging frame times to {}".format(filepath))
+
+
+def stop_frame_log():
+    """stops the frame log (if there is one) and waits for its remaining records to be written."""
+    global _FRAME_LOG
+    if _FRAME_LOG is not None:
+        _FRAME_LOG.close()
+        _FRAME_LOG = None
+
+
+def _check_frame_log_writer():
+    """
+        returns: whether the frame log's writer is still running. If it isn't (e.g. the file couldn't be written), the
+            frame log is stopped with a warning, rather than queueing records that nothing will write.
+    """
+    global _FRAME_LOG
+    if not _FRAME_LOG.is_writing():
+        print("WARN: the frame log writer for {} stopped unexpectedly, frame logging is now disabled".format(
+            _FRAME_LOG.filepath))
+        _FRAME_LOG = None
+        return False
+    return True
+
+
+def is_logging_frames():
+    return _FRAME_LOG is not None
+
+
+class _FrameLog:
+
+    MAX_QUEUED_RECORDS = 10000  # if the writer falls this far behind, new records are dropped (and counted)
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.n_dropped = 0
+        self._queue = queue.Queue(maxsize=_FrameLog.MAX_QUEUED_RECORDS)
+        self._future = threadutils.do_work_on_background_thread(lambda: self._write_records())
+
+    def is_writing(self):
+        """returns: whether the background writer is still running (it stops early if it fails to write)."""
+        return not self._future.is_done()
+
+    def add(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def close(self):
+        while self.is_writing():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass  # the writer's still draining the queue
+        self._future.wait(poll_rate_secs=0.01, time_limit_secs=10)
+        if self.n_dropped > 0:
+            print("WARN: dropped {} record(s) from the frame log at {}, because they were queued faster than they "
+                  "could be written".format(self.n_dropped, self.filepath))
+
+    def _write_records(self):
+        with open(self.filepath, "w") as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record) + "\n")
+                if self._queue.empty():
+                    f.flush()
@@ -1,7 +1,9 @@
 from OpenGL.GL import *
 
 import numpy
+import bisect
 
+import src.engine.renderengine as renderengine
 import src.engine.sprites as sprites
 import src.utils.util as util
 
@@ -42,16 +44,21 @@ class _Layer:
     def accepts_sprite_type(self, sprite_type):
         raise NotImplementedError()
 
-    def vertex_stride(self):
+    def vertices_per_sprite(self):
         raise NotImplementedError()
 
-    def texture_stride(self):
+    def index_pattern(self):
+        """returns: the indices (relative to a sprite's first vertex) of the triangles that make up each sprite."""
         raise NotImplementedError()
 
     def index_stride(self):
-        raise NotImplementedError()
+        return len(self.index_pattern())
 
-    def color_stride(self):
+    def add_sprites_to_arrays(self, sprite_list, start_idx, vertices, tex_coords, colors, pages=None):
+        """
+            writes the sprites' data into the arrays, starting at sprite index start_idx. The arrays have one
+            row per sprite, see ImageDataArray. pages (if not None) gets the atlas page of each sprite's texture.
+        """
         raise NotImplementedError()
 
     def get_layer_z(self):
@@ -72,9 +79,17 @@ class _Layer:
     def rebuild(self, sprite_info_lookup):
         raise NotImplementedError()
 
+    def get_last_rebuild_stats(self):
+        """returns: map of render stat -> amount (see renderengine.RENDER_STATS) for the most recent rebuild."""
+        return {}
+
     def render(self, engine):
         raise NotImplementedError()
 
+    def release(self, engine):
+        """frees any GPU buffers the layer holds (e.g. when it's removed from the engine)."""
+        pass
+
     def __contains__(self, sprite_id):
         raise NotImplementedError()
 
@@ -84,20 +99,51 @@ class _Layer:
 
 class ImageDataArray:
 
+    # Layout of each vertex. This gets uploaded to the GPU as-is, with all attributes interleaved in one buffer.
+    VERTEX_FORMAT = numpy.dtype([("position", numpy.float32, 3),  # x, y, z
+                                 ("tex_coord", numpy.uint16, 2),  # atlas pixel coords (checked by SpriteAtlas)
+                                 ("color", numpy.uint8, 4)])      # rgba, clamped and normalized to [0, 1]
+
     def __init__(self, parent: 'ImageLayer', min_capacity=256):
         self._parent_layer = parent
         self._array_capacity = 0
         self._min_capacity = min_capacity
         self._size = 0
 
-        self.vertices = numpy.array([], dtype=float)
-        self.tex_coords = numpy.array([], dtype=float)
-        self.indices = numpy.array([], dtype=float)
-        self.colors = numpy.array([], dtype=float)
+        # one row per sprite
+        self.vertex_data = numpy.zeros((0, parent.vertices_per_sprite()), dtype=ImageDataArray.VERTEX_FORMAT)
+
+        # the atlas page of each sprite's texture, which decides which draw call it goes in
+        self.pages = numpy.zeros((0,), dtype=numpy.uint16)
+
+        # views into vertex_data
+        self.vertices = None
+        self.tex_coords = None
+        self.colors = None
+        self._update_views()
+
+        # GPU-side copy of vertex_data, which stays resident between frames. Indices come from the engine's
+        # shared index buffers, since they're the same for every layer.
+        self._buffer_id = None
+        self._buffer_context_id = None
+        self._buffer_capacity = 0  # capacity of the buffers' storage, in sprites
+        self._first_unsynced_idx = 0  # sprites in [first, end) have changed since the last upload
+        self._end_unsynced_idx = 0
+
+        # when the sprites span several atlas pages, each page gets an element buffer that draws its sprites.
+        # They're only rebuilt when a sprite's slot or page changes, not every frame.
+        self._page_index_buffers = {}  # page -> (buffer_id, n_indices), or None to draw with the shared indices
+        self._page_index_context_id = None
+        self._page_indices_stale = True
 
     def __len__(self):
         return self._size
 
+    def _update_views(self):
+        self.vertices = self.vertex_data["position"]
+        self.tex_coords = self.vertex_data["tex_coord"]
+        self.colors = self.vertex_data["color"]
+
     def _ensure_capacity(self, n):
         self._size = n
 
@@ -114,29 +160,255 @@ class ImageDataArray:
             return
 
         # pycharm's debugger likes to hold refs to these in debug mode~
-        self.vertices.resize(capacity * self._parent_layer.vertex_stride(), refcheck=False)
-        self.tex_coords.resize(capacity * self._parent_layer.texture_stride(), refcheck=False)
-        self.indices.resize(capacity * self._parent_layer.index_stride(), refcheck=False)
-        self.colors.resize(capacity * self._parent_layer.color_stride(), refcheck=False)
+        self.vertex_data.resize((capacity, self._parent_layer.vertices_per_sprite()), refcheck=False)
+        self.pages.resize((capacity,), refcheck=False)
+        self._update_views()
 
         self._array_capacity = capacity
 
     def update(self, spr_list, start_idx=0):
-        self._size = len(spr_list)
-        self._ensure_capacity(self._size)
-        for i, spr in enumerate(spr_list[start_idx:]):
-            spr.add_urself(
-                i + start_idx,
-                self.vertices,
-                self.tex_coords,
-                self.colors,
-                self.indices)
-
-    def pass_attributes_and_draw(self, engine):
-        engine.set_vertices(self.vertices)
-        engine.set_texture_coords(self.tex_coords)
-        engine.set_colors(self.colors)
-        engine.draw_elements(self.indices, n=self._size * self._parent_layer.index_stride())
+        self.update_range(spr_list[start_idx:], start_idx, len(spr_list))
+
+    def update_range(self, spr_sublist, start_idx, new_size):
+        """
+            Resizes the arrays to hold new_size sprites, and writes spr_sublist into the slots starting at start_idx.
+            Slots outside that range are left alone.
+        """
+        end_idx = start_idx + len(spr_sublist)
+        if not self._page_indices_stale:
+            old_size = self._size
+            old_pages = self.pages[start_idx:min(end_idx, old_size)].copy()
+
+        self._ensure_capacity(new_size)
+        self._parent_layer.add_sprites_to_arrays(spr_sublist, start_idx, self.vertices, self.tex_coords, self.colors,
+                                                 pages=self.pages)
+
+        if not self._page_indices_stale:
+            self._page_indices_stale = new_size != old_size or not numpy.array_equal(old_pages,
+                                                                                     self.pages[start_idx:end_idx])
+        self._first_unsynced_idx = min(self._first_unsynced_idx, start_idx)
+        self._end_unsynced_idx = max(self._end_unsynced_idx, end_idx)
+
+    def sync_buffers(self, engine):
+        """
+            Uploads whatever's changed since the last call into the engine's buffer objects. Sprites before
+            the first dirty index aren't touched, so static sprites cost nothing here once they've settled.
+        """
+        if self._buffer_id is None or self._buffer_context_id != engine.get_gl_context_id():
+            self._buffer_id = engine.gen_buffer()
+            self._buffer_context_id = engine.get_gl_context_id()
+            self._buffer_capacity = 0
+
+        if self._buffer_capacity != self._array_capacity:
+            # the storage has to be reallocated, so everything gets uploaded
+            engine.set_buffer_data(self._buffer_id, self.vertex_data.view(numpy.uint8))
+            self._buffer_capacity = self._array_capacity
+
+        elif self._first_unsynced_idx < min(self._end_unsynced_idx, self._size):
+            start, end = self._first_unsynced_idx, min(self._end_unsynced_idx, self._size)
+            engine.set_buffer_sub_data(self._buffer_id, self.vertex_data[start:end].view(numpy.uint8),
+                                       start * self.vertex_data.strides[0])
+
+        self._first_unsynced_idx = self._size
+        self._end_unsynced_idx = 0
+
+    def release(self, engine):
+        """frees the GPU buffers. If the array gets drawn again, new ones are created and filled."""
+        if self._buffer_id is not None and self._buffer_context_id == engine.get_gl_context_id():
+            engine.delete_buffers([self._buffer_id])
+        self._buffer_id = None
+        self._buffer_capacity = 0
+
+        if self._page_index_context_id == engine.get_gl_context_id():
+            engine.delete_buffers([buf[0] for buf in self._page_index_buffers.values() if buf is not None])
+        self._page_index_buffers = {}
+        self._page_index_context_id = None
+        self._page_indices_stale = True
+
+    def pass_attributes_and_draw(self, engine, slots=None):
+        """
+            slots: if not None, only the sprites at these indices are drawn (in the given order).
+
+            Sprites on different atlas pages take one draw call per page. Within a page they're drawn in slot
+            order, but a page's sprites are all drawn before the next page's, so translucent sprites only blend
+            in depth order with the other sprites on their own page.
+        """
+        if self._size == 0 or (slots is not None and len(slots) == 0):
+            return
+
+        self.sync_buffers(engine)
+
+        fmt = ImageDataArray.VERTEX_FORMAT
+        engine.bind_buffer(self._buffer_id)
+        engine.set_vertices(None, stride=fmt.itemsize, offset=fmt.fields["position"][1])
+        engine.set_texture_coords(None, stride=fmt.itemsize, offset=fmt.fields["tex_coord"][1],
+                                  gl_type=GL_UNSIGNED_SHORT)
+        engine.set_colors(None, stride=fmt.itemsize, offset=fmt.fields["color"][1], gl_type=GL_UNSIGNED_BYTE)
+
+        lay = self._parent_layer
+        if slots is not None:
+            # the visible sprites change with the camera, so their indices are streamed
+            for page, page_slots in self._get_page_batches(slots, engine):
+                engine.set_texture_page(page)
+                engine.draw_sprite_slots(page_slots, lay.vertices_per_sprite(), lay.index_pattern())
+        else:
+            page_index_buffers = self._sync_page_indices(engine) if engine.get_num_texture_pages() > 1 else {0: None}
+            for page in sorted(page_index_buffers.keys()):
+                engine.set_texture_page(page)
+                if page_index_buffers[page] is None:
+                    index_type = engine.bind_shared_indices(lay.vertices_per_sprite(), lay.index_pattern(),
+                                                            self._array_capacity)
+                    engine.draw_elements(None, n=self._size * lay.index_stride(), index_type=index_type)
+                else:
+                    buffer_id, n_indices = page_index_buffers[page]
+                    engine.bind_buffer(buffer_id, target=GL_ELEMENT_ARRAY_BUFFER)
+                    engine.draw_elements(None, n=n_indices, index_type=GL_UNSIGNED_INT)
+
+        n_drawn = self._size if slots is None else len(slots)
+        engine.count_render_stat(renderengine.VERTICES, n_drawn * lay.vertices_per_sprite())
+
+        # unbind so that client-side arrays (e.g. in ThreeDeeLayer) still work
+        engine.bind_buffer(None)
+        engine.bind_buffer(None, target=GL_ELEMENT_ARRAY_BUFFER)
+
+    def _sync_page_indices(self, engine):
+        """
+            Rebuilds the element buffers that draw each page's sprites, if any sprite moved to a different slot
+            or page since they were last built.
+            returns: map of page -> (buffer_id, n_indices), or page -> None if it's the only page in use.
+        """
+        if self._page_index_context_id != engine.get_gl_context_id():
+            self._page_index_buffers = {}  # the old buffers died with their context
+            self._page_index_context_id = engine.get_gl_context_id()
+            self._page_indices_stale = True
+
+        if self._page_indices_stale:
+            old_buffers = self._page_index_buffers
+            self._page_index_buffers = {}
+
+            slot_pages = self.pages[:self._size]
+            if slot_pages.min() == slot_pages.max():
+                self._page_index_buffers[int(slot_pages[0])] = None
+            else:
+                lay = self._parent_layer
+                pattern = numpy.array(lay.index_pattern(), dtype=numpy.uint32)
+                for page, page_slots in self._group_by_page(numpy.arange(self._size, dtype=numpy.uint32)):
+                    buffer_id = old_buffers[page][0] if old_buffers.get(page) is not None else engine.gen_buffer()
+                    old_buffers.pop(page, None)
+                    indices = (page_slots[:, None] * lay.vertices_per_sprite() + pattern).ravel()
+                    engine.set_buffer_data(buffer_id, indices, target=GL_ELEMENT_ARRAY_BUFFER)
+                    self._page_index_buffers[page] = (buffer_id, len(indices))
+
+            engine.delete_buffers([buf[0] for buf in old_buffers.values() if buf is not None])
+            self._page_indices_stale = False
+
+        return self._page_index_buffers
+
+    def _get_page_batches(self, slots, engine):
+        """returns: list of (page, slots), the sprites to draw with each page's texture bound."""
+        slots = numpy.asarray(slots, dtype=numpy.uint32)
+        if engine.get_num_texture_pages() <= 1:
+            return [(0, slots)]
+        return self._group_by_page(slots)
+
+    def _group_by_page(self, slots):
+        """returns: list of (page, slots) for each page that has sprites in slots, keeping their order within it."""
+        slot_pages = self.pages[slots]
+        order = numpy.argsort(slot_pages, kind="stable")
+        pages, starts = numpy.unique(slot_pages[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        return [(int(page), slots[order[start:end]]) for page, start, end in zip(pages, starts, ends)]
+
+
+class _DepthSortedIds:
+    """
+        Sprite ids sorted by descending depth (i.e. back to front), with ties going to whichever was added first.
+        Sprites can be inserted, removed, and moved without re-sorting, and the range of indices that changed
+        is tracked so that only that part of the layer's data arrays needs to be rewritten.
+    """
+
+    def __init__(self):
+        self._keys = []  # (-depth, insertion order), sorted
+        self._ids = []   # parallel to _keys
+        self._id_to_key = {}
+        self._next_seq = 0
+
+        self._changed_start = None
+        self._changed_end = None  # None means "through the end of the list"
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, sprite_id):
+        return sprite_id in self._id_to_key
+
+    def __getitem__(self, item):
+        return self._ids[item]
+
+    def index_of(self, sprite_id):
+        return bisect.bisect_left(self._keys, self._id_to_key[sprite_id])
+
+    def _mark_changed(self, start, end=None):
+        """end=None means every index after start changed (i.e. the items were shifted)."""
+        if self._changed_start is None:
+            self._changed_start, self._changed_end = start, end
+        else:
+            self._changed_start = min(self._changed_start, start)
+            if self._changed_end is not None:
+                self._changed_end = None if end is None else max(self._changed_end, end)
+
+    def _insert_key(self, sprite_id, key):
+        idx = bisect.bisect_right(self._keys, key)
+        self._keys.insert(idx, key)
+        self._ids.insert(idx, sprite_id)
+        self._id_to_key[sprite_id] = key
+        return idx
+
+    def _remove_key(self, sprite_id):
+        idx = self.index_of(sprite_id)
+        del self._keys[idx]
+        del self._ids[idx]
+        del self._id_to_key[sprite_id]
+        return idx
+
+    def insert(self, sprite_id, depth, seq=None):
+        """seq: what to break ties in depth with (lower = further back), or None to put it in front of the others."""
+        if seq is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        self._mark_changed(self._insert_key(sprite_id, (-depth, seq)))
+
+    def remove(self, sprite_id):
+        self._mark_changed(self._remove_key(sprite_id))
+
+    def remove_all(self, sprite_ids):
+        for sprite_id in sprite_ids:
+            if sprite_id in self._id_to_key:
+                self.remove(sprite_id)
+
+    def get_depth(self, sprite_id):
+        return -self._id_to_key[sprite_id][0]
+
+    def move(self, sprite_id, depth):
+        """updates a sprite's depth. It's also marked as changed if its depth is the same."""
+        old_key = self._id_to_key[sprite_id]
+        old_idx = self._remove_key(sprite_id)
+        new_idx = self._insert_key(sprite_id, (-depth, old_key[1]))
+        self._mark_changed(min(old_idx, new_idx), max(old_idx, new_idx) + 1)
+
+    def get_changed_span(self):
+        """returns: (start, end) of the indices that changed since the last call to clear_changed_span, or None."""
+        if self._changed_start is None:
+            return None
+        end = len(self._ids) if self._changed_end is None else min(self._changed_end, len(self._ids))
+        return (min(self._changed_start, end), end)
+
+    def clear_changed_span(self):
+        self._changed_start = None
+        self._changed_end = None
 
 
 class ImageLayer(_Layer):
@@ -144,11 +416,16 @@ class ImageLayer(_Layer):
         Layer for ImageSprites.
     """
 
-    def __init__(self, layer_id, layer_z):
+    def __init__(self, layer_id, layer_z, cull_cell_size=None):
+        """
+            cull_cell_size: if not None, sprites are kept in a spatial index with cells of this size (in world
+                units), and only the ones that intersect the visible area get drawn. Worth it for large layers
+                where most of the sprites are off-screen.
+        """
         _Layer.__init__(self, layer_id, layer_z)
 
         self.opaque_images = []
-        self.trans_images = []
+        self.trans_images = _DepthSortedIds()
         self._id_to_idx = {}
 
         self._last_known_last_modified_ticks = {}  # image id -> int
@@ -161,6 +438,15 @@ class ImageLayer(_Layer):
         self._to_remove = set()
         self._to_add = set()
 
+        self._spatial_index = None if cull_cell_size is None else util.SpatialHashMap(cull_cell_size)
+        self._insertion_order = {}  # sprite id -> int
+        self._next_insertion_order = 0
+
+        # every sprite in back-to-front order, for compatibility mode. Only kept up to date after it's first needed.
+        self._compat_draw_order = None
+
+        self._last_rebuild_stats = {}
+
     def update(self, sprite_id, last_mod_time):
         assert_int(sprite_id)
         if sprite_id in self._id_to_idx:
@@ -173,6 +459,8 @@ class ImageLayer(_Layer):
         else:
             self._id_to_idx[sprite_id] = -1
             self._to_add.add(sprite_id)
+            self._insertion_order[sprite_id] = self._next_insertion_order
+            self._next_insertion_order += 1
 
         self._last_known_last_modified_ticks[sprite_id] = last_mod_time
 
@@ -182,6 +470,8 @@ class ImageLayer(_Layer):
             del self._id_to_idx[sprite_id]
             self._to_remove.add(sprite_id)
             del self._last_known_last_modified_ticks[sprite_id]
+            if sprite_id in self._insertion_order:
+                del self._insertion_order[sprite_id]
 
     def is_dirty(self):
         return len(self._dirty_sprites) + len(self._to_add) + len(self._to_remove) > 0
@@ -189,28 +479,55 @@ class ImageLayer(_Layer):
     def accepts_sprite_type(self, sprite_type):
         return sprite_type == sprites.SpriteTypes.IMAGE
 
-    def vertex_stride(self):
-        return 4 * 3
+    def vertices_per_sprite(self):
+        return 4
 
-    def texture_stride(self):
-        return 8
+    def index_pattern(self):
+        return (0, 1, 2, 0, 2, 3)
 
-    def index_stride(self):
-        return 6
+    def add_sprites_to_arrays(self, sprite_list, start_idx, vertices, tex_coords, colors, pages=None):
+        sprites.ImageSprite.add_all_urselves(sprite_list, start_idx, vertices, tex_coords, colors, pages=pages)
 
-    def color_stride(self):
-        return 4 * 3
+    def get_sprite_bounds(self, sprite):
+        """returns: the rect (in world coordinates) that contains the sprite, for culling."""
+        return sprite.rect()
 
-    def populate_data_arrays(self, opaque_ids, translucent_ids, sprite_info_lookup, first_dirty_opaque_idx=0):
+    def populate_data_arrays(self, opaque_ids, translucent_ids, sprite_info_lookup, first_dirty_opaque_idx=0,
+                             trans_span=None):
         # order doesn't matter for opaque sprites
-        opaques = [sprite_info_lookup[spr_id].sprite for spr_id in opaque_ids]
-        self.opaque_data_arrays.update(opaques, start_idx=first_dirty_opaque_idx)
+        opaques = [sprite_info_lookup[spr_id].sprite for spr_id in opaque_ids[first_dirty_opaque_idx:]]
+        self.opaque_data_arrays.update_range(opaques, first_dirty_opaque_idx, len(opaque_ids))
 
         # translucent sprites should already be sorted (necessary for proper rendering)
-        trans = [sprite_info_lookup[spr_id].sprite for spr_id in translucent_ids]
-        self.trans_data_arrays.update(trans)
+        start, end = trans_span if trans_span is not None else (0, len(translucent_ids))
+        trans = [sprite_info_lookup[spr_id].sprite for spr_id in translucent_ids[start:end]]
+        self.trans_data_arrays.update_range(trans, start, len(translucent_ids))
+
+    def _update_compat_draw_order(self, sprite_info_lookup):
+        self._compat_draw_order.remove_all(self._to_remove)
+        for spr_id in self._dirty_sprites:
+            if spr_id in self._compat_draw_order:
+                depth = sprite_info_lookup[spr_id].sprite.depth()
+                if depth != self._compat_draw_order.get_depth(spr_id):
+                    self._compat_draw_order.move(spr_id, depth)
+        for spr_id in self._to_add:
+            if spr_id not in self._to_remove and spr_id not in self._compat_draw_order:
+                self._compat_draw_order.insert(spr_id, sprite_info_lookup[spr_id].sprite.depth(),
+                                               seq=self._insertion_order[spr_id])
+        self._compat_draw_order.clear_changed_span()
+
+    def _get_compat_draw_order(self, sprite_info_lookup):
+        if self._compat_draw_order is None:
+            self._compat_draw_order = _DepthSortedIds()
+            for spr_id in self._id_to_idx:
+                self._compat_draw_order.insert(spr_id, sprite_info_lookup[spr_id].sprite.depth(),
+                                               seq=self._insertion_order[spr_id])
+        return self._compat_draw_order
 
     def rebuild(self, sprite_info_lookup):
+        if self._compat_draw_order is not None:
+            self._update_compat_draw_order(sprite_info_lookup)
+
         first_dirty_idx = self._first_dirty_idx
         if len(self._to_remove) > 0:
             for sprite_id in self._to_remove:
@@ -218,19 +535,37 @@ class ImageLayer(_Layer):
                     del self._id_to_idx[sprite_id]
                 if sprite_id in self._last_known_last_modified_ticks:
                     del self._last_known_last_modified_ticks[sprite_id]
+                if self._spatial_index is not None:
+                    self._spatial_index.remove(sprite_id)
 
             self._to_add.difference_update(self._to_remove)
-            util.remove_all_from_list_in_place(self.trans_images, self._to_remove)
+            self.trans_images.remove_all(self._to_remove)
 
             rm_idx = util.remove_all_from_list_in_place(self.opaque_images, self._to_remove)
             if rm_idx >= 0:
                 first_dirty_idx = min(rm_idx, first_dirty_idx)
             self._to_remove.clear()
 
+        if self._spatial_index is not None:
+            for spr_id in self._to_add | self._dirty_sprites:
+                if spr_id in self._id_to_idx:
+                    bounds = self.get_sprite_bounds(sprite_info_lookup[spr_id].sprite)
+                    self._spatial_index.put(spr_id, bounds)
+
+        n_trans_sorted = 0
+
+        # translucent sprites that changed may have moved to a different depth
+        for spr_id in self._dirty_sprites:
+            if spr_id in self.trans_images:
+                self.trans_images.move(spr_id, sprite_info_lookup[spr_id].sprite.depth())
+                n_trans_sorted += 1
+
         new_opaque_sprites = []
         for spr_id in self._to_add:
-            if sprite_info_lookup[spr_id].sprite.is_translucent():
-                self.trans_images.append(spr_id)
+            spr = sprite_info_lookup[spr_id].sprite
+            if spr.is_translucent():
+                self.trans_images.insert(spr_id, spr.depth(), seq=self._insertion_order[spr_id])
+                n_trans_sorted += 1
             else:
                 new_opaque_sprites.append(spr_id)
         self._to_add.clear()
@@ -244,7 +579,9 @@ class ImageLayer(_Layer):
                 clean_opaque_sprites.append(spr_id)
             elif sprite_info_lookup[spr_id].sprite.is_translucent():
                 self._id_to_idx[spr_id] = -1
-                self.trans_images.append(spr_id)  # opaque sprite became translucent
+                self.trans_images.insert(spr_id, sprite_info_lookup[spr_id].sprite.depth(),  # became translucent
+                                         seq=self._insertion_order[spr_id])
+                n_trans_sorted += 1
             else:
                 dirty_opaque_sprites.append(spr_id)
         self._dirty_sprites.clear()
@@ -255,36 +592,86 @@ class ImageLayer(_Layer):
         self.opaque_images = super_clean_sprites + clean_opaque_sprites + dirty_opaque_sprites + new_opaque_sprites
         self._first_dirty_idx = len(self.opaque_images)
 
-        self.trans_images.sort(key=lambda x: -sprite_info_lookup[x].sprite.depth())
-
         for idx in range(len(super_clean_sprites), len(self.opaque_images)):
             self._id_to_idx[self.opaque_images[idx]] = idx
 
+        trans_span = self.trans_images.get_changed_span()
+        self.trans_images.clear_changed_span()
+
+        trans_span = trans_span if trans_span is not None else (0, 0)
         self.populate_data_arrays(self.opaque_images, self.trans_images, sprite_info_lookup,
-                                  first_dirty_opaque_idx=first_dirty_idx)
+                                  first_dirty_opaque_idx=first_dirty_idx, trans_span=trans_span)
+
+        # sprites before first_dirty_idx (and outside the translucent span) are the ones the percolation skipped
+        n_rebuilt = (len(self.opaque_images) - first_dirty_idx) + (trans_span[1] - trans_span[0])
+        n_sprites = len(self.opaque_images) + len(self.trans_images)
+        self._last_rebuild_stats = {renderengine.SPRITES_REBUILT: n_rebuilt,
+                                    renderengine.SPRITES_SKIPPED: n_sprites - n_rebuilt,
+                                    renderengine.TRANSLUCENT_SORTED: n_trans_sorted}
+
+    def get_last_rebuild_stats(self):
+        return self._last_rebuild_stats
+
+    def is_culling(self):
+        return self._spatial_index is not None
+
+    def get_visible_rect(self, engine):
+        """returns: the area of the world (in this layer's coordinates) that's currently on screen."""
+        game_w, game_h = engine.get_game_size()
+        offs = self.get_offset()
+        scale = self.get_scale()
+        return (offs[0] / scale, offs[1] / scale, game_w / scale, game_h / scale)
+
+    def get_visible_sprite_ids(self, engine):
+        """returns: the ids of the sprites that intersect the visible rect, in no particular order."""
+        if self._spatial_index is None:
+            return list(self._id_to_idx.keys())
+        else:
+            return [item[0] for item in self._spatial_index.all_items_in_rect(self.get_visible_rect(engine))]
+
+    def _get_visible_slots(self, engine):
+        """returns: (opaque_slots, trans_slots), the indices of the visible sprites in each data array."""
+        opaque_slots = []
+        trans_slots = []
+        for spr_id in self.get_visible_sprite_ids(engine):
+            idx = self._id_to_idx[spr_id]
+            if idx >= 0:
+                opaque_slots.append(idx)
+            else:
+                trans_slots.append(self.trans_images.index_of(spr_id))
 
-        # if self.get_num_sprites() > 100:
-        #     print(f"INFO: Rebuilt {self.get_num_sprites()} sprites with a no-op rate of: "
-        #           f"{(first_dirty_idx + 1) / len(self.opaque_images)}")
+        # translucent sprites need to stay in back-to-front order
+        opaque_slots.sort()
+        trans_slots.sort()
+        return opaque_slots, trans_slots
 
     def render(self, engine):
         engine.set_camera_2d(self.get_offset(), scale=[self.get_scale()] * 2)
 
-        if engine.is_opengl():
+        if engine.uses_data_arrays():
+            opaque_slots, trans_slots = self._get_visible_slots(engine) if self.is_culling() else (None, None)
+
             self.set_client_states(True, engine)
-            self.opaque_data_arrays.pass_attributes_and_draw(engine)
+            self.opaque_data_arrays.pass_attributes_and_draw(engine, slots=opaque_slots)
 
             engine.set_depth_write_enabled(False)
-            self.trans_data_arrays.pass_attributes_and_draw(engine)
+            self.trans_data_arrays.pass_attributes_and_draw(engine, slots=trans_slots)
             engine.set_depth_write_enabled(True)
 
             self.set_client_states(False, engine)
         else:
             # compatibility mode
-            all_sprites = [engine.sprite_info_lookup[spr_id].sprite for spr_id in self._id_to_idx]
-            all_sprites.sort(key=lambda sprite: -sprite.depth())
-            for spr in all_sprites:
-                engine.blit_sprite(spr)
+            lookup = engine.sprite_info_lookup
+            if self.is_culling():
+                sprite_ids = self.get_visible_sprite_ids(engine)
+                sprite_ids.sort(key=lambda spr_id: (-lookup[spr_id].sprite.depth(), self._insertion_order[spr_id]))
+            else:
+                sprite_ids = self._get_compat_draw_order(lookup)
+            engine.blit_sprites([lookup[spr_id].sprite for spr_id in sprite_ids])
+
+    def release(self, engine):
+        self.opaque_data_arrays.release(engine)
+        self.trans_data_arrays.release(engine)
 
     def set_client_states(self, enable, engine):
         engine.set_vertices_enabled(enable)
@@ -305,21 +692,20 @@ class ImageLayer(_Layer):
 
 class PolygonLayer(ImageLayer):
 
-    def __init__(self, layer_id, layer_z):
-        ImageLayer.__init__(self, layer_id, layer_z)
+    def __init__(self, layer_id, layer_z, cull_cell_size=None):
+        ImageLayer.__init__(self, layer_id, layer_z, cull_cell_size=cull_cell_size)
 
     def accepts_sprite_type(self, sprite_type):
         return sprite_type == sprites.SpriteTypes.TRIANGLE
 
-    def vertex_stride(self):
-        return 3 * 3
-
-    def texture_stride(self):
-        return 6
-
-    def index_stride(self):
+    def vertices_per_sprite(self):
         return 3
 
-    def color_stride(self):
-        return 3 * 3
+    def index_pattern(self):
+        return (0, 1, 2)
+
+    def add_sprites_to_arrays(self, sprite_list, start_idx, vertices, tex_coords, colors, pages=None):
+        sprites.TriangleSprite.add_all_urselves(sprite_list, start_idx, vertices, tex_coords, colors, pages=pages)
 
+    def get_sprite_bounds(self, sprite):
+        return util.get_rect_containing_points(sprite.points())
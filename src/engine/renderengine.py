@@ -5,9 +5,15 @@ import numpy
 import math
 import re
 import traceback
+import ctypes
+import collections
+import time
 import pygame
 
+import configs
+
 import src.engine.globaltimer as globaltimer
+import src.engine.frametimers as frametimers
 import src.engine.crashreporting as crashreporting
 import src.utils.util as util
 import src.utils.matutils as matutils
@@ -15,6 +21,20 @@ import src.utils.matutils as matutils
 
 _SINGLETON = None
 
+# per-frame render stats (see RenderEngine.get_render_stats)
+DRAW_CALLS = "draw_calls"                   # draws (or blits, in compat mode)
+STATE_CHANGES = "state_changes"             # texture and buffer binds, vertex attribute setup, enabling/disabling
+UNIFORM_UPLOADS = "uniform_uploads"         # matrices and other shader uniforms that were set
+VERTICES = "vertices"                       # vertices in the sprites and meshes that were drawn
+INDICES = "indices"                         # indices that were drawn
+BYTES_UPLOADED = "bytes_uploaded"           # buffer and texture data sent to the GPU
+SPRITES_REBUILT = "sprites_rebuilt"         # sprites whose vertex data had to be rewritten by Layer.rebuild
+SPRITES_SKIPPED = "sprites_skipped"         # sprites that Layer.rebuild could skip over because they hadn't changed
+TRANSLUCENT_SORTED = "translucent_sorted"   # translucent sprites that were (re)inserted into depth order
+
+RENDER_STATS = (DRAW_CALLS, STATE_CHANGES, UNIFORM_UPLOADS, VERTICES, INDICES, BYTES_UPLOADED,
+                SPRITES_REBUILT, SPRITES_SKIPPED, TRANSLUCENT_SORTED)
+
 
 def create_instance(glsl_version):
     """Initializes (or re-initializes) the RenderEngine singleton."""
@@ -33,12 +53,25 @@ def create_instance(glsl_version):
         _SINGLETON.set_min_size(*old_engine.min_size)
         _SINGLETON.set_pixel_scale(old_engine.get_pixel_scale())
 
-        _SINGLETON.set_texture_atlas(old_engine.cached_texture_atlas)
+        _SINGLETON.set_texture_atlas_pages(old_engine.cached_texture_pages)
         _SINGLETON.sprite_info_lookup.update(old_engine.sprite_info_lookup)
+        _SINGLETON._prev_gen_ids.update(old_engine._prev_gen_ids)
+        _SINGLETON._cur_gen_ids.update(old_engine._cur_gen_ids)
+        _SINGLETON._last_eviction_tick = old_engine._last_eviction_tick
+        _SINGLETON._persistent_roots.update(old_engine._persistent_roots)
+        _SINGLETON._persistent_ids.update(old_engine._persistent_ids)
 
     return _SINGLETON
 
 
+def create_headless_instance():
+    """Initializes the RenderEngine singleton as a HeadlessRenderEngine, which needs neither a display nor a GPU."""
+    global _SINGLETON
+    _SINGLETON = HeadlessRenderEngine()
+    crashreporting.add_runtime_info("Render Engine", "HeadlessRenderEngine")
+    return _SINGLETON
+
+
 def get_instance() -> 'RenderEngine':
     """after init is called, returns the RenderEngine singleton."""
     return _SINGLETON
@@ -99,15 +132,32 @@ def _get_best_render_engine(glsl_version):
         return PurePygameRenderEngine()
 
 
+_GL_CONTEXT_COUNTER = 0
+
+
+def _next_gl_context_id():
+    global _GL_CONTEXT_COUNTER
+    _GL_CONTEXT_COUNTER += 1
+    return _GL_CONTEXT_COUNTER
+
+
 def printOpenGLError():
     err = glGetError()
     if err != GL_NO_ERROR:
         print("GLERROR: {}".format(gluErrorString(err)))
 
 
+def _attrib_data(data, offset=0):
+    """data: a client-side array, or None to read from the bound GL_ARRAY_BUFFER (starting at a byte offset)."""
+    return data if data is not None else ctypes.c_void_p(offset)
+
+
 class Shader:
 
-    def __init__(self, vertex_shader_source, fragment_shader_source):
+    def __init__(self, vertex_shader_source, fragment_shader_source, attrib_locations=None):
+        """
+            attrib_locations: optional map from attribute names to the locations they should be bound to.
+        """
         self.program = glCreateProgram()
         printOpenGLError()
 
@@ -129,6 +179,10 @@ class Shader:
         if len(info_log) > 0:
             print("INFO: fragment shader has non-empty info log: {}".format(info_log))
 
+        if attrib_locations is not None:
+            for name in attrib_locations:
+                glBindAttribLocation(self.program, attrib_locations[name], name)
+
         glLinkProgram(self.program)
         printOpenGLError()
 
@@ -143,6 +197,15 @@ class Shader:
         glUseProgram(0)
 
 
+def _all_leaves(sprite):
+    if sprite.is_parent():
+        for child_sprite in sprite.all_sprites():
+            for leaf in _all_leaves(child_sprite):
+                yield leaf
+    else:
+        yield sprite
+
+
 class _SpriteInfoBundle:
 
     def __init__(self, sprite, last_updated_tick):
@@ -150,10 +213,65 @@ class _SpriteInfoBundle:
         self.last_updated_tick = last_updated_tick
 
 
+class _MeshBuffers:
+
+    def __init__(self, vertex_buffer, tex_coord_buffer, index_buffer, n_indices, context_id):
+        self.vertex_buffer = vertex_buffer
+        self.tex_coord_buffer = tex_coord_buffer
+        self.index_buffer = index_buffer
+        self.n_indices = n_indices
+        self.context_id = context_id
+
+
+class _SharedIndexBuffer:
+    """
+        Element buffer for drawing sprites that all share the same index pattern (e.g. two triangles per quad).
+        Indices only depend on each sprite's position in the vertex buffer, so one of these can serve every layer.
+    """
+
+    def __init__(self, vertices_per_sprite, pattern):
+        self.vertices_per_sprite = vertices_per_sprite
+        self.pattern = numpy.array(pattern, dtype=numpy.uint32)
+
+        self.capacity = 0  # in sprites
+        self.indices = numpy.zeros((0, len(pattern)), dtype=numpy.uint16)
+
+        self.buffer_id = None
+        self.context_id = None
+        self.needs_upload = True
+
+    def ensure_capacity(self, n_sprites):
+        capacity = util.next_power_of_2(n_sprites)
+        if capacity <= self.capacity:
+            return  # never shrinks, since other layers may still need it
+
+        n_vertices = capacity * self.vertices_per_sprite
+        index_type = numpy.uint16 if n_vertices <= 2 ** 16 else numpy.uint32
+        first_vertices = numpy.arange(0, n_vertices, self.vertices_per_sprite, dtype=numpy.uint32)
+        self.indices = (first_vertices[:, None] + self.pattern).astype(index_type)
+
+        self.capacity = capacity
+        self.needs_upload = True
+
+    def get_gl_type(self):
+        return GL_UNSIGNED_SHORT if self.indices.dtype == numpy.uint16 else GL_UNSIGNED_INT
+
+
 class RenderEngine:
 
     def __init__(self):
         self.sprite_info_lookup = {}  # (int) id -> _SpriteInfoBundle
+
+        # sprites are tracked in two generations, so that finding the stale ones doesn't require a full scan.
+        self._prev_gen_ids = {}  # id -> None, for sprites that were rendered last frame but haven't been updated since
+        self._cur_gen_ids = {}   # id -> None, for sprites that have been updated since the last frame
+        self._last_eviction_tick = -1
+        self._n_evicted_last_frame = 0
+
+        # persistent sprites are exempt from the generations above, and stay until they're explicitly removed.
+        self._persistent_roots = {}  # root id -> {leaf id -> None}
+        self._persistent_ids = {}    # leaf id -> root id
+
         self.size = (0, 0)
         self.min_size = (0, 0)
         self._pixel_scale = 1  # the number of screen "pixels" per game pixel
@@ -162,19 +280,33 @@ class RenderEngine:
         self.ordered_layers = []
         self.shader = None
 
-        self.tex_id = None
+        self.tex_ids = []  # one texture per atlas page
+        self._cur_texture_page = None  # the page whose texture is bound
+
+        self.cached_texture_pages = []  # list of pygame.Surface
+
+        # changes whenever the GL context is (potentially) replaced, which invalidates all buffer objects.
+        self._gl_context_id = _next_gl_context_id()
+
+        self._shared_index_buffers = {}  # (vertices_per_sprite, index pattern) -> _SharedIndexBuffer
+        self._stream_index_buffer = None  # (buffer_id, gl_context_id), for drawing subsets of sprites
+        self._mesh_cache = {}  # ThreeDeeModel id -> _MeshBuffers
+
+        self._render_stats = {}       # layer_id (or None, outside of layers) -> Counter of stat -> amount, this frame
+        self._last_render_stats = {}  # same, for the most recently drawn frame
+        self._render_stats_layer_id = None
 
-        self.cached_texture_atlas = None
-        self.raw_texture_data = (None, 0, 0)  # data, width, height
-        
     def add_layer(self, layer):
+        old_layer = self.layers.get(layer.get_layer_id())
+        if old_layer is not None and old_layer is not layer:
+            old_layer.release(self)
         self.layers[layer.get_layer_id()] = layer
         
         self.ordered_layers = list(self.layers.values())
         self.ordered_layers.sort(key=lambda x: x.get_layer_z())
         
     def remove_layer(self, layer_id):
-        del self.layers[layer_id]
+        self.layers.pop(layer_id).release(self)
         
         self.ordered_layers = list(self.layers.values())
         self.ordered_layers.sort(key=lambda x: x.get_layer_z())
@@ -265,16 +397,32 @@ class RenderEngine:
     def resize_internal(self):
         raise NotImplementedError()
 
+    def _calc_optimal_vp_size(self, window_size, px_scale):
+        """
+            finds the smallest dimensions greater than or equal to window_size
+            that are evenly divisible by px_scale.
+        """
+        w, h = window_size
+        if w % px_scale != 0:
+            w += (px_scale - w % px_scale)
+        if h % px_scale != 0:
+            h += (px_scale - h % px_scale)
+        return (w, h)
+
     def set_vertices_enabled(self, val):
         raise NotImplementedError()
 
-    def set_vertices(self, data):
+    def set_vertices(self, data, stride=0, offset=0):
+        """
+            data: client-side array of floats, or None to use the bound GL_ARRAY_BUFFER.
+            stride, offset: in bytes, for interleaved data.
+        """
         raise NotImplementedError()
 
     def set_texture_coords_enabled(self, val):
         raise NotImplementedError()
 
-    def set_texture_coords(self, data):
+    def set_texture_coords(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
         raise NotImplementedError()
 
     def set_colors_enabled(self, val):
@@ -289,12 +437,30 @@ class RenderEngine:
     def set_alpha_test_enabled(self, val):
         raise NotImplementedError()
 
-    def set_colors(self, data):
+    def set_colors(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
+        """
+            gl_type: if this is an integer type, the values are normalized (e.g. GL_UNSIGNED_BYTE 255 -> 1.0).
+        """
+        raise NotImplementedError()
+
+    def supports_instancing(self):
+        """returns: whether set_instance_model_matrices and draw_elements_instanced can be used."""
+        return False
+
+    def set_instance_model_matrices(self, matrices):
+        """
+            matrices: list of 4x4 model matrices, one per instance, to use instead of the model matrix in
+                subsequent instanced draws. Or None to go back to using the model matrix.
+        """
         raise NotImplementedError()
 
     def is_opengl(self):
         return True
 
+    def uses_data_arrays(self):
+        """returns: whether layers should be drawn from their vertex data (see layers.ImageDataArray) or blitted."""
+        return True
+
     def get_shader(self):
         return self.shader
 
@@ -318,28 +484,99 @@ class RenderEngine:
            gl context, so we get around that by rebuilding the shader program and rebinding the texture...
         """
         self.shader.end()
+        self._gl_context_id = _next_gl_context_id()  # any buffers we were holding are gone now
+        self._mesh_cache.clear()
 
         self.shader = self.build_shader()
         self.shader.begin()
         self.setup_shader()
 
-        img_data, w, h = self.raw_texture_data
-        if img_data is not None:
-            self._set_texture_data_as_str(img_data, w, h, tex_id=self.tex_id)
+        self._upload_texture_pages()
+
+    def get_max_texture_size(self):
+        """returns: the largest texture width (and height) the driver supports, or None if there's no limit."""
+        return int(glGetIntegerv(GL_MAX_TEXTURE_SIZE))
 
     def set_texture_atlas(self, texture: pygame.Surface):
-        self.cached_texture_atlas = texture
-        img_data = pygame.image.tostring(texture, 'RGBA', True)
-        self._set_texture_data_as_str(img_data, texture.get_width(), texture.get_height())
+        self.set_texture_atlas_pages([texture])
 
-    def _set_texture_data_as_str(self, img_data, width, height, tex_id=None):
+    def set_texture_atlas_pages(self, pages):
         """
-            img_data: image data in string RGBA format.
+            pages: list of Surfaces, one per atlas page (see SpriteAtlas.create_atlas_pages). Each gets its own
+                texture, and ImageModels use their page index to say which one they're on.
+        """
+        self.cached_texture_pages = list(pages)
+        self._upload_texture_pages()
+
+    def add_texture_page(self, page):
+        """adds a page to the end of the atlas, without re-uploading the existing ones. returns: its index."""
+        self.cached_texture_pages.append(page)
+        self.tex_ids.append(glGenTextures(1))
+        self._upload_texture_page(len(self.cached_texture_pages) - 1)
+        return len(self.cached_texture_pages) - 1
+
+    def update_texture_page_region(self, page, surface, rect):
+        """
+            Re-uploads part of a page after it's been drawn on, e.g. when a sheet is added at runtime.
+            surface: the page's updated image. rect: (x, y, w, h) the area that changed.
         """
-        if tex_id is None:
-            tex_id = glGenTextures(1)
-            self.tex_id = tex_id
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return
+        self.cached_texture_pages[page] = surface
+
+        # GL's y-axis points up, so the data and its position are flipped
+        img_data = pygame.image.tostring(surface.subsurface(rect), 'RGBA', True)
+        glBindTexture(GL_TEXTURE_2D, self.tex_ids[page])
+        glTexSubImage2D(GL_TEXTURE_2D, 0, x, surface.get_height() - (y + h), w, h, GL_RGBA, GL_UNSIGNED_BYTE, img_data)
+        printOpenGLError()
+        self.count_render_stat(BYTES_UPLOADED, len(img_data))
+
+        self._cur_texture_page = page
+        self.on_texture_changed()
+
+    def _upload_texture_pages(self):
+        n_pages = len(self.cached_texture_pages)
+        if len(self.tex_ids) > n_pages:
+            glDeleteTextures(self.tex_ids[n_pages:])
+            self.tex_ids = self.tex_ids[:n_pages]
+        while len(self.tex_ids) < n_pages:
+            self.tex_ids.append(glGenTextures(1))
 
+        for page in range(0, n_pages):
+            self._upload_texture_page(page)
+
+        self._cur_texture_page = None
+        if n_pages > 0:
+            self.set_texture_page(0)
+
+    def _upload_texture_page(self, page):
+        surface = self.cached_texture_pages[page]
+        img_data = pygame.image.tostring(surface, 'RGBA', True)
+        self._set_texture_data_as_str(img_data, surface.get_width(), surface.get_height(), self.tex_ids[page])
+        self.count_render_stat(BYTES_UPLOADED, len(img_data))
+
+        self._cur_texture_page = page
+        self.on_texture_changed()
+
+    def get_num_texture_pages(self):
+        return len(self.cached_texture_pages)
+
+    def get_texture_page_size(self, page):
+        return self.cached_texture_pages[page].get_size()
+
+    def set_texture_page(self, page):
+        """binds the texture of the given atlas page, for drawing the sprites on it."""
+        if page != self._cur_texture_page and 0 <= page < len(self.tex_ids):
+            glBindTexture(GL_TEXTURE_2D, self.tex_ids[page])
+            self._cur_texture_page = page
+            self.on_texture_changed()
+            self.count_render_stat(STATE_CHANGES)
+
+    def _set_texture_data_as_str(self, img_data, width, height, tex_id):
+        """
+            img_data: image data in string RGBA format.
+        """
         glBindTexture(GL_TEXTURE_2D, tex_id)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
@@ -349,70 +586,359 @@ class RenderEngine:
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-        self.raw_texture_data = (img_data, width, height)
-
-        self.on_texture_changed()
-
     def on_texture_changed(self):
         pass
+
+    def get_gl_context_id(self):
+        """returns: an id that changes whenever buffer objects created through this engine become invalid."""
+        return self._gl_context_id
+
+    def gen_buffer(self):
+        return glGenBuffers(1)
+
+    def delete_buffers(self, buffer_ids):
+        """frees buffer objects that were created with gen_buffer (in the current GL context)."""
+        if len(buffer_ids) > 0:
+            glDeleteBuffers(len(buffer_ids), buffer_ids)
+
+    def bind_buffer(self, buffer_id, target=GL_ARRAY_BUFFER):
+        """binds a buffer object, or unbinds the current one if buffer_id is None."""
+        glBindBuffer(target, buffer_id if buffer_id is not None else 0)
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_buffer_data(self, buffer_id, data, target=GL_ARRAY_BUFFER, usage=GL_DYNAMIC_DRAW):
+        """(re)allocates a buffer's storage to fit data, and fills it."""
+        glBindBuffer(target, buffer_id)
+        glBufferData(target, data.nbytes, data, usage)
+        printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
+        self.count_render_stat(BYTES_UPLOADED, data.nbytes)
+
+    def set_buffer_sub_data(self, buffer_id, data, byte_offset, target=GL_ARRAY_BUFFER):
+        """overwrites part of a buffer's existing storage, starting at byte_offset."""
+        glBindBuffer(target, buffer_id)
+        glBufferSubData(target, byte_offset, data.nbytes, data)
+        printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
+        self.count_render_stat(BYTES_UPLOADED, data.nbytes)
+
+    def bind_shared_indices(self, vertices_per_sprite, pattern, n_sprites):
+        """
+            Binds an element buffer that draws at least n_sprites sprites, where the i-th sprite's vertices start
+            at i * vertices_per_sprite and are connected according to pattern. The buffer is shared by every
+            layer with the same geometry, and only gets rebuilt when it needs to grow past a power of two.
+            returns: the GL type of the bound indices.
+        """
+        key = (vertices_per_sprite, tuple(pattern))
+        if key not in self._shared_index_buffers:
+            self._shared_index_buffers[key] = _SharedIndexBuffer(vertices_per_sprite, pattern)
+        index_buffer = self._shared_index_buffers[key]
+        index_buffer.ensure_capacity(n_sprites)
+
+        if index_buffer.buffer_id is None or index_buffer.context_id != self.get_gl_context_id():
+            index_buffer.buffer_id = self.gen_buffer()
+            index_buffer.context_id = self.get_gl_context_id()
+            index_buffer.needs_upload = True
+
+        if index_buffer.needs_upload:
+            self.set_buffer_data(index_buffer.buffer_id, index_buffer.indices, target=GL_ELEMENT_ARRAY_BUFFER)
+            index_buffer.needs_upload = False
+        else:
+            self.bind_buffer(index_buffer.buffer_id, target=GL_ELEMENT_ARRAY_BUFFER)
+
+        return index_buffer.get_gl_type()
+
+    def bind_mesh(self, model_3d):
+        """
+            Binds a ThreeDeeModel's vertex, texture coord, and index buffers, uploading them first if they aren't
+            cached yet. The cache is keyed by model id, so call invalidate_mesh if a model's data changes.
+            returns: the number of indices in the mesh (which are GL_UNSIGNED_INTs).
+        """
+        model_id = model_3d.get_model_id()
+        mesh = self._mesh_cache.get(model_id)
+        if mesh is None or mesh.context_id != self.get_gl_context_id():
+            vertices, tex_coords, indices = model_3d.get_mesh_arrays()
+            mesh = _MeshBuffers(self.gen_buffer(), self.gen_buffer(), self.gen_buffer(), len(indices),
+                                self.get_gl_context_id())
+            self.set_buffer_data(mesh.vertex_buffer, vertices, usage=GL_STATIC_DRAW)
+            self.set_buffer_data(mesh.tex_coord_buffer, tex_coords, usage=GL_STATIC_DRAW)
+            self.set_buffer_data(mesh.index_buffer, indices, target=GL_ELEMENT_ARRAY_BUFFER, usage=GL_STATIC_DRAW)
+            self._mesh_cache[model_id] = mesh
+
+        self.bind_buffer(mesh.vertex_buffer)
+        self.set_vertices(None)
+        self.bind_buffer(mesh.tex_coord_buffer)
+        self.set_texture_coords(None)
+        self.bind_buffer(mesh.index_buffer, target=GL_ELEMENT_ARRAY_BUFFER)
+
+        return mesh.n_indices
+
+    def invalidate_mesh(self, model_id=None):
+        """
+            Drops the cached buffers for a ThreeDeeModel, so they're rebuilt the next time it's drawn.
+            model_id: the model's id, or None to drop every cached mesh.
+        """
+        model_ids = list(self._mesh_cache.keys()) if model_id is None else [model_id]
+        for m_id in model_ids:
+            if m_id in self._mesh_cache:
+                mesh = self._mesh_cache[m_id]
+                if mesh.context_id == self.get_gl_context_id():
+                    self.delete_buffers([mesh.vertex_buffer, mesh.tex_coord_buffer, mesh.index_buffer])
+                del self._mesh_cache[m_id]
+
+    def draw_sprite_slots(self, slots, vertices_per_sprite, pattern):
+        """
+            Draws a subset of the sprites in the bound vertex buffer, in the given order. Unlike the shared index
+            buffers, the indices are streamed to the GPU on every call, so this is meant for things like culling.
+        """
+        if self._stream_index_buffer is None or self._stream_index_buffer[1] != self.get_gl_context_id():
+            self._stream_index_buffer = (self.gen_buffer(), self.get_gl_context_id())
+
+        slots = numpy.asarray(slots, dtype=numpy.uint32)
+        indices = (slots[:, None] * vertices_per_sprite + numpy.array(pattern, dtype=numpy.uint32)).ravel()
+        self.set_buffer_data(self._stream_index_buffer[0], indices, target=GL_ELEMENT_ARRAY_BUFFER,
+                             usage=GL_STREAM_DRAW)
+        self.draw_elements(None, n=len(indices), index_type=GL_UNSIGNED_INT)
         
     def update(self, sprite):
         if sprite is None:
             return
 
-        if sprite.is_parent():
+        if sprite.uid() in self._persistent_roots:
+            self._update_persistent(sprite)
+        elif sprite.is_parent():
             for child_sprite in sprite.all_sprites():
                 self.update(child_sprite)
         else:
-            uid = sprite.uid()
-            cur_tick = globaltimer.tick_count()
+            self._update_leaf(sprite)
 
-            if uid not in self.sprite_info_lookup:
-                self.sprite_info_lookup[uid] = _SpriteInfoBundle(sprite, cur_tick)
-            else:
-                self.sprite_info_lookup[uid].sprite = sprite
-                self.sprite_info_lookup[uid].last_updated_tick = cur_tick
+    def _update_leaf(self, sprite):
+        uid = sprite.uid()
+        cur_tick = globaltimer.tick_count()
 
-            layer = self.layers[sprite.layer_id()]
+        if uid not in self.sprite_info_lookup:
+            self.sprite_info_lookup[uid] = _SpriteInfoBundle(sprite, cur_tick)
+        else:
+            self.sprite_info_lookup[uid].sprite = sprite
+            self.sprite_info_lookup[uid].last_updated_tick = cur_tick
 
-            if layer.accepts_sprite_type(sprite.sprite_type()):
-                layer.update(uid, sprite.last_modified_tick())
-            else:
-                raise ValueError("Incompatible sprite type: {}".format(sprite.sprite_type()))
+        if uid not in self._persistent_ids:
+            if uid in self._prev_gen_ids:
+                del self._prev_gen_ids[uid]
+            self._cur_gen_ids[uid] = None
+
+        layer = self.layers[sprite.layer_id()]
+
+        if layer.accepts_sprite_type(sprite.sprite_type()):
+            layer.update(uid, sprite.last_modified_tick())
+        else:
+            raise ValueError("Incompatible sprite type: {}".format(sprite.sprite_type()))
+
+    def _remove_leaf(self, uid):
+        sprite_info = self.sprite_info_lookup[uid]
+        self.layers[sprite_info.sprite.layer_id()].remove(uid)
+        del self.sprite_info_lookup[uid]
+
+    def add_persistent(self, sprite):
+        """
+            Registers a sprite (or MultiSprite) that stays on screen until remove_persistent is called, without
+            needing to be passed to update every tick. To change it, pass the new version (with the same uid)
+            to update, which also takes care of any children that were added or dropped.
+        """
+        if sprite is None:
+            return
+        if sprite.uid() not in self._persistent_roots:
+            self._persistent_roots[sprite.uid()] = {}
+        self._update_persistent(sprite)
+
+    def remove_persistent(self, sprite):
+        """
+            sprite: a sprite (or uid) that was previously passed to add_persistent.
+        """
+        root_uid = sprite if isinstance(sprite, int) else sprite.uid()
+        if root_uid not in self._persistent_roots:
+            return
+
+        for uid in self._persistent_roots[root_uid]:
+            del self._persistent_ids[uid]
+            if uid in self.sprite_info_lookup:
+                self._remove_leaf(uid)
+        del self._persistent_roots[root_uid]
+
+    def is_persistent(self, sprite):
+        root_uid = sprite if isinstance(sprite, int) else sprite.uid()
+        return root_uid in self._persistent_roots
+
+    def _update_persistent(self, root):
+        root_uid = root.uid()
+        old_ids = self._persistent_roots[root_uid]
+        new_ids = {}
+
+        for spr in _all_leaves(root):
+            uid = spr.uid()
+            new_ids[uid] = None
+            self._persistent_ids[uid] = root_uid
+
+            # it may have been a regular sprite before
+            if uid in self._prev_gen_ids:
+                del self._prev_gen_ids[uid]
+            if uid in self._cur_gen_ids:
+                del self._cur_gen_ids[uid]
+
+            self._update_leaf(spr)
+
+        for uid in old_ids:
+            if uid not in new_ids:
+                del self._persistent_ids[uid]
+                if uid in self.sprite_info_lookup:
+                    self._remove_leaf(uid)
+
+        self._persistent_roots[root_uid] = new_ids
 
     def clear_screen(self):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
+    def clear_depth_buffer(self):
+        glClear(GL_DEPTH_BUFFER_BIT)
+
     def render_layers(self):
         self.clear_screen()
 
-        # clear out sprites that weren't updated this tick
-        cur_tick = globaltimer.tick_count()
-        ids_to_remove = [sprite_id for sprite_id in self.sprite_info_lookup
-                         if self.sprite_info_lookup[sprite_id].last_updated_tick < cur_tick]
-
-        for sprite_id in ids_to_remove:
-            sprite_info = self.sprite_info_lookup[sprite_id]
-            self.layers[sprite_info.sprite.layer_id()].remove(sprite_id)
-            del self.sprite_info_lookup[sprite_id]
+        self._evict_stale_sprites()
 
         for layer in self.ordered_layers:
             if layer.is_dirty():
-                layer.rebuild(self.sprite_info_lookup)
+                self.rebuild_layer(layer)
 
             if layer.get_layer_id() in self.hidden_layers:
                 continue
 
-            glClear(GL_DEPTH_BUFFER_BIT)
+            self.clear_depth_buffer()
             self.render_layer(layer)
 
+        self._finish_render_stats()
+
+    def present(self):
+        """pushes the frame drawn by render_layers to the window."""
+        pygame.display.flip()
+
+    def _evict_stale_sprites(self):
+        """
+            Clears out sprites that weren't updated since the previous frame. Whatever's left in the previous
+            generation is stale, so this only costs as much as the number of sprites being removed.
+        """
+        cur_tick = globaltimer.tick_count()
+        if cur_tick == self._last_eviction_tick:
+            return  # already done this tick (e.g. render_layers was called twice)
+
+        for sprite_id in self._prev_gen_ids:
+            self._remove_leaf(sprite_id)
+
+        self._n_evicted_last_frame = len(self._prev_gen_ids)
+        self._prev_gen_ids = self._cur_gen_ids
+        self._cur_gen_ids = {}
+        self._last_eviction_tick = cur_tick
+
+    def count_evicted_sprites(self):
+        """returns: the number of stale sprites that were removed during the most recent frame."""
+        return self._n_evicted_last_frame
+
+    def rebuild_layer(self, layer):
+        start_time = time.perf_counter()
+        layer.rebuild(self.sprite_info_lookup)
+        frametimers.get_instance().add_layer_time(layer.get_layer_id(), frametimers.REBUILD, start_time)
+
+        self._render_stats_layer_id = layer.get_layer_id()
+        for stat, amount in layer.get_last_rebuild_stats().items():
+            self.count_render_stat(stat, amount)
+        self._render_stats_layer_id = None
+
     def render_layer(self, layer):
+        start_time = time.perf_counter()
+        self._render_stats_layer_id = layer.get_layer_id()
         layer.render(self)
+        self._render_stats_layer_id = None
+        frametimers.get_instance().add_layer_time(layer.get_layer_id(), frametimers.RENDER, start_time)
+
+    def count_render_stat(self, stat, amount=1):
+        """adds to one of the RENDER_STATS for the current frame, under the layer being rebuilt or rendered (if any)."""
+        counter = self._render_stats.get(self._render_stats_layer_id)
+        if counter is None:
+            counter = collections.Counter()
+            self._render_stats[self._render_stats_layer_id] = counter
+        counter[stat] += amount
+
+    def _finish_render_stats(self):
+        """
+            called once a frame has been drawn. Anything counted after this (e.g. texture uploads during the next
+            update) goes towards the next frame.
+        """
+        self._last_render_stats = self._render_stats
+        self._render_stats = {}
 
-    def draw_elements(self, indices, n=None):
-        glDrawElements(GL_TRIANGLES, n if n is not None else len(indices), GL_UNSIGNED_INT, indices)
+    def get_render_stats(self, layer_id=None):
+        """
+            returns: map of stat -> amount (see RENDER_STATS) for the most recent frame, for the given layer or
+                for the whole frame if layer_id is None. Work done outside of layers (like texture uploads) only
+                counts towards the whole frame.
+        """
+        res = {stat: 0 for stat in RENDER_STATS}
+        if layer_id is not None:
+            res.update(self._last_render_stats.get(layer_id, {}))
+        else:
+            for counter in self._last_render_stats.values():
+                for stat in counter:
+                    res[stat] += counter[stat]
+        return res
+
+    def get_layer_render_stats(self):
+        """returns: map of layer_id -> (map of stat -> amount), for each layer, in the most recent frame."""
+        return {layer.get_layer_id(): self.get_render_stats(layer.get_layer_id()) for layer in self.ordered_layers}
+
+    def draw_elements(self, indices, n=None, index_type=GL_UNSIGNED_INT):
+        """
+            indices: array of indices, or None to draw from the bound GL_ELEMENT_ARRAY_BUFFER (in which case n is required).
+            index_type: GL_UNSIGNED_INT or GL_UNSIGNED_SHORT.
+        """
+        if indices is None:
+            glDrawElements(GL_TRIANGLES, n, index_type, ctypes.c_void_p(0))
+        else:
+            n = n if n is not None else len(indices)
+            glDrawElements(GL_TRIANGLES, n, index_type, indices)
+        self.count_render_stat(DRAW_CALLS)
+        self.count_render_stat(INDICES, n)
+
+    def draw_elements_instanced(self, indices, n_instances, n=None, index_type=GL_UNSIGNED_INT):
+        """
+            Draws the same elements n_instances times (see set_instance_model_matrices).
+            indices: array of indices, or None to draw from the bound GL_ELEMENT_ARRAY_BUFFER (in which case n is required).
+        """
+        if indices is None:
+            glDrawElementsInstanced(GL_TRIANGLES, n, index_type, ctypes.c_void_p(0), n_instances)
+        else:
+            n = n if n is not None else len(indices)
+            glDrawElementsInstanced(GL_TRIANGLES, n, index_type, indices, n_instances)
+        self.count_render_stat(DRAW_CALLS)
+        self.count_render_stat(INDICES, n * n_instances)
+
+    def release_buffers(self):
+        """frees the buffer objects held by the engine and its layers. They're recreated if drawing continues."""
+        for layer in self.layers.values():
+            layer.release(self)
+
+        context_id = self.get_gl_context_id()
+        stale_ids = [index_buffer.buffer_id for index_buffer in self._shared_index_buffers.values()
+                     if index_buffer.buffer_id is not None and index_buffer.context_id == context_id]
+        self._shared_index_buffers.clear()
+        if self._stream_index_buffer is not None and self._stream_index_buffer[1] == context_id:
+            stale_ids.append(self._stream_index_buffer[0])
+        self._stream_index_buffer = None
+        self.delete_buffers(stale_ids)
+
+        self.invalidate_mesh()
 
     def cleanup(self):
+        self.release_buffers()
         self.shader.end()
 
     def count_sprites(self):
@@ -437,6 +963,11 @@ class RenderEngine130(RenderEngine):
         self._texture_pos_attrib_loc = None
         self._color_attrib_loc = None
 
+        self._instance_model_attrib_loc = None
+        self._use_instance_model_uniform_loc = None
+        self._instance_buffer = None  # (buffer_id, gl_context_id)
+        self._instancing_supported = None
+
         self._model_matrix = numpy.identity(4, dtype=numpy.float32)
         self._view_matrix = numpy.identity(4, dtype=numpy.float32)
         self._proj_matrix = numpy.identity(4, dtype=numpy.float32)
@@ -454,6 +985,9 @@ class RenderEngine130(RenderEngine):
             uniform mat4 view;
             uniform mat4 proj;
             
+            in mat4 instanceModel;
+            uniform bool useInstanceModel;
+            
             in vec2 vTexCoord;
             out vec2 texCoord;
             
@@ -464,7 +998,8 @@ class RenderEngine130(RenderEngine):
             {
                 texCoord = vTexCoord;
                 color = vColor;
-                gl_Position = proj * view * model * vec4(position.x, position.y, position.z, 1.0);
+                mat4 m = useInstanceModel ? instanceModel : model;
+                gl_Position = proj * view * m * vec4(position.x, position.y, position.z, 1.0);
             }
             ''',
             '''
@@ -489,7 +1024,8 @@ class RenderEngine130(RenderEngine):
                 
                 gl_FragColor.w = tcolor.w;
             }
-            '''
+            ''',
+            attrib_locations={"position": 0}  # some drivers won't draw anything unless attribute 0 is enabled
         )
 
     def _assert_valid_var(self, varname, loc):
@@ -536,20 +1072,32 @@ class RenderEngine130(RenderEngine):
         glVertexAttrib3f(self._color_attrib_loc, 1.0, 1.0, 1.0)
         printOpenGLError()
 
+        if self.supports_instancing():
+            self._instance_model_attrib_loc = glGetAttribLocation(prog_id, "instanceModel")
+            self._assert_valid_var("instanceModel", self._instance_model_attrib_loc)
+
+            self._use_instance_model_uniform_loc = glGetUniformLocation(prog_id, "useInstanceModel")
+            self._assert_valid_var("useInstanceModel", self._use_instance_model_uniform_loc)
+            glUniform1i(self._use_instance_model_uniform_loc, 0)
+            printOpenGLError()
+
     def set_model_matrix(self, mat):
         self._model_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
         glUniformMatrix4fv(self._model_matrix_uniform_loc, 1, GL_TRUE, self._model_matrix)
         printOpenGLError()
+        self.count_render_stat(UNIFORM_UPLOADS)
 
     def set_view_matrix(self, mat):
         self._view_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
         glUniformMatrix4fv(self._view_matrix_uniform_loc, 1, GL_TRUE, self._view_matrix)
         printOpenGLError()
+        self.count_render_stat(UNIFORM_UPLOADS)
 
     def set_proj_matrix(self, mat):
         self._proj_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
         glUniformMatrix4fv(self._proj_matrix_uniform_loc, 1, GL_TRUE, self._proj_matrix)
         printOpenGLError()
+        self.count_render_stat(UNIFORM_UPLOADS)
 
     def resize_internal(self):
         self.set_proj_matrix(numpy.identity(4, dtype=numpy.float32))
@@ -560,25 +1108,13 @@ class RenderEngine130(RenderEngine):
         glViewport(0, 0, vp_width, vp_height)
         printOpenGLError()
 
-    def _calc_optimal_vp_size(self, window_size, px_scale):
-        """
-            finds the smallest dimensions greater than or equal to window_size
-            that are evenly divisible by px_scale.
-        """
-        w, h = window_size
-        if w % px_scale != 0:
-            w += (px_scale - w % px_scale)
-        if h % px_scale != 0:
-            h += (px_scale - h % px_scale)
-        return (w, h)
-
     def on_texture_changed(self):
-        if self.raw_texture_data is not None:
-            tex_w = self.raw_texture_data[1]
-            tex_h = self.raw_texture_data[2]
+        if self._cur_texture_page is not None:
+            tex_w, tex_h = self.get_texture_page_size(self._cur_texture_page)
 
             glUniform2f(self._tex_size_uniform_loc, float(tex_w), float(tex_h))
             printOpenGLError()
+            self.count_render_stat(UNIFORM_UPLOADS)
 
     def set_vertices_enabled(self, val):
         if val:
@@ -586,10 +1122,12 @@ class RenderEngine130(RenderEngine):
         else:
             glDisableVertexAttribArray(self._position_attrib_loc)
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
 
-    def set_vertices(self, data):
-        glVertexAttribPointer(self._position_attrib_loc, 3, GL_FLOAT, GL_FALSE, 0, data)
+    def set_vertices(self, data, stride=0, offset=0):
+        glVertexAttribPointer(self._position_attrib_loc, 3, GL_FLOAT, GL_FALSE, stride, _attrib_data(data, offset))
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
 
     def set_texture_coords_enabled(self, val):
         if val:
@@ -597,10 +1135,12 @@ class RenderEngine130(RenderEngine):
         else:
             glDisableVertexAttribArray(self._texture_pos_attrib_loc)
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
 
-    def set_texture_coords(self, data):
-        glVertexAttribPointer(self._texture_pos_attrib_loc, 2, GL_FLOAT, GL_FALSE, 0, data)
+    def set_texture_coords(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
+        glVertexAttribPointer(self._texture_pos_attrib_loc, 2, gl_type, GL_FALSE, stride, _attrib_data(data, offset))
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
 
     def set_colors_enabled(self, val):
         if val:
@@ -608,15 +1148,18 @@ class RenderEngine130(RenderEngine):
         else:
             glDisableVertexAttribArray(self._color_attrib_loc)
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
 
     def set_depth_test_enabled(self, val):
         if val:
             glEnable(GL_DEPTH_TEST)
         else:
             glDisable(GL_DEPTH_TEST)
+        self.count_render_stat(STATE_CHANGES)
 
     def set_depth_write_enabled(self, val):
         glDepthMask(GL_TRUE if val else GL_FALSE)
+        self.count_render_stat(STATE_CHANGES)
 
     def set_alpha_test_enabled(self, val, thresh=0.0):
         if val:
@@ -625,10 +1168,57 @@ class RenderEngine130(RenderEngine):
         else:
             glAlphaFunc(GL_ALWAYS, 0.0)
             glDisable(GL_ALPHA_TEST)
+        self.count_render_stat(STATE_CHANGES)
 
-    def set_colors(self, data):
-        glVertexAttribPointer(self._color_attrib_loc, 3, GL_FLOAT, GL_FALSE, 0, data)
+    def set_colors(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
+        normalize = GL_FALSE if gl_type == GL_FLOAT else GL_TRUE
+        glVertexAttribPointer(self._color_attrib_loc, 3, gl_type, normalize, stride, _attrib_data(data, offset))
         printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
+
+    def supports_instancing(self):
+        if self._instancing_supported is None:
+            # glVertexAttribDivisor is core in GL 3.3, so it may be missing even though GLSL 130 works
+            self._instancing_supported = bool(glDrawElementsInstanced) and bool(glVertexAttribDivisor)
+            if not self._instancing_supported:
+                print("INFO: instanced rendering isn't supported, falling back to one draw call per 3D sprite")
+        return self._instancing_supported
+
+    def set_instance_model_matrices(self, matrices):
+        loc = self._instance_model_attrib_loc
+        if matrices is None:
+            for i in range(0, 4):
+                glVertexAttribDivisor(loc + i, 0)  # divisors aren't part of the program's state
+                glDisableVertexAttribArray(loc + i)
+            glUniform1i(self._use_instance_model_uniform_loc, 0)
+            printOpenGLError()
+            self.count_render_stat(STATE_CHANGES)
+            self.count_render_stat(UNIFORM_UPLOADS)
+            return
+
+        if self._instance_buffer is None or self._instance_buffer[1] != self.get_gl_context_id():
+            self._instance_buffer = (self.gen_buffer(), self.get_gl_context_id())
+
+        # a mat4 attribute is read as four column vectors, so each matrix is stored transposed
+        data = numpy.ascontiguousarray(numpy.transpose(numpy.array(matrices, dtype=numpy.float32), (0, 2, 1)))
+        self.set_buffer_data(self._instance_buffer[0], data, usage=GL_STREAM_DRAW)
+
+        for i in range(0, 4):
+            glEnableVertexAttribArray(loc + i)
+            glVertexAttribPointer(loc + i, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * i))
+            glVertexAttribDivisor(loc + i, 1)
+        self.bind_buffer(None)
+
+        glUniform1i(self._use_instance_model_uniform_loc, 1)
+        printOpenGLError()
+        self.count_render_stat(STATE_CHANGES)
+        self.count_render_stat(UNIFORM_UPLOADS)
+
+    def release_buffers(self):
+        super().release_buffers()
+        if self._instance_buffer is not None and self._instance_buffer[1] == self.get_gl_context_id():
+            self.delete_buffers([self._instance_buffer[0]])
+        self._instance_buffer = None
 
 
 class RenderEngine120(RenderEngine130):
@@ -636,6 +1226,9 @@ class RenderEngine120(RenderEngine130):
     def get_glsl_version(self):
         return "120"
 
+    def supports_instancing(self):
+        return False
+
     def build_shader(self):
         return Shader(
             '''
@@ -686,6 +1279,31 @@ class RenderEngine120(RenderEngine130):
 import src.engine.sprites as sprites
 
 
+_DEFAULT_TRANSFORM_CACHE_BYTES = 32 * 1024 * 1024
+_MAX_PRESCALED_PAGE_BYTES = 64 * 1024 * 1024  # bigger pages aren't prescaled, their sprites go through the cache instead
+_MAX_DIRTY_RECTS = 16  # past this many, the dirty rects are merged into their bounding rect
+_MAX_DIRTY_AREA_RATIO = 0.5  # if more of the screen than this is dirty, it's cheaper to redraw all of it
+
+
+def _get_rect_from_triangles(tri1, tri2):
+    """
+        returns: the corners of the axis-aligned rectangle that the two triangles make up, or None if they don't.
+                 pygame fills such a rectangle exactly like the two triangles, which isn't true of other shapes.
+    """
+    pts = set(tri1) | set(tri2)
+    if len(pts) != 4 or len(set(tri1) & set(tri2)) != 2:
+        return None
+    xs = sorted(set(p[0] for p in pts))
+    ys = sorted(set(p[1] for p in pts))
+    if len(xs) != 2 or len(ys) != 2:
+        return None
+    # the shared edge has to be a diagonal, otherwise the triangles overlap rather than tile the rectangle
+    shared = list(set(tri1) & set(tri2))
+    if shared[0][0] == shared[1][0] or shared[0][1] == shared[1][1]:
+        return None
+    return [(xs[0], ys[0]), (xs[1], ys[0]), (xs[1], ys[1]), (xs[0], ys[1])]
+
+
 class PurePygameRenderEngine(RenderEngine):
 
     def __init__(self):
@@ -694,11 +1312,41 @@ class PurePygameRenderEngine(RenderEngine):
 
         self.camera_xy = [0, 0]
         self.camera_scale = (1, 1)
-        self.camera_surface = None
+        self.camera_surface = None  # when the display isn't exactly game size * pixel scale, frames go here first
+
+        # sprites that are flipped, rotated, colored, or scaled get transformed on the CPU, so the results are
+        # kept around. (model uid, xflip, rotation, color, dest size, pixel scale) -> Surface, least recent first.
+        self._transform_cache = collections.OrderedDict()
+        self._transform_cache_bytes = 0
+        self._transform_cache_max_bytes = _DEFAULT_TRANSFORM_CACHE_BYTES
+        self._transform_cache_hits = 0
+        self._transform_cache_misses = 0
+
+        # (page, pixel scale) -> the atlas page scaled up by the pixel scale, or None if it'd be too big. Most
+        # sprites are drawn at exactly the pixel scale, so they can be blitted straight from these.
+        self._prescaled_pages = {}
+
+        # sprite id -> (sprite, camera, (source, dest, area, transform key)) from the last time it was drawn (see
+        # _get_image_blit). Sprites are immutable, so if it's the same object under the same camera, it can be
+        # blitted the same way again. Transformed images aren't held here, so the transform cache's limit holds.
+        self._blit_cache = {}
+
+        # dirty-rect mode (see set_dirty_rect_mode)
+        self._dirty_rects_enabled = configs.compat_dirty_rects
+        self._drawn_rects = {}  # sprite id -> pygame.Rect on the display where it was last drawn
+        self._changed_ids = {}  # ids of sprites that were added or modified since the last frame
+        self._dirty_rects = []  # areas of the display that need to be redrawn, e.g. where removed sprites were
+        self._needs_full_redraw = True
+        self._last_frame_state = None
+        self._redraw_rects = None  # while redrawing parts of the display, sprites outside these rects are skipped
+        self._rects_to_present = None  # rects of the display that changed in the last frame, or None for all of it
 
     def is_opengl(self):
         return False
 
+    def uses_data_arrays(self):
+        return False
+
     def get_glsl_version(self): return None
     def build_shader(self): pass
     def setup_shader(self): pass
@@ -709,15 +1357,16 @@ class PurePygameRenderEngine(RenderEngine):
 
     def resize_internal(self): pass
     def set_vertices_enabled(self, val): pass
-    def set_vertices(self, data): pass
+    def set_vertices(self, data, stride=0, offset=0): pass
     def set_texture_coords_enabled(self, val): pass
-    def set_texture_coords(self, data): pass
+    def set_texture_coords(self, data, stride=0, offset=0, gl_type=GL_FLOAT): pass
 
     def set_colors_enabled(self, val): pass
-    def set_colors(self, data): pass
+    def set_colors(self, data, stride=0, offset=0, gl_type=GL_FLOAT): pass
 
     def reset_for_display_mode_change(self, new_surface):
-        self.set_camera_2d(self.camera_xy, self.camera_scale)
+        self._update_camera_surface()
+        self.request_full_redraw()
 
     def on_texture_changed(self): pass
     def cleanup(self): pass
@@ -737,6 +1386,8 @@ class PurePygameRenderEngine(RenderEngine):
     def set_camera_2d(self, xy, scale=(1, 1)):
         self.camera_xy = xy
         self.camera_scale = scale
+
+    def _update_camera_surface(self):
         game_size = self.get_game_size()
         mult = self._get_render_mult()
         camera_surface_size = (int(game_size[0] * mult), int(game_size[1] * mult))
@@ -749,82 +1400,749 @@ class PurePygameRenderEngine(RenderEngine):
             if self.camera_surface is None or self.camera_surface.get_size() != camera_surface_size:
                 self.camera_surface = pygame.Surface(camera_surface_size, pygame.SRCALPHA)
 
-    def set_texture_atlas(self, texture: pygame.Surface):
-        self.cached_texture_atlas = texture.convert_alpha()
+    def get_max_texture_size(self):
+        return None
+
+    def set_texture_atlas_pages(self, pages):
+        self.cached_texture_pages = [page.convert_alpha() for page in pages]
+        self._prescaled_pages.clear()
+        self.clear_transform_cache()
+        self.request_full_redraw()
         self.on_texture_changed()
 
+    def add_texture_page(self, page):
+        self.cached_texture_pages.append(page.convert_alpha())
+        return len(self.cached_texture_pages) - 1
+
+    def update_texture_page_region(self, page, surface, rect):
+        if rect[2] <= 0 or rect[3] <= 0:
+            return
+        # replace the pixels outright, rather than alpha-blending them over the old ones
+        dest = self.cached_texture_pages[page]
+        dest.fill((0, 0, 0, 0), rect)
+        dest.blit(surface, rect[:2], rect, special_flags=pygame.BLEND_RGBA_ADD)
+
+        for key in [key for key in self._prescaled_pages if key[0] == page]:
+            del self._prescaled_pages[key]
+        self._blit_cache.clear()
+        self.request_full_redraw()
+
+    def set_transform_cache_size(self, max_bytes):
+        """sets the most memory that transformed sprite images can take up (see blit_sprite)."""
+        self._transform_cache_max_bytes = max_bytes
+        self._evict_transformed_images()
+
+    def clear_transform_cache(self):
+        self._transform_cache.clear()
+        self._transform_cache_bytes = 0
+        self._blit_cache.clear()
+
+    def get_transform_cache_stats(self):
+        """returns: dict of the transformed image cache's hits, misses, entries, and size (in bytes)."""
+        return {"hits": self._transform_cache_hits,
+                "misses": self._transform_cache_misses,
+                "entries": len(self._transform_cache),
+                "bytes": self._transform_cache_bytes}
+
+    def _evict_transformed_images(self):
+        while self._transform_cache_bytes > self._transform_cache_max_bytes and len(self._transform_cache) > 0:
+            _, surf = self._transform_cache.popitem(last=False)
+            self._transform_cache_bytes -= surf.get_pitch() * surf.get_height()
+
+    def _get_prescaled_page(self, page, px_scale):
+        key = (page, px_scale)
+        if key not in self._prescaled_pages:
+            src = self.cached_texture_pages[page]
+            size = (src.get_width() * px_scale, src.get_height() * px_scale)
+            if size[0] * size[1] * src.get_bytesize() <= _MAX_PRESCALED_PAGE_BYTES:
+                self._prescaled_pages[key] = pygame.transform.scale(src, size)
+            else:
+                self._prescaled_pages[key] = None
+        return self._prescaled_pages[key]
+
+    @staticmethod
+    def _get_transform_key(sprite, dest_size, px_scale):
+        return (sprite.model().uid(), sprite.xflip(), sprite.rotation(), tuple(sprite.color()), dest_size, px_scale)
+
+    def _get_transformed_image(self, sprite, src_atlas, dest_size, px_scale):
+        """returns: the sprite's image, flipped, rotated, colored, and scaled to dest_size."""
+        model = sprite.model()
+        key = self._get_transform_key(sprite, dest_size, px_scale)
+        if key in self._transform_cache:
+            self._transform_cache.move_to_end(key)
+            self._transform_cache_hits += 1
+            return self._transform_cache[key]
+
+        self._transform_cache_misses += 1
+
+        subsurf = src_atlas.subsurface(model.rect())
+        orig_subsurf = subsurf
+        if sprite.xflip():
+            subsurf = pygame.transform.flip(subsurf, True, False)
+
+        if sprite.rotation() == 0:
+            subsurf = subsurf.copy()
+        elif sprite.rotation() == 1:
+            subsurf = pygame.transform.rotate(subsurf, -90)
+        elif sprite.rotation() == 2:
+            subsurf = pygame.transform.rotate(subsurf, -180)
+        else:
+            subsurf = pygame.transform.rotate(subsurf, -270)
+
+        if sprite.color() != (1, 1, 1):
+            if subsurf == orig_subsurf:
+                subsurf = subsurf.copy()
+            color255 = tuple(util.bound(int(c * 256), 0, 255) for c in sprite.color())
+            subsurf.fill(color255, [0, 0, subsurf.get_width(), subsurf.get_height()], pygame.BLEND_MULT)
+
+        xformed = pygame.transform.scale(subsurf, dest_size)
+
+        n_bytes = xformed.get_pitch() * xformed.get_height()
+        if n_bytes <= self._transform_cache_max_bytes:
+            self._transform_cache[key] = xformed
+            self._transform_cache_bytes += n_bytes
+            self._evict_transformed_images()
+
+        return xformed
+
+    def set_texture_page(self, page): pass
+
+    def set_dirty_rect_mode(self, enabled):
+        """
+            In dirty-rect mode, only the parts of the display where sprites were added, changed, or removed get
+            redrawn (and presented) each frame, rather than the whole thing. Good for mostly static scenes, but
+            anything that moves the camera (e.g. layer offsets) still causes a full redraw.
+        """
+        if enabled != self._dirty_rects_enabled:
+            self._dirty_rects_enabled = enabled
+            self._drawn_rects.clear()
+            self._changed_ids.clear()
+            self._dirty_rects = []
+            self.request_full_redraw()
+
+    def is_dirty_rect_mode(self):
+        return self._dirty_rects_enabled
+
+    def request_full_redraw(self):
+        """makes the next frame redraw the whole display, e.g. after something else drew on it."""
+        self._needs_full_redraw = True
+
+    def _update_leaf(self, sprite):
+        if self._dirty_rects_enabled:
+            old_info = self.sprite_info_lookup.get(sprite.uid())
+            if old_info is None or sprite.last_modified_tick() > old_info.sprite.last_modified_tick():
+                self._changed_ids[sprite.uid()] = None
+        super()._update_leaf(sprite)
+
+    def _remove_leaf(self, uid):
+        if uid in self._blit_cache:
+            del self._blit_cache[uid]
+        if self._dirty_rects_enabled:
+            if uid in self._drawn_rects:
+                self._dirty_rects.append(self._drawn_rects.pop(uid))
+            if uid in self._changed_ids:
+                del self._changed_ids[uid]
+        super()._remove_leaf(uid)
+
+    def _get_frame_state(self):
+        """returns: everything besides the sprites themselves that affects where (and whether) things are drawn."""
+        return (pygame.display.get_surface().get_size(),
+                self.get_pixel_scale(),
+                self.get_game_size(),
+                self.clear_color,
+                tuple((layer.get_layer_id(), layer.get_offset(), layer.get_scale(),
+                       layer.get_layer_id() in self.hidden_layers) for layer in self.ordered_layers))
+
+    def _get_rects_to_redraw(self):
+        """
+            returns: the areas of the display that changed since the last frame (merged so that they don't
+                     overlap), or None if it'd be cheaper to redraw everything.
+        """
+        rects = list(self._dirty_rects)
+        for uid in self._changed_ids:
+            if uid in self._drawn_rects:
+                rects.append(self._drawn_rects[uid])  # where it used to be
+            sprite = self.sprite_info_lookup[uid].sprite
+            if sprite.layer_id() not in self.hidden_layers:
+                layer = self.layers[sprite.layer_id()]
+                rects.append(self._get_screen_rect(sprite, layer.get_offset(), [layer.get_scale()] * 2))
+
+        display_rect = pygame.display.get_surface().get_rect()
+        rects = [r.clip(display_rect) for r in rects]
+        rects = [r for r in rects if r.width > 0 and r.height > 0]
+
+        merged = []
+        for r in rects:
+            # anything overlapping gets absorbed, which may make it overlap some of the others
+            idx = r.collidelist(merged)
+            while idx >= 0:
+                r = r.union(merged.pop(idx))
+                idx = r.collidelist(merged)
+            merged.append(r)
+
+        if len(merged) > _MAX_DIRTY_RECTS:
+            merged = [merged[0].unionall(merged[1:])]
+
+        dirty_area = sum(r.width * r.height for r in merged)
+        if dirty_area > _MAX_DIRTY_AREA_RATIO * display_rect.width * display_rect.height:
+            return None
+        return merged
+
+    def render_layers(self):
+        # every layer is drawn onto the same surface, which is only scaled to fit the display once at the end
+        self._update_camera_surface()
+
+        if not self._dirty_rects_enabled:
+            self._rects_to_present = None
+            super().render_layers()
+        else:
+            self._render_dirty_rects()
+
+        if self.camera_surface is not None:
+            display_surf = pygame.display.get_surface()
+            display_surf.blit(pygame.transform.scale(self.camera_surface, display_surf.get_size()), (0, 0))
+
+    def _render_dirty_rects(self):
+        self._evict_stale_sprites()
+
+        for layer in self.ordered_layers:
+            if layer.is_dirty():
+                self.rebuild_layer(layer)
+
+        frame_state = self._get_frame_state()
+        rects = None
+        if (not self._needs_full_redraw
+                and frame_state == self._last_frame_state
+                and self.camera_surface is None):
+            rects = self._get_rects_to_redraw()
+
+        if rects is None:
+            self._drawn_rects.clear()
+            self.clear_screen()
+            for layer in self.ordered_layers:
+                if layer.get_layer_id() not in self.hidden_layers:
+                    self.render_layer(layer)
+        else:
+            # the rects don't overlap, so each layer can be drawn into all of them in one pass (see blit_sprites)
+            surf = pygame.display.get_surface()
+            for rect in rects:
+                surf.fill(self.clear_color, rect)
+            self._redraw_rects = rects
+            for layer in self.ordered_layers:
+                if layer.get_layer_id() not in self.hidden_layers:
+                    self.render_layer(layer)
+            self._redraw_rects = None
+
+        self._rects_to_present = rects
+        self._changed_ids.clear()
+        self._dirty_rects = []
+        self._needs_full_redraw = False
+        self._last_frame_state = frame_state
+
+        self._finish_render_stats()
+
+    def present(self):
+        if self._rects_to_present is None:
+            pygame.display.flip()
+        elif len(self._rects_to_present) > 0:
+            pygame.display.update(self._rects_to_present)
+
     def _get_drawing_surface(self):
         if self.camera_surface is not None:
             return self.camera_surface
         else:
             return pygame.display.get_surface()
 
+    def _get_dest_rect(self, sprite, camera_xy, camera_scale):
+        """returns: the rect [x, y, w, h] that an ImageSprite gets drawn to, in display pixels (not rounded)."""
+        mult = self._get_render_mult()
+        rect = sprite.rect()
+        return [rect[0] * mult * camera_scale[0] - camera_xy[0] * mult,
+                rect[1] * mult * camera_scale[1] - camera_xy[1] * mult,
+                rect[2] * mult * camera_scale[0],
+                rect[3] * mult * camera_scale[1]]
+
+    def _get_screen_rect(self, sprite, camera_xy, camera_scale):
+        """returns: a pygame.Rect that covers every pixel the (leaf) sprite could touch when it's drawn."""
+        if isinstance(sprite, sprites.ImageSprite):
+            x, y, w, h = self._get_dest_rect(sprite, camera_xy, camera_scale)
+        else:
+            mult = self._get_render_mult()
+            x, y, w, h = util.get_rect_containing_points([(p[0] * mult - camera_xy[0] * mult,
+                                                          p[1] * mult - camera_xy[1] * mult)
+                                                         for p in sprite.points()])
+        x1, y1 = math.floor(x), math.floor(y)
+        return pygame.Rect(x1, y1, math.ceil(x + w) - x1 + 1, math.ceil(y + h) - y1 + 1)
+
     def blit_sprite(self, sprite: 'sprites.AbstractSprite'):
         if sprite is None:
             return
         elif isinstance(sprite, sprites.MultiSprite):
-            for spr in sprite.all_sprites():
-                self.blit_sprite(spr)
+            self.blit_sprites(list(sprite.all_sprites()))
         else:
-            mult = self._get_render_mult()
-            offs = (self.camera_xy[0] * mult,
-                    self.camera_xy[1] * mult)
+            self.blit_sprites([sprite])
+
+    def blit_sprites(self, sprite_list):
+        """
+            Draws a list of leaf sprites, in order. Images are handed to pygame in batches (via Surface.blits), and
+            pairs of triangles that make up an axis-aligned rectangle (e.g. from RectangleSprites or horizontal and
+            vertical LineSprites) are filled as a single polygon.
+        """
+        surf = self._get_drawing_surface()
+        if not self._dirty_rects_enabled:
+            self._draw_sprites(surf, sprite_list)
+        elif self._redraw_rects is None:
+            for sprite in sprite_list:
+                self._drawn_rects[sprite.uid()] = self._get_screen_rect(sprite, self.camera_xy, self.camera_scale)
+            self._draw_sprites(surf, sprite_list)
+        else:
+            # each sprite's screen rect is found once, and it's only drawn into the rects it touches. Partial redraws
+            # only happen when nothing but the sprites changed, so unchanged sprites are where they were last drawn.
+            in_rects = [[] for _ in self._redraw_rects]
+            for sprite in sprite_list:
+                uid = sprite.uid()
+                screen_rect = self._drawn_rects.get(uid) if uid not in self._changed_ids else None
+                if screen_rect is None:
+                    screen_rect = self._get_screen_rect(sprite, self.camera_xy, self.camera_scale)
+                rect_idxs = screen_rect.collidelistall(self._redraw_rects)
+                if len(rect_idxs) > 0:
+                    self._drawn_rects[uid] = screen_rect
+                    for idx in rect_idxs:
+                        in_rects[idx].append(sprite)
+
+            for rect, rect_sprites in zip(self._redraw_rects, in_rects):
+                if len(rect_sprites) > 0:
+                    surf.set_clip(rect)
+                    self._draw_sprites(surf, rect_sprites)
+            surf.set_clip(None)
+
+    def _draw_sprites(self, surf, sprite_list):
+        mult = self._get_render_mult()
+        camera = (tuple(self.camera_xy), tuple(self.camera_scale), mult)
+        blits = []  # (source, dest, area)
+        polygons = []  # (color, points)
 
+        for sprite in sprite_list:
             if isinstance(sprite, sprites.ImageSprite):
-                if sprite.model() is not None:
-                    src_rect_on_atlas = sprite.model().rect()
-                    dest_rect_in_world = sprite.rect()
-
-                    surf = self._get_drawing_surface()
-                    dest_rect = [dest_rect_in_world[0] * mult * self.camera_scale[0] - offs[0],
-                                 dest_rect_in_world[1] * mult * self.camera_scale[1] - offs[1],
-                                 dest_rect_in_world[2] * mult * self.camera_scale[0],
-                                 dest_rect_in_world[3] * mult * self.camera_scale[1]]
-
-                    if (src_rect_on_atlas[2] == dest_rect[2]
-                            and src_rect_on_atlas[3] == dest_rect[3]
-                            and sprite.rotation() == 0
-                            and sprite.xflip() is False
-                            and sprite.color() == (1, 1, 1)):
-                        # already the correct size, just blit it
-                        surf.blit(self.cached_texture_atlas, (dest_rect[0], dest_rect[1]), src_rect_on_atlas)
-                    else:
-                        subsurf = self.cached_texture_atlas.subsurface(src_rect_on_atlas)
-                        orig_subsurf = subsurf
-                        if sprite.xflip():
-                            subsurf = pygame.transform.flip(subsurf, True, False)
-
-                        if sprite.rotation() == 0:
-                            subsurf = subsurf.copy()
-                        elif sprite.rotation() == 1:
-                            subsurf = pygame.transform.rotate(subsurf, -90)
-                        elif sprite.rotation() == 2:
-                            subsurf = pygame.transform.rotate(subsurf, -180)
+                model = sprite.model()
+                if model is not None:
+                    if len(polygons) > 0:
+                        self._draw_polygons(surf, polygons)
+                        polygons = []
+                    cached = self._blit_cache.get(sprite.uid())
+                    if cached is None or cached[0] is not sprite or cached[1] != camera:
+                        cached = (sprite, camera, self._get_image_blit(sprite, model, mult))
+                        self._blit_cache[sprite.uid()] = cached
+                    source, dest_xy, area, xform_key = cached[2]
+                    if source is None:
+                        source = self._transform_cache.get(xform_key)
+                        if source is not None:
+                            self._transform_cache.move_to_end(xform_key)
+                            self._transform_cache_hits += 1
                         else:
-                            subsurf = pygame.transform.rotate(subsurf, -270)
-
-                        if sprite.color() != (1, 1, 1):
-                            if subsurf == orig_subsurf:
-                                subsurf = subsurf.copy()
-                            color255 = tuple(util.bound(int(c * 256), 0, 255) for c in sprite.color())
-                            subsurf.fill(color255, [0, 0, subsurf.get_width(), subsurf.get_height()], pygame.BLEND_MULT)
-
-                        xformed = pygame.transform.scale(subsurf, (int(dest_rect[2]), int(dest_rect[3])))
-                        surf.blit(xformed, (dest_rect[0], dest_rect[1]))
+                            source = self._get_transformed_image(sprite, self.cached_texture_pages[model.page],
+                                                                 xform_key[4], mult)
+                    blits.append((source, dest_xy, area))
             elif isinstance(sprite, sprites.TriangleSprite):
-                surf = self._get_drawing_surface()
-                color255 = list(util.bound(int(c * 256), 0, 255) for c in sprite.color())
-                xformed_pts = [(p[0] * mult - offs[0], p[1] * mult - offs[1]) for p in sprite.points()]
-                pygame.draw.polygon(surf, color255, xformed_pts)
+                if len(blits) > 0:
+                    self._draw_blits(surf, blits)
+                    blits = []
+                self._add_triangle(sprite, polygons)
 
-    def render_layer(self, layer):
-        super().render_layer(layer)
+        if len(blits) > 0:
+            self._draw_blits(surf, blits)
+        if len(polygons) > 0:
+            self._draw_polygons(surf, polygons)
 
-        if self.camera_surface is not None:
-            display_surf = pygame.display.get_surface()
-            temp = pygame.transform.scale(self.camera_surface, display_surf.get_size())
-            display_surf.blit(temp, (0, 0), temp.get_rect(), pygame.BLEND_PREMULTIPLIED)
+    def _get_image_blit(self, sprite, model, mult):
+        """
+            returns: (source, dest, area, transform key) to blit to draw the ImageSprite. If the image needs to be
+                transformed, source is None and it comes from the transform cache (see _get_transformed_image).
+        """
+        src_rect_on_atlas = model.rect()
+        dest_rect = self._get_dest_rect(sprite, self.camera_xy, self.camera_scale)
+        dest_xy = (dest_rect[0], dest_rect[1])
+
+        if sprite.rotation() == 0 and sprite.xflip() is False and sprite.color() == (1, 1, 1):
+            if src_rect_on_atlas[2] == dest_rect[2] and src_rect_on_atlas[3] == dest_rect[3]:
+                # already the correct size, just blit it
+                return (self.cached_texture_pages[model.page], dest_xy, src_rect_on_atlas, None)
+            elif src_rect_on_atlas[2] * mult == dest_rect[2] and src_rect_on_atlas[3] * mult == dest_rect[3]:
+                # the correct size after pixel scaling, so it's already in the prescaled atlas
+                prescaled_page = self._get_prescaled_page(model.page, mult)
+                if prescaled_page is not None:
+                    return (prescaled_page, dest_xy, [v * mult for v in src_rect_on_atlas], None)
+
+        return (None, dest_xy, None, self._get_transform_key(sprite, (int(dest_rect[2]), int(dest_rect[3])), mult))
+
+    def _add_triangle(self, sprite, polygons):
+        """adds a TriangleSprite to the list of polygons to draw, merging it into the previous one if possible."""
+        mult = self._get_render_mult()
+        offs = (self.camera_xy[0] * mult,
+                self.camera_xy[1] * mult)
+        color255 = tuple(util.bound(int(c * 256), 0, 255) for c in sprite.color())
+        xformed_pts = [(p[0] * mult - offs[0], p[1] * mult - offs[1]) for p in sprite.points()]
+
+        if len(polygons) > 0 and polygons[-1][0] == color255 and len(polygons[-1][1]) == 3:
+            rect_pts = _get_rect_from_triangles(polygons[-1][1], xformed_pts)
+            if rect_pts is not None:
+                polygons[-1] = (color255, rect_pts)
+                return
+        polygons.append((color255, xformed_pts))
+
+    def _draw_blits(self, surf, blits):
+        surf.blits(blits, doreturn=False)
+        self.count_render_stat(DRAW_CALLS, len(blits))
+
+    def _draw_polygons(self, surf, polygons):
+        for color255, pts in polygons:
+            pygame.draw.polygon(surf, color255, pts)
+        self.count_render_stat(DRAW_CALLS, len(polygons))
+        self.count_render_stat(VERTICES, sum(len(pts) for _, pts in polygons))
 
     def clear_screen(self):
         self._get_drawing_surface().fill(self.clear_color)
 
+    def clear_depth_buffer(self): pass
+
+
+
+_GL_TYPE_TO_DTYPE = {
+    GL_FLOAT: numpy.float32,
+    GL_UNSIGNED_BYTE: numpy.uint8,
+    GL_UNSIGNED_SHORT: numpy.uint16,
+    GL_UNSIGNED_INT: numpy.uint32,
+}
+
+
+def _as_bytes(data):
+    """returns: a flat uint8 view of an array's data (or a copy, if it isn't contiguous)."""
+    return numpy.ascontiguousarray(data).view(numpy.uint8).reshape(-1)
+
+
+class _VertexAttrib:
+    """where a vertex attribute's data comes from, like a call to glVertexAttribPointer."""
+
+    def __init__(self, data, buffer_id, size, gl_type, stride, offset, normalized):
+        self.data = data  # a client-side array, or None to read from the buffer
+        self.buffer_id = buffer_id
+        self.size = size  # number of components
+        self.gl_type = gl_type
+        self.stride = stride
+        self.offset = offset
+        self.normalized = normalized
+
+
+_SUBPIXEL_STEPS = 256  # vertex positions are rounded to this fraction of a pixel before rasterizing
+_MAX_DEPTH = 2 ** 24 - 1  # depth values are stored as 24-bit ints, so that equal depths compare as equal
+
+
+class HeadlessRenderEngine(RenderEngine):
+    """
+        Renders layers without a display or a GPU, by rasterizing the same vertex data that's sent to OpenGL
+        (see layers.ImageDataArray) into a numpy framebuffer. It follows the shader in RenderEngine130 (including
+        its color-multiply rule), GL's blending, depth and alpha tests, and nearest-neighbor texture sampling, so
+        its frames match the OpenGL engines' (except where a sample lands exactly between two texels, which is
+        up to the driver). Meant for benchmarks and pixel-diff tests, it's much too slow for playing the game.
+        3D layers aren't drawn.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clear_color = (0.0, 0.0, 0.0, 0.0)
+
+        self._framebuffer = numpy.zeros((0, 0, 4), dtype=numpy.uint8)  # rows go bottom to top, like GL's
+        self._depth_buffer = numpy.zeros((0, 0), dtype=numpy.uint32)
+        self._viewport_size = (0, 0)
+
+        self._texture_arrays = []  # one per atlas page, RGBA rows from bottom to top (like GL textures)
+
+        self._buffers = {}  # buffer id -> numpy array of bytes
+        self._next_buffer_id = 1
+        self._bound_buffers = {GL_ARRAY_BUFFER: None, GL_ELEMENT_ARRAY_BUFFER: None}
+
+        self._model_matrix = numpy.identity(4, dtype=numpy.float32)
+        self._view_matrix = numpy.identity(4, dtype=numpy.float32)
+        self._proj_matrix = numpy.identity(4, dtype=numpy.float32)
+
+        self._vertex_attrib = None
+        self._tex_coord_attrib = None
+        self._color_attrib = None
+        self._colors_enabled = False
+
+        self._depth_test = False
+        self._depth_write = True
+        self._alpha_test = False
+        self._alpha_thresh = 0.0
+
+    def is_opengl(self):
+        return False
+
+    def get_glsl_version(self): return None
+    def build_shader(self): pass
+    def setup_shader(self): pass
+    def on_texture_changed(self): pass
+    def present(self): pass
+
+    def cleanup(self):
+        self.release_buffers()  # there's no shader to end
+
+    def init(self, w, h):
+        """
+        params w, h: The dimension of the "window" (not the "game size"!)
+        """
+        self.resize(w, h)
+
+    def reset_for_display_mode_change(self, new_surface):
+        pass
+
+    def resize_internal(self):
+        self._viewport_size = self._calc_optimal_vp_size(self.size, self.get_pixel_scale())
+        self._framebuffer = numpy.zeros((self.size[1], self.size[0], 4), dtype=numpy.uint8)
+        self._depth_buffer = numpy.full((self.size[1], self.size[0]), _MAX_DEPTH, dtype=numpy.uint32)
+
+        self.set_proj_matrix(None)
+        self.set_view_matrix(None)
+        self.set_model_matrix(None)
+
+    def get_framebuffer(self):
+        """returns: a copy of the last rendered frame, as an array of RGBA bytes with shape (height, width, 4)."""
+        return self._framebuffer[::-1].copy()
+
+    def set_clear_color(self, color):
+        r, g, b = color
+        self.clear_color = (r, g, b, 0.0)
+
+    def clear_screen(self):
+        self._framebuffer[:] = numpy.rint(numpy.array(self.clear_color) * 255).astype(numpy.uint8)
+        self.clear_depth_buffer()
+
+    def clear_depth_buffer(self):
+        self._depth_buffer.fill(_MAX_DEPTH)
+
+    def set_model_matrix(self, mat):
+        self._model_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
+        self.count_render_stat(UNIFORM_UPLOADS)
+
+    def set_view_matrix(self, mat):
+        self._view_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
+        self.count_render_stat(UNIFORM_UPLOADS)
+
+    def set_proj_matrix(self, mat):
+        self._proj_matrix = mat if mat is not None else numpy.identity(4, dtype=numpy.float32)
+        self.count_render_stat(UNIFORM_UPLOADS)
+
+    def get_max_texture_size(self):
+        return None
+
+    def _upload_texture_pages(self):
+        self._texture_arrays = []
+        for page in range(0, len(self.cached_texture_pages)):
+            self._texture_arrays.append(None)
+            self._upload_texture_page(page)
+        self._cur_texture_page = 0 if len(self._texture_arrays) > 0 else None
+
+    def _upload_texture_page(self, page):
+        surface = self.cached_texture_pages[page]
+        img_data = pygame.image.tostring(surface, 'RGBA', True)
+        self._texture_arrays[page] = numpy.frombuffer(img_data, dtype=numpy.uint8).reshape(
+            (surface.get_height(), surface.get_width(), 4)).copy()
+        self.count_render_stat(BYTES_UPLOADED, len(img_data))
+
+    def add_texture_page(self, page):
+        self.cached_texture_pages.append(page)
+        self._texture_arrays.append(None)
+        self._upload_texture_page(len(self.cached_texture_pages) - 1)
+        return len(self.cached_texture_pages) - 1
+
+    def update_texture_page_region(self, page, surface, rect):
+        if rect[2] <= 0 or rect[3] <= 0:
+            return
+        self.cached_texture_pages[page] = surface
+        self._upload_texture_page(page)
+
+    def set_texture_page(self, page):
+        if page != self._cur_texture_page and 0 <= page < len(self._texture_arrays):
+            self._cur_texture_page = page
+            self.count_render_stat(STATE_CHANGES)
+
+    def gen_buffer(self):
+        self._next_buffer_id += 1
+        return self._next_buffer_id - 1
+
+    def delete_buffers(self, buffer_ids):
+        for buffer_id in buffer_ids:
+            self._buffers.pop(buffer_id, None)
+
+    def bind_buffer(self, buffer_id, target=GL_ARRAY_BUFFER):
+        self._bound_buffers[target] = buffer_id
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_buffer_data(self, buffer_id, data, target=GL_ARRAY_BUFFER, usage=GL_DYNAMIC_DRAW):
+        self._bound_buffers[target] = buffer_id
+        self._buffers[buffer_id] = _as_bytes(data).copy()
+        self.count_render_stat(STATE_CHANGES)
+        self.count_render_stat(BYTES_UPLOADED, len(self._buffers[buffer_id]))
+
+    def set_buffer_sub_data(self, buffer_id, data, byte_offset, target=GL_ARRAY_BUFFER):
+        self._bound_buffers[target] = buffer_id
+        data_bytes = _as_bytes(data)
+        self._buffers[buffer_id][byte_offset:byte_offset + len(data_bytes)] = data_bytes
+        self.count_render_stat(STATE_CHANGES)
+        self.count_render_stat(BYTES_UPLOADED, len(data_bytes))
+
+    def _make_attrib(self, data, size, gl_type, stride, offset, normalized):
+        self.count_render_stat(STATE_CHANGES)
+        return _VertexAttrib(data, self._bound_buffers[GL_ARRAY_BUFFER] if data is None else None,
+                             size, gl_type, stride, offset, normalized)
+
+    def set_vertices_enabled(self, val):
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_texture_coords_enabled(self, val):
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_vertices(self, data, stride=0, offset=0):
+        self._vertex_attrib = self._make_attrib(data, 3, GL_FLOAT, stride, offset, False)
+
+    def set_texture_coords(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
+        self._tex_coord_attrib = self._make_attrib(data, 2, gl_type, stride, offset, False)
+
+    def set_colors_enabled(self, val):
+        self._colors_enabled = val
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_colors(self, data, stride=0, offset=0, gl_type=GL_FLOAT):
+        self._color_attrib = self._make_attrib(data, 3, gl_type, stride, offset, gl_type != GL_FLOAT)
+
+    def set_depth_test_enabled(self, val):
+        self._depth_test = val
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_depth_write_enabled(self, val):
+        self._depth_write = val
+        self.count_render_stat(STATE_CHANGES)
+
+    def set_alpha_test_enabled(self, val, thresh=0.0):
+        self._alpha_test = val
+        self._alpha_thresh = thresh
+        self.count_render_stat(STATE_CHANGES)
+
+    def _read_attrib(self, attrib, n_vertices):
+        """returns: float array of shape (n_vertices, attrib.size), the attribute's value for each vertex."""
+        dtype = numpy.dtype(_GL_TYPE_TO_DTYPE[attrib.gl_type])
+        if attrib.data is not None:
+            res = numpy.asarray(attrib.data, dtype=dtype).reshape(-1, attrib.size)[:n_vertices]
+        else:
+            buf = self._buffers[attrib.buffer_id]
+            stride = attrib.stride if attrib.stride > 0 else attrib.size * dtype.itemsize
+            rows = buf[:n_vertices * stride].reshape(n_vertices, stride)
+            res = rows[:, attrib.offset:attrib.offset + attrib.size * dtype.itemsize].copy().view(dtype)
+        res = res.astype(numpy.float64)
+        return res / numpy.iinfo(dtype).max if attrib.normalized else res
+
+    def draw_elements(self, indices, n=None, index_type=GL_UNSIGNED_INT):
+        if indices is None:
+            index_bytes = self._buffers[self._bound_buffers[GL_ELEMENT_ARRAY_BUFFER]]
+            indices = index_bytes.view(_GL_TYPE_TO_DTYPE[index_type])[:n]
+        else:
+            indices = numpy.asarray(indices)[:n]
+        self.count_render_stat(DRAW_CALLS)
+        self.count_render_stat(INDICES, len(indices))
+        if len(indices) < 3 or self._cur_texture_page is None:
+            return
+
+        n_vertices = int(indices.max()) + 1
+        positions = self._read_attrib(self._vertex_attrib, n_vertices)
+        tex_coords = self._read_attrib(self._tex_coord_attrib, n_vertices)
+        if self._colors_enabled and self._color_attrib is not None:
+            colors = self._read_attrib(self._color_attrib, n_vertices)
+        else:
+            colors = numpy.ones((n_vertices, 3))
+
+        # vertex "shader", then to window coordinates (with y pointing up, like GL)
+        mat = self._proj_matrix.astype(numpy.float64) @ self._view_matrix @ self._model_matrix
+        clip = numpy.hstack([positions, numpy.ones((n_vertices, 1))]) @ mat.T
+        w = clip[:, 3]
+        vp_w, vp_h = self._viewport_size
+        win = numpy.empty((n_vertices, 3))
+        win[:, 0] = (clip[:, 0] / w + 1) / 2 * vp_w
+        win[:, 1] = (clip[:, 1] / w + 1) / 2 * vp_h
+        win[:, 2] = (clip[:, 2] / w + 1) / 2
+        win[:, 0:2] = numpy.round(win[:, 0:2] * _SUBPIXEL_STEPS) / _SUBPIXEL_STEPS  # snapped, like GPUs do
+
+        texture = self._texture_arrays[self._cur_texture_page]
+        for tri in indices[:len(indices) - len(indices) % 3].reshape(-1, 3):
+            self._draw_triangle(win[tri], w[tri], tex_coords[tri], colors[tri], texture)
+
+    def _draw_triangle(self, pts, w, tex_coords, colors, texture):
+        area = (pts[1, 0] - pts[0, 0]) * (pts[2, 1] - pts[0, 1]) - (pts[2, 0] - pts[0, 0]) * (pts[1, 1] - pts[0, 1])
+        if area == 0 or not numpy.isfinite(area):
+            return
+        elif area < 0:
+            # make it counter-clockwise, so the inside is to the left of every edge
+            order = [0, 2, 1]
+            pts, w, tex_coords, colors = pts[order], w[order], tex_coords[order], colors[order]
+            area = -area
+
+        fb_h, fb_w = self._depth_buffer.shape
+        x1 = max(0, int(math.floor(pts[:, 0].min())))
+        x2 = min(fb_w, int(math.ceil(pts[:, 0].max())))
+        y1 = max(0, int(math.floor(pts[:, 1].min())))
+        y2 = min(fb_h, int(math.ceil(pts[:, 1].max())))
+        if x1 >= x2 or y1 >= y2:
+            return
+
+        # pixels are covered if their centers are inside. Centers exactly on an edge go to the triangle that the
+        # edge is a top or left edge of, so that triangles sharing an edge never draw the same pixel twice.
+        px = numpy.arange(x1, x2) + 0.5
+        py = (numpy.arange(y1, y2) + 0.5)[:, None]
+        inside = numpy.ones((y2 - y1, x2 - x1), dtype=bool)
+        weights = []
+        for i in range(0, 3):
+            a, b = pts[(i + 1) % 3], pts[(i + 2) % 3]
+            edge = (b[0] - a[0]) * (py - a[1]) - (b[1] - a[1]) * (px - a[0])
+            is_top_left = (a[1] == b[1] and b[0] < a[0]) or b[1] < a[1]
+            inside &= (edge >= 0) if is_top_left else (edge > 0)
+            weights.append(edge)
+
+        ys, xs = numpy.nonzero(inside)
+        if len(ys) == 0:
+            return
+        bary = numpy.stack([weight[ys, xs] for weight in weights], axis=1) / area
+        ys = ys + y1
+        xs = xs + x1
+
+        # depth is interpolated in window space, everything else is perspective-correct
+        depth = numpy.rint(numpy.clip(bary @ pts[:, 2], 0, 1) * _MAX_DEPTH).astype(numpy.uint32)
+        persp = bary / w
+        persp /= persp.sum(axis=1)[:, None]
+        uv = persp @ tex_coords
+        color = persp @ colors
+
+        # fragment "shader"
+        tex_h, tex_w = texture.shape[0], texture.shape[1]
+        texel = texture[numpy.floor(uv[:, 1]).astype(int) % tex_h,
+                        numpy.floor(uv[:, 0]).astype(int) % tex_w] / 255
+        rgb = numpy.where(texel[:, 0:3] >= 0.99, texel[:, 0:3] * color, texel[:, 0:3] * color * color)
+        alpha = texel[:, 3]
+
+        passed = numpy.ones(len(ys), dtype=bool)
+        if self._alpha_test:
+            passed &= alpha > self._alpha_thresh
+        if self._depth_test:
+            passed &= depth < self._depth_buffer[ys, xs]
+        if not passed.all():
+            ys, xs, depth, rgb, alpha = ys[passed], xs[passed], depth[passed], rgb[passed], alpha[passed]
+
+        if self._depth_test and self._depth_write:
+            self._depth_buffer[ys, xs] = depth
+
+        # blending with (GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA), for all four channels
+        src = numpy.hstack([rgb, alpha[:, None]])
+        dest = self._framebuffer[ys, xs] / 255
+        blended = src * alpha[:, None] + dest * (1 - alpha[:, None])
+        self._framebuffer[ys, xs] = numpy.clip(numpy.rint(blended * 255), 0, 255).astype(numpy.uint8)
+
+    def draw_elements_instanced(self, indices, n_instances, n=None, index_type=GL_UNSIGNED_INT):
+        raise ValueError("draw_elements_instanced() not supported in HeadlessRenderEngine.")
@@ -3,6 +3,7 @@ import src.engine.globaltimer as globaltimer
 
 import math
 import typing
+import numpy
 
 import src.utils.util as util
 
@@ -62,6 +63,22 @@ class AbstractSprite:
         return "{}({}, {}, {})".format(type(self).__name__, self.sprite_type(), self.layer_id(), self.uid())
 
 
+_WARNED_ABOUT_COLOR_RANGE = False
+
+
+def _to_rgb255(rgb):
+    """
+        converts an array of float colors to bytes. Layers store colors as 8 bits per channel, so components are
+        clamped to [0, 1] (like in compatibility mode). A warning is printed the first time a color is out of range.
+    """
+    global _WARNED_ABOUT_COLOR_RANGE
+    if not _WARNED_ABOUT_COLOR_RANGE and len(rgb) > 0 and (rgb.min() < 0 or rgb.max() > 1):
+        bad_idx = numpy.argmax(numpy.any((rgb < 0) | (rgb > 1), axis=1))
+        print("WARN: sprite colors are clamped to [0, 1], got: {}".format(tuple(rgb[bad_idx])))
+        _WARNED_ABOUT_COLOR_RANGE = True
+    return numpy.clip(rgb * 255 + 0.5, 0, 255).astype(numpy.uint8)
+
+
 class TriangleSprite(AbstractSprite):
 
     def __init__(self, layer_id, p1=(0, 0), p2=(0, 0), p3=(0, 0), color=(1, 1, 1), depth=1, uid=None):
@@ -114,39 +131,40 @@ class TriangleSprite(AbstractSprite):
         else:
             return TriangleSprite(self.layer_id(), color=color, depth=depth, p1=p1, p2=p2, p3=p3, uid=self.uid())
 
-    def add_urself(self, i, vertices, texts, colors, indices):
-        p1 = self.p1()
-        p2 = self.p2()
-        p3 = self.p3()
+    def _get_array_info(self):
+        p1, p2, p3 = self._p1, self._p2, self._p3
+        rgb = self._color
+        return (p1[0], p1[1], p2[0], p2[1], p3[0], p3[1], self._depth / 1000, rgb[0], rgb[1], rgb[2])
 
-        z = self.depth() / 1000
-
-        vertices[i * 9 + 0] = p1[0]
-        vertices[i * 9 + 1] = p1[1]
-        vertices[i * 9 + 2] = z
+    @staticmethod
+    def add_all_urselves(sprite_list, start_i, vertices, texts, colors, pages=None):
+        """
+            Writes many sprites at once, starting at index start_i. The arrays have one row per sprite (see
+            layers.ImageDataArray), and they're filled with a handful of numpy operations. Indices
+            aren't written, because they're shared (see RenderEngine.bind_shared_indices).
+            pages: if not None, each sprite's atlas page is written here (one entry per sprite).
+        """
+        n = len(sprite_list)
+        if n == 0:
+            return
 
-        vertices[i * 9 + 3] = p2[0]
-        vertices[i * 9 + 4] = p2[1]
-        vertices[i * 9 + 5] = z
+        info = numpy.array([spr._get_array_info() for spr in sprite_list], dtype=float)
+        end_i = start_i + n
 
-        vertices[i * 9 + 6] = p3[0]
-        vertices[i * 9 + 7] = p3[1]
-        vertices[i * 9 + 8] = z
+        verts = vertices[start_i:end_i]
+        verts[:, :, 0:2] = info[:, 0:6].reshape(n, 3, 2)
+        verts[:, :, 2] = info[:, 6:7]
 
         if colors is not None:
-            rgb = self.color()
-            for j in range(0, 9):
-                colors[i * 9 + j] = rgb[j % 3]
+            colors[start_i:end_i, :, 0:3] = _to_rgb255(info[:, 7:10])[:, None, :]
+            colors[start_i:end_i, :, 3] = 255
 
-        model = self._model
+        # all triangles share the same model (the white square)
+        model = sprite_list[0]._model
         if model is not None:
-            for j in range(0, 3):
-                texts[i * 6 + j * 2] = (model.tx1 + model.tx2) // 2
-                texts[i * 6 + j * 2 + 1] = (model.ty1 + model.ty2) // 2
-
-        indices[3 * i + 0] = 3 * i
-        indices[3 * i + 1] = 3 * i + 1
-        indices[3 * i + 2] = 3 * i + 2
+            texts[start_i:end_i] = ((model.tx1 + model.tx2) // 2, (model.ty1 + model.ty2) // 2)
+            if pages is not None:
+                pages[start_i:end_i] = model.page
 
     def __repr__(self):
         return "TriangleSprite({}, {}, {}, {}, {})".format(
@@ -274,86 +292,79 @@ class ImageSprite(AbstractSprite):
     def raw_size(self):
         return self._raw_size
         
-    def add_urself(self, i, vertices, texts, colors, indices):
-        """
-            i: sprite's "index", which determines where in the arrays its data is written.
-        """
-        x = self.x()
-        y = self.y()
-
-        model = self.model()
+    def _get_array_info(self):
+        rgb = self._color
+        model = self._model
         if model is None:
-            w = 0
-            h = 0
+            return (self._x, self._y, 0, 0, self._depth, rgb[0], rgb[1], rgb[2],
+                    0, 0, 0, 0, self._xflip, self._yflip, self._rotation, False, 0)
         else:
-            w = model.w * self.scale() * self.ratio()[0]
-            h = model.h * self.scale() * self.ratio()[1]
-
-            raw_size = self.raw_size()
-            if raw_size[0] >= 0: w = raw_size[0]
-            if raw_size[1] >= 0: h = raw_size[1]
-
-        if self.rotation() == 1 or self._rotation == 3:
-            temp_w = w
-            w = h
-            h = temp_w
+            w = model.w * self._scale * self._ratio[0] if self._raw_size[0] < 0 else self._raw_size[0]
+            h = model.h * self._scale * self._ratio[1] if self._raw_size[1] < 0 else self._raw_size[1]
+            return (self._x, self._y, w, h, self._depth, rgb[0], rgb[1], rgb[2],
+                    model.tx1, model.ty1, model.tx2, model.ty2, self._xflip, self._yflip, self._rotation, True,
+                    model.page)
 
-        # some places are irresponsibly using depths like -5000
-        z = (self.depth() + 5000) / 10000
+    @staticmethod
+    def add_all_urselves(sprite_list, start_i, vertices, texts, colors, pages=None):
+        """
+            Writes many sprites at once, starting at index start_i. The arrays have one row per sprite (see
+            layers.ImageDataArray), and they're filled with a handful of numpy operations. Indices
+            aren't written, because they're shared (see RenderEngine.bind_shared_indices).
+            pages: if not None, each sprite's atlas page is written here (one entry per sprite).
+        """
+        n = len(sprite_list)
+        if n == 0:
+            return
 
-        vertices[i*12 + 0] = x
-        vertices[i*12 + 1] = y
-        vertices[i*12 + 2] = z
+        info = numpy.array([spr._get_array_info() for spr in sprite_list], dtype=float)
+        end_i = start_i + n
 
-        vertices[i*12 + 3] = x
-        vertices[i*12 + 4] = y + h
-        vertices[i*12 + 5] = z
+        x, y, w, h, depth = info[:, 0], info[:, 1], info[:, 2], info[:, 3], info[:, 4]
+        rotation = info[:, 14].astype(int) % 4
 
-        vertices[i*12 + 6] = x + w
-        vertices[i*12 + 7] = y + h
-        vertices[i*12 + 8] = z
+        sideways = rotation % 2 == 1
+        w, h = numpy.where(sideways, h, w), numpy.where(sideways, w, h)
 
-        vertices[i*12 + 9] = x + w
-        vertices[i*12 + 10] = y
-        vertices[i*12 + 11] = z
+        # corners go: top left, bottom left, bottom right, top right
+        verts = vertices[start_i:end_i]
+        verts[:, :, 0] = x[:, None] + w[:, None] * (0, 0, 1, 1)
+        verts[:, :, 1] = y[:, None] + h[:, None] * (0, 1, 1, 0)
+        verts[:, :, 2] = ((depth + 5000) / 10000)[:, None]
 
         if colors is not None:
-            rgb = self.color()
-            for j in range(0, 12):
-                colors[i * 12 + j] = rgb[j % 3]
-
-        if model is not None:
-            corners = [
-                model.tx1, model.ty2,
-                model.tx1, model.ty1,
-                model.tx2, model.ty1,
-                model.tx2, model.ty2
-            ]
-
-            if self.xflip():
-                corners[0] = model.tx2
-                corners[2] = model.tx2
-                corners[4] = model.tx1
-                corners[6] = model.tx1
-
-            if self.yflip():
-                corners[1] = model.ty1
-                corners[3] = model.ty2
-                corners[5] = model.ty2
-                corners[7] = model.ty1
-
-            for _ in range(0, self.rotation()):
-                corners = corners[2:] + corners[:2]
-
-            for j in range(0, 8):
-                texts[i * 8 + j] = corners[j]
-
-        indices[6 * i + 0] = 4 * i
-        indices[6 * i + 1] = 4 * i + 1
-        indices[6 * i + 2] = 4 * i + 2
-        indices[6 * i + 3] = 4 * i
-        indices[6 * i + 4] = 4 * i + 2
-        indices[6 * i + 5] = 4 * i + 3
+            colors[start_i:end_i, :, 0:3] = _to_rgb255(info[:, 5:8])[:, None, :]
+            colors[start_i:end_i, :, 3] = 255
+
+        if pages is not None:
+            pages[start_i:end_i] = info[:, 16]
+
+        has_model = info[:, 15] != 0
+        if has_model.any():
+            tx1, ty1, tx2, ty2 = info[:, 8], info[:, 9], info[:, 10], info[:, 11]
+            xflip = info[:, 12] != 0
+            yflip = info[:, 13] != 0
+
+            left = numpy.where(xflip, tx2, tx1)
+            right = numpy.where(xflip, tx1, tx2)
+            top = numpy.where(yflip, ty1, ty2)
+            bottom = numpy.where(yflip, ty2, ty1)
+
+            corners = numpy.empty((n, 4, 2), dtype=float)
+            corners[:, 0, 0] = left
+            corners[:, 0, 1] = top
+            corners[:, 1, 0] = left
+            corners[:, 1, 1] = bottom
+            corners[:, 2, 0] = right
+            corners[:, 2, 1] = bottom
+            corners[:, 3, 0] = right
+            corners[:, 3, 1] = top
+
+            # each clockwise rotation shifts the texture coords over by one corner
+            corner_order = (numpy.arange(4)[None, :] + rotation[:, None]) % 4
+            corners = corners[numpy.arange(n)[:, None], corner_order]
+
+            texts[start_i:end_i][has_model] = corners[has_model]
 
     def __repr__(self):
         return "ImageSprite({}, {}, {}, {}, {}, {}, {}, {}, {}. {})".format(
@@ -362,6 +373,8 @@ class ImageSprite(AbstractSprite):
 
 
 _CURRENT_ATLAS_SIZE = None  # XXX this is a mega hack, just look away please
+_CURRENT_ATLAS_PAGE = 0  # same deal, the atlas page that new ImageModels are on
+_NEW_ATLAS_MODELS = None  # while the atlas draws a sheet, the ImageModels it creates (see SpriteAtlas)
 
 
 _IMAGE_MODEL_UID_COUNTER = 0
@@ -375,7 +388,13 @@ def _get_next_model_uid():
 
 class ImageModel:
 
-    def __init__(self, x, y, w, h, offset=(0, 0), translucent=False, texture_size=None):
+    def __init__(self, x, y, w, h, offset=(0, 0), translucent=False, texture_size=None, page=None):
+        """
+            page: which texture of the atlas the model is on (see SpriteAtlas.create_atlas_pages).
+
+            Layers store texture coords as uint16, so they have to be whole numbers in [0, 65535]. That's checked
+            by the SpriteAtlas when it draws the model's sheet.
+        """
         # sheet coords, origin top left corner
         self.x = x + offset[0]
         self.y = y + offset[1]
@@ -394,8 +413,12 @@ class ImageModel:
         self.ty2 = tex_size[1] - self.y
 
         self.translucent = translucent
+        self.page = page if page is not None else _CURRENT_ATLAS_PAGE
 
         self._uid = _get_next_model_uid()
+
+        if _NEW_ATLAS_MODELS is not None:
+            _NEW_ATLAS_MODELS.append(self)
         
     def rect(self):
         return self._rect
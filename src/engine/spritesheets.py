@@ -1,13 +1,25 @@
 import pygame
 import traceback
+import hashlib
+import io
+import os
+import copy
+import struct
 
 import src.engine.sprites as sprites
+import src.engine.renderengine as renderengine
 import src.utils.util as util
+import src.utils.rectpacking as rectpacking
 import src.utils.artutils as artutils
 
 
 _SINGLETON = None
 
+_ATLAS_CACHE_VERSION = 3  # bump this when the cache's format (or the built-in sheets' layouts) change
+_IMAGE_STATS_FILENAME = "image_stats.json"  # in the cache dir, see _get_image_digest
+
+_MIN_RUNTIME_PAGE_SIZE = 512  # smallest page that's created when a sheet added at runtime doesn't fit anywhere
+
 
 def create_instance() -> 'SpriteAtlas':
     global _SINGLETON
@@ -50,9 +62,100 @@ class SpriteSheet:
         return img_size
 
     def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
+        """
+        draws the sheet onto an atlas page at start_pos, and creates its ImageModels.
+        :param atlas: the page to draw onto. This is None when the atlas is restored from the cache, in which case
+            only the models should be created (see restore_from_cached_layout).
+        :param sheet: the sheet's image, or None if it doesn't have one (or it failed to load).
+        """
         if atlas is not None and sheet is not None:
             atlas.blit(sheet, start_pos)
 
+    def cache_version(self):
+        """
+        returns: anything json-friendly, which is part of the atlas cache's key. The cache can tell when a sheet's
+            image or size changes, but not when its code does, so sheets that draw sprites (or arrange their models)
+            in code should bump this whenever that code changes.
+        """
+        return 0
+
+    def get_cached_layout(self):
+        """
+        returns: json-friendly data that restore_from_cached_layout can use to recreate this sheet's models
+            when the atlas is loaded from the cache (see SpriteAtlas.create_atlas_pages). Only called after
+            draw_to_atlas. The default is None, since most sheets create their models from hardcoded rects.
+        """
+        return None
+
+    def restore_from_cached_layout(self, layout, start_pos=(0, 0)):
+        """
+        recreates the sheet's models without drawing anything. By default, this calls draw_to_atlas with the sheet's
+        image but no atlas, so sheets that draw to the atlas must check that it isn't None first (or override this
+        and get_cached_layout, which also avoids loading the image).
+        """
+        img = None
+        if self.get_filepath() is not None:
+            img = pygame.image.load(util.resource_path(self.get_filepath()))
+        self.draw_to_atlas(None, img, start_pos=start_pos)
+
+
+def _get_image_size(data, filepath):
+    """returns: the (w, h) of an image file's contents. PNGs only need their header read."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    return pygame.image.load(io.BytesIO(data), filepath).get_size()
+
+
+def _get_image_digest(filepath, image_stats):
+    """
+        returns: (sha1 hex digest, (w, h)) of an image file, or None if it can't be read.
+        image_stats: {filepath: [mtime_ns, file size, sha1 hex digest, w, h]}, the results of earlier calls. The file
+            is only read if its stat doesn't match its entry, which is then updated.
+    """
+    try:
+        stat = os.stat(filepath)
+        entry = image_stats.get(filepath)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2], (entry[3], entry[4])
+
+        with open(filepath, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        img_size = tuple(_get_image_size(data, filepath))
+    except Exception:
+        image_stats.pop(filepath, None)
+        return None
+
+    image_stats[filepath] = [stat.st_mtime_ns, stat.st_size, digest, img_size[0], img_size[1]]
+    return digest, img_size
+
+
+def _draw_and_check_models(sheet_id, draw_func):
+    """
+        Calls draw_func (which draws or restores a sheet), then checks that the ImageModels it created can be
+        stored in the layers' vertex format, where texture coords are uint16 (see layers.ImageDataArray).
+    """
+    sprites._NEW_ATLAS_MODELS = []
+    try:
+        draw_func()
+        new_models = sprites._NEW_ATLAS_MODELS
+    finally:
+        sprites._NEW_ATLAS_MODELS = None
+
+    for model in new_models:
+        coords = (model.tx1, model.ty1, model.tx2, model.ty2)
+        if any(coord != int(coord) or not 0 <= coord <= 0xFFFF for coord in coords):
+            raise ValueError("sprite sheet {} has a model whose texture coords aren't whole numbers in [0, {}]: "
+                             "{} (at {})".format(sheet_id, 0xFFFF, coords, model.rect()))
+
+
+def _model_to_json(model):
+    return None if model is None else [model.x, model.y, model.w, model.h, model.is_translucent()]
+
+
+def _model_from_json(blob):
+    return None if blob is None else sprites.ImageModel(blob[0], blob[1], blob[2], blob[3], translucent=blob[4])
+
 
 class FontCharacterSpriteLookup:
 
@@ -82,6 +185,15 @@ class FontSheet(SpriteSheet, FontCharacterSpriteLookup):
         """returns: whether the font is monospaced"""
         return len(self.char_sizes) <= 1
 
+    def get_cached_layout(self):
+        return {c: _model_to_json(self._sprite_lookup[c]) for c in self._sprite_lookup}
+
+    def restore_from_cached_layout(self, layout, start_pos=(0, 0)):
+        self._sprite_lookup.clear()
+        self.char_sizes.clear()
+        for c in layout:
+            self.set_char(c, _model_from_json(layout[c]))
+
     def get_char(self, c):
         """returns: an ImageSprite for the character c, or None if one isn't defined."""
         if c in self._swap_chars:
@@ -208,7 +320,8 @@ class WhiteSquare(SpriteSheet):
                     WhiteSquare._SIZE[0],
                     WhiteSquare._SIZE[1]]
             alpha = int(255 * (1 - i / (WhiteSquare._OPACITY_LEVELS - 1)))
-            pygame.draw.rect(atlas, (255, 255, 255, alpha), rect)
+            if atlas is not None:
+                pygame.draw.rect(atlas, (255, 255, 255, alpha), rect)
             self.white_boxes.append(sprites.ImageModel(rect[0], rect[1], rect[2], rect[3],
                                                        translucent=0 < alpha < 255))
 
@@ -236,6 +349,12 @@ class SingleImageSheet(SpriteSheet):
         self._img = sprites.ImageModel(0, 0, sheet.get_width(), sheet.get_height(),
                                        offset=start_pos, translucent=self._translucent)
 
+    def get_cached_layout(self):
+        return _model_to_json(self._img)
+
+    def restore_from_cached_layout(self, layout, start_pos=(0, 0)):
+        self._img = _model_from_json(layout)
+
 
 def get_default_font(mono=False, small=False) -> FontSheet:
     if small:
@@ -259,6 +378,14 @@ class SpriteAtlas:
 
     def __init__(self):
         self._sheets = {}  # sheet_id -> SpriteSheet
+        self._packer = rectpacking.SkylinePacker()
+
+        # the current layout, once the atlas has been created
+        self._pages = None  # list of Surfaces
+        self._placements = {}  # sheet_id -> (page, (x, y))
+        self._sheet_sizes = {}  # sheet_id -> (w, h)
+        self._max_page_size = None
+        self._free_spaces = None  # page -> free space for sheets added at runtime (see RectPacker.create_free_space)
 
         # some "built-in" sheets
         self.add_sheet(DefaultFont())
@@ -270,32 +397,272 @@ class SpriteAtlas:
     def add_sheet(self, sheet):
         self._sheets[sheet.get_sheet_id()] = sheet
 
+    def set_packer(self, packer: rectpacking.RectPacker):
+        """sets the packer used to arrange the sheets on the atlas. Only affects atlases created afterwards."""
+        self._packer = packer
+
+    def add_sheet_at_runtime(self, sheet):
+        """
+            Adds a sheet after the atlas has been created, without rebuilding it. The sheet goes in the free space
+            of an existing page if possible, or onto a new page otherwise, and only that area is re-uploaded to
+            the render engine's textures. The sheet's models can be used as soon as this returns.
+            returns: (page, (x, y)), where the sheet was drawn.
+        """
+        s_id = sheet.get_sheet_id()
+        if self._pages is None:
+            raise ValueError("can't add sheet {} at runtime, the atlas hasn't been created yet".format(s_id))
+        if s_id in self._sheets:
+            raise ValueError("there's already a sheet with id: {}".format(s_id))
+
+        img = self._load_sheet_image(sheet)
+        size = sheet.get_size((0, 0) if img is None else img.get_size())
+        if size[0] <= 0 or size[1] <= 0:
+            print("WARN: sprite sheet {} has empty or invalid size: {}".format(s_id, size))
+            page_idx, pos = 0, (0, 0)  # "draw" invalid sheets at (0, 0)
+        else:
+            page_idx, pos = self._find_runtime_space(s_id, size)
+
+        page = self._pages[page_idx]
+        print("INFO: adding {} [{}x{}] to atlas at ({}, {}) on page {}".format(
+            s_id, size[0], size[1], pos[0], pos[1], page_idx))
+
+        # see _build_atlas_pages
+        sprites._CURRENT_ATLAS_PAGE = page_idx
+        sprites._CURRENT_ATLAS_SIZE = page.get_size()
+        _draw_and_check_models(s_id, lambda: sheet.draw_to_atlas(page, img, start_pos=pos))
+        sprites._CURRENT_ATLAS_PAGE = 0
+        sprites._CURRENT_ATLAS_SIZE = self._pages[0].get_size()
+
+        self.add_sheet(sheet)
+        self._placements[s_id] = (page_idx, pos)
+        self._sheet_sizes[s_id] = size
+
+        render_eng = renderengine.get_instance()
+        if render_eng is not None:
+            if page_idx >= render_eng.get_num_texture_pages():
+                render_eng.add_texture_page(page)
+            else:
+                rect = (pos[0], pos[1], min(size[0], page.get_width() - pos[0]), min(size[1], page.get_height() - pos[1]))
+                render_eng.update_texture_page_region(page_idx, page, rect)
+
+        return page_idx, pos
+
+    def _find_runtime_space(self, s_id, size):
+        """returns: (page, (x, y)), the spot for a sheet being added at runtime. Creates a new page if necessary."""
+        pad = self._packer.padding
+        if self._free_spaces is None:
+            self._free_spaces = []
+            for page_idx, page in enumerate(self._pages):
+                used = [(pos[0], pos[1], self._sheet_sizes[used_id][0], self._sheet_sizes[used_id][1])
+                        for used_id, (used_page, pos) in self._placements.items()
+                        if used_page == page_idx and used_id in self._sheet_sizes]
+                self._free_spaces.append(self._packer.create_free_space(page.get_size(), used))
+
+        for page_idx, free_space in enumerate(self._free_spaces):
+            pos = free_space.insert(size[0] + pad, size[1] + pad)
+            if pos is not None:
+                return page_idx, pos
+
+        # no room, so the atlas grows by a page
+        page_size = [max(_MIN_RUNTIME_PAGE_SIZE, util.next_power_of_2(dim + pad)) for dim in size]
+        if self._max_page_size is not None:
+            if size[0] + pad > self._max_page_size or size[1] + pad > self._max_page_size:
+                raise ValueError("sheet {} is larger than the max page size {}: {}".format(
+                    s_id, self._max_page_size, size))
+            page_size = [min(dim, self._max_page_size) for dim in page_size]
+
+        page = pygame.Surface(page_size, pygame.SRCALPHA, 32)
+        page.fill((255, 255, 255, 0))
+        self._pages.append(page)
+        self._free_spaces.append(self._packer.create_free_space(page.get_size(), []))
+        return len(self._pages) - 1, self._free_spaces[-1].insert(size[0] + pad, size[1] + pad)
+
     def get_sheet(self, sheet_id) -> SpriteSheet:
         if sheet_id in self._sheets:
             return self._sheets[sheet_id]
         else:
             return None
 
-    def create_atlas_surface(self):
+    def create_atlas_surface(self, cache_dir=None):
+        """
+            Packs every sheet onto a single atlas, however big it needs to be. See create_atlas_pages.
+        """
+        return self.create_atlas_pages(cache_dir=cache_dir)[0]
+
+    def create_atlas_pages(self, cache_dir=None, max_page_size=None):
+        """
+            returns: list of Surfaces (always at least one). Sheets that don't fit on the first page spill over
+                onto more, and each ImageModel knows which page it's on (see ImageModel.page).
+            cache_dir: if not None, the finished atlas and the layout of its sheets are saved in this directory,
+                and later calls load them from there instead of rebuilding everything (unless the sheets changed).
+            max_page_size: the largest width and height of a page (e.g. the GPU's max texture size), or None
+                for no limit.
+        """
+        self._max_page_size = max_page_size
+        self._free_spaces = None
+
+        if cache_dir is None:
+            return self._build_atlas_pages(max_page_size)
+
+        cache_key = self._get_cache_key(max_page_size, cache_dir)
+        pages = self._load_from_cache(cache_dir, cache_key)
+        if pages is None:
+            pages = self._build_atlas_pages(max_page_size)
+            self._save_to_cache(cache_dir, cache_key)
+        return pages
+
+    def _get_cache_key(self, max_page_size, cache_dir):
+        """
+            returns: a hash of everything that affects the atlas, i.e. the sheets' ids, classes, images, sizes, and
+                cache versions (see SpriteSheet.cache_version). An image is only read (and hashed) if its
+                modification time or size differ from the last time it was hashed (see _get_image_digest).
+        """
+        stats_path = os.path.join(cache_dir, _IMAGE_STATS_FILENAME)
+        image_stats = {}
+        if os.path.exists(stats_path):
+            try:
+                image_stats = util.load_json_from_path(stats_path)
+            except Exception:
+                print("WARN: failed to load sprite sheet image stats, rehashing the images: {}".format(stats_path))
+                traceback.print_exc()
+        old_image_stats = dict(image_stats)
+
+        h = hashlib.sha1()
+        h.update("atlas_v{}|{}".format(_ATLAS_CACHE_VERSION, max_page_size).encode("utf-8"))
+        for s_id in self._sheets:
+            sheet = self._sheets[s_id]
+            img_size = (0, 0)
+            if sheet.get_filepath() is not None:
+                digest = _get_image_digest(util.resource_path(sheet.get_filepath()), image_stats)
+                if digest is None:
+                    h.update(b"missing")  # same as when the image fails to load (see _load_sheet_image)
+                else:
+                    h.update(digest[0].encode("utf-8"))
+                    img_size = digest[1]
+            h.update("|{}|{}.{}|{}|{}|{}|{}|".format(s_id, type(sheet).__module__, type(sheet).__qualname__,
+                                                     sheet.get_filepath(), sheet.get_draw_order(),
+                                                     tuple(sheet.get_size(img_size)),
+                                                     sheet.cache_version()).encode("utf-8"))
+
+        if image_stats != old_image_stats:
+            try:
+                util.save_json_to_path(image_stats, stats_path, make_pretty=False)
+            except Exception:
+                print("WARN: failed to save sprite sheet image stats: {}".format(stats_path))
+                traceback.print_exc()
+
+        return h.hexdigest()
+
+    def _load_from_cache(self, cache_dir, cache_key):
+        """returns: the cached atlas pages (after restoring every sheet's models), or None if there aren't any."""
+        layout_path = os.path.join(cache_dir, "atlas_{}.json".format(cache_key))
+        if not os.path.exists(layout_path):
+            return None
+
+        try:
+            layout = util.load_json_from_path(layout_path)
+            if layout["key"] != cache_key:
+                return None
+
+            pages = []
+            for page_idx, page_size in enumerate(layout["pages"]):
+                image_path = os.path.join(cache_dir, "atlas_{}_{}.png".format(cache_key, page_idx))
+                if not os.path.exists(image_path):
+                    return None
+                pages.append(pygame.image.load(image_path))
+                if tuple(page_size) != pages[-1].get_size():
+                    return None
+
+            placements = {}
+            sheet_sizes = {}
+            all_sheets = [s_id for s_id in self._sheets]
+            all_sheets.sort(key=lambda s_id: self._sheets[s_id].get_draw_order())
+            for s_id in all_sheets:
+                sheet_layout = layout["sheets"][s_id]
+                placements[s_id] = (sheet_layout["page"], tuple(sheet_layout["pos"]))
+                sheet_sizes[s_id] = tuple(sheet_layout["size"])
+
+                # see _build_atlas_pages
+                sprites._CURRENT_ATLAS_PAGE = sheet_layout["page"]
+                sprites._CURRENT_ATLAS_SIZE = pages[sheet_layout["page"]].get_size()
+
+                try:
+                    _draw_and_check_models(s_id, lambda: self._sheets[s_id].restore_from_cached_layout(
+                        sheet_layout["layout"], start_pos=tuple(sheet_layout["pos"])))
+                except Exception:
+                    print("WARN: sprite sheet {} can't be restored from the atlas cache, it should override "
+                          "get_cached_layout and restore_from_cached_layout".format(s_id))
+                    raise
+
+            sprites._CURRENT_ATLAS_PAGE = 0
+            sprites._CURRENT_ATLAS_SIZE = pages[0].get_size()
+
+            self._pages = pages
+            self._placements = placements
+            self._sheet_sizes = sheet_sizes
+
+            print("INFO: loaded sprite atlas for {} sheets ({} page(s)) from cache: {}".format(
+                len(self._sheets), len(pages), layout_path))
+            return pages
+        except Exception:
+            print("WARN: failed to load sprite atlas from cache, rebuilding it: {}".format(layout_path))
+            traceback.print_exc()
+            return None
+
+    def _save_to_cache(self, cache_dir, cache_key):
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            # only keep the latest atlas around
+            for filename in os.listdir(cache_dir):
+                if filename.startswith("atlas_") and (filename.endswith(".json") or filename.endswith(".png")):
+                    os.remove(os.path.join(cache_dir, filename))
+
+            layout = {
+                "key": cache_key,
+                "pages": [list(page.get_size()) for page in self._pages],
+                "sheets": {s_id: {"page": self._placements[s_id][0],
+                                  "pos": list(self._placements[s_id][1]),
+                                  "size": list(self._sheet_sizes[s_id]),
+                                  "layout": self._sheets[s_id].get_cached_layout()} for s_id in self._sheets}
+            }
+
+            # the images go first, so the json's presence means they were all written
+            for page_idx, page in enumerate(self._pages):
+                pygame.image.save(page, os.path.join(cache_dir, "atlas_{}_{}.png".format(cache_key, page_idx)))
+            util.save_json_to_path(layout, os.path.join(cache_dir, "atlas_{}.json".format(cache_key)), make_pretty=False)
+        except Exception:
+            print("WARN: failed to save sprite atlas to cache: {}".format(cache_dir))
+            traceback.print_exc()
+
+    def _load_sheet_image(self, sheet):
+        """returns: the sheet's image, or None if it doesn't have one (or it failed to load)."""
+        rel_path = sheet.get_filepath()
+        if rel_path is None:
+            return None
+        resource_path = util.resource_path(rel_path)
+        try:
+            return pygame.image.load(resource_path)
+        except Exception:
+            print("ERROR: failed to load sprite sheet {} from path: {}".format(sheet.get_sheet_id(), resource_path))
+            traceback.print_exc()
+            return None
+
+    def _build_atlas_pages(self, max_page_size):
+        """
+            Packs and draws all the sheets, and remembers where they went.
+            returns: the list of pages (as Surfaces).
+        """
         print("INFO: creating sprite atlas for {} sheets: [{}]".format(
             len(self._sheets), ", ".join([s_id for s_id in self._sheets])))
 
         sizes = {}  # sheet_id -> (w, h)
-        all_non_empty_sizes = []
+        non_empty_sizes = {}  # sheet_id -> (w, h)
 
         loaded_images = {}  # sheet_id -> Surface or None
         for s_id in self._sheets:
-            rel_path = self._sheets[s_id].get_filepath()
-            if rel_path is None:
-                loaded_images[s_id] = None
-            else:
-                resource_path = util.resource_path(rel_path)
-                try:
-                    loaded_images[s_id] = pygame.image.load(resource_path)
-                except Exception:
-                    print("ERROR: failed to load sprite sheet {} from path: {}".format(s_id, resource_path))
-                    traceback.print_exc()
-                    loaded_images[s_id] = None
+            loaded_images[s_id] = self._load_sheet_image(self._sheets[s_id])
 
         for s_id in self._sheets:
             img_size = (0, 0)
@@ -305,52 +672,64 @@ class SpriteAtlas:
             s_size = self._sheets[s_id].get_size(img_size)
             sizes[s_id] = s_size
             if s_size[0] > 0 and s_size[1] > 0:
-                all_non_empty_sizes.append(s_size)
+                non_empty_sizes[s_id] = s_size
             else:
                 print("WARN: sprite sheet {} has empty or invalid size: {}".format(s_id, s_size))
 
-        packed_rects, atlas_size = util.pack_rects_into_smallest_rect(all_non_empty_sizes)
-
-        packed_rects_set = set()
-        for r in packed_rects:
-            packed_rects_set.add(tuple(r))
+        packer = copy.copy(self._packer)
+        if max_page_size is not None:
+            if packer.max_size is None:
+                packer.max_size = (max_page_size, max_page_size)
+            else:
+                packer.max_size = (min(packer.max_size[0], max_page_size), min(packer.max_size[1], max_page_size))
+        packed_pages = packer.pack_pages(non_empty_sizes)
 
-        positions = {}  # sheet_id -> (x, y)
+        placements = {}  # sheet_id -> (page, (x, y))
+        for page_idx, (packed_rects, _) in enumerate(packed_pages):
+            for s_id in packed_rects:
+                placements[s_id] = (page_idx, packed_rects[s_id][:2])
         for s_id in self._sheets:
-            my_rect = None
+            if s_id not in placements:
+                placements[s_id] = (0, (0, 0))  # "draw" invalid sheets at (0, 0)
 
-            for r in packed_rects_set:
-                if r[2] == sizes[s_id][0] and r[3] == sizes[s_id][1]:
-                    positions[s_id] = (r[0], r[1])
-                    my_rect = r
-                    break
+        if len(packed_pages) > 1:
+            print("INFO: split sprite atlas into {} pages (max page size: {}): {}".format(
+                len(packed_pages), max_page_size, [page_size for _, page_size in packed_pages]))
 
-            if my_rect is not None:
-                packed_rects_set.remove(my_rect)
-            else:
-                positions[s_id] = (0, 0)  # "draw" invalid sheets at (0, 0)
+        pages = []
+        for _, page_size in packed_pages:
+            page = pygame.Surface(page_size, pygame.SRCALPHA, 32)
+            page.fill((255, 255, 255, 0))
+            pages.append(page)
 
         all_sheets = [s_id for s_id in self._sheets]
         all_sheets.sort(key=lambda s_id: self._sheets[s_id].get_draw_order())
 
-        # XXX this is a big hack that tells all the ImageModels we're about to create what size
-        # their texture is. They need to know because their GL texture coordinates use an "upward"
-        # y-axis (and everything in my code uses the opposite), so they need to flip themselves.
-        sprites._CURRENT_ATLAS_SIZE = atlas_size
-
-        atlas_surface = pygame.Surface(atlas_size, pygame.SRCALPHA, 32)
-        atlas_surface.fill((255, 255, 255, 0))
-
         for s_id in all_sheets:
-            pos = positions[s_id]
+            page_idx, pos = placements[s_id]
             img = loaded_images[s_id]
             size = sizes[s_id]
-            print("INFO:   drawing {} [{}x{}] to ({}, {})".format(s_id, size[0], size[1], pos[0], pos[1]))
-            self._sheets[s_id].draw_to_atlas(atlas_surface, img, start_pos=pos)
 
-        sprites.CURRENT_ATLAS_SIZE = None  # clean it up for good measure ~
+            # XXX this is a big hack that tells all the ImageModels we're about to create what size
+            # their texture is. They need to know because their GL texture coordinates use an "upward"
+            # y-axis (and everything in my code uses the opposite), so they need to flip themselves.
+            # They also need to know which page they're on.
+            sprites._CURRENT_ATLAS_PAGE = page_idx
+            sprites._CURRENT_ATLAS_SIZE = pages[page_idx].get_size()
+
+            print("INFO:   drawing {} [{}x{}] to ({}, {}) on page {}".format(
+                s_id, size[0], size[1], pos[0], pos[1], page_idx))
+            _draw_and_check_models(s_id, lambda: self._sheets[s_id].draw_to_atlas(pages[page_idx], img, start_pos=pos))
+
+        # models created after this are assumed to be on the first page
+        sprites._CURRENT_ATLAS_PAGE = 0
+        sprites._CURRENT_ATLAS_SIZE = pages[0].get_size()
+
+        self._pages = pages
+        self._placements = placements
+        self._sheet_sizes = sizes
 
-        return atlas_surface
+        return pages
 
 
 
@@ -1,8 +1,11 @@
 from OpenGL.GL import *
 
 import numpy
+import os
+import hashlib
 
 import src.engine.layers as layers
+import src.engine.renderengine as renderengine
 import src.engine.sprites as sprites
 import src.utils.util as util
 import src.utils.matutils as matutils
@@ -50,17 +53,14 @@ class ThreeDeeLayer(layers.ImageLayer):
         super().__init__(layer_id, layer_z)
         self.camera = Camera3D()
 
-        self.vertices = numpy.array([], dtype=float)
-        self.tex_coords = numpy.array([], dtype=float)
-        self.indices = numpy.array([], dtype=float)
-
     def set_camera(self, cam):
         self.camera = cam.get_snapshot()
 
     def accepts_sprite_type(self, sprite_type):
         return sprite_type == sprites.SpriteTypes.THREE_DEE
 
-    def populate_data_arrays(self, opaque_ids, translucent_ids, sprite_info_lookup, first_dirty_opaque_idx=0):
+    def populate_data_arrays(self, opaque_ids, translucent_ids, sprite_info_lookup, first_dirty_opaque_idx=0,
+                             trans_span=None):
         pass  # we don't actually use these
 
     def get_sprites_grouped_by_model_id(self, engine):
@@ -81,14 +81,31 @@ class ThreeDeeLayer(layers.ImageLayer):
 
         model_ids_to_sprites = self.get_sprites_grouped_by_model_id(engine)
         for model_id in model_ids_to_sprites:
-            # only pass model data (vertices, tex_coords, indices) once per unique model in the scene
+            # only bind model data (vertices, tex_coords, indices) once per unique model in the scene.
+            # the engine keeps it on the GPU between frames.
             model = model_ids_to_sprites[model_id][0].model()
-            self._pass_attributes_for_model(engine, model)
-
-            # draw each sprite with that model, using the same data, but different uniforms
-            for spr_3d in model_ids_to_sprites[model_id]:
-                self._set_uniforms_for_sprite(engine, spr_3d)
-                glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, self.indices)
+            n_indices = engine.bind_mesh(model)
+            engine.set_texture_page(model.get_texture_page())
+            engine.count_render_stat(renderengine.VERTICES,
+                                     len(model.get_mesh_arrays()[0]) * len(model_ids_to_sprites[model_id]))
+
+            if engine.supports_instancing():
+                # draw every sprite with that model in one call, with a model matrix per instance
+                xforms = [self._get_model_matrix(spr_3d) for spr_3d in model_ids_to_sprites[model_id]]
+                engine.set_instance_model_matrices(xforms)
+                engine.draw_elements_instanced(None, len(xforms), n=n_indices)
+            else:
+                # draw each sprite with that model, using the same data, but different uniforms
+                for spr_3d in model_ids_to_sprites[model_id]:
+                    self._set_uniforms_for_sprite(engine, spr_3d)
+                    engine.draw_elements(None, n=n_indices)
+
+        if engine.supports_instancing():
+            engine.set_instance_model_matrices(None)
+
+        # unbind so that client-side arrays still work
+        engine.bind_buffer(None)
+        engine.bind_buffer(None, target=GL_ELEMENT_ARRAY_BUFFER)
 
         self.set_client_states(False, engine)
 
@@ -134,21 +151,11 @@ class ThreeDeeLayer(layers.ImageLayer):
         proj = self.get_proj_matrix(engine)
         engine.set_proj_matrix(proj)
 
-    def _set_uniforms_for_sprite(self, engine, spr_3d: 'Sprite3D'):
-        model = spr_3d.get_xform(camera_pos=self.camera.get_position())
-        engine.set_model_matrix(model)
-
-    def _pass_attributes_for_model(self, engine, model_3d):
-        self.vertices.resize(3 * len(model_3d.get_vertices()), refcheck=False)
-        self.tex_coords.resize(2 * len(model_3d.get_texture_coords()), refcheck=False)
-        self.indices.resize(len(model_3d.get_indices()), refcheck=False)
+    def _get_model_matrix(self, spr_3d: 'Sprite3D'):
+        return spr_3d.get_xform(camera_pos=self.camera.get_position())
 
-        model_3d.add_urself(self.vertices,
-                            self.tex_coords,
-                            self.indices)
-
-        engine.set_vertices(self.vertices)
-        engine.set_texture_coords(self.tex_coords)
+    def _set_uniforms_for_sprite(self, engine, spr_3d: 'Sprite3D'):
+        engine.set_model_matrix(self._get_model_matrix(spr_3d))
 
 
 class Sprite3D(sprites.AbstractSprite):
@@ -338,14 +345,16 @@ class BillboardSprite3D(Sprite3D):
 
 class ThreeDeeModel:
 
-    def __init__(self, model_id, vertices, normals, native_texture_coords, indices, map_from_texture_to_atlas=lambda xy: xy):
+    def __init__(self, model_id, vertices, normals, native_texture_coords, indices, map_from_texture_to_atlas=lambda xy: xy,
+                 texture_page=0):
         """
         :param model_id: str
-        :param vertices: list of (x, y, z)
-        :param normals: list of (x, y, z)
-        :param native_texture_coords: list of (x, y)
-        :param indices: list of ints, one for each corner of each triangle
+        :param vertices: list of (x, y, z), or an (n, 3) array
+        :param normals: list of (x, y, z), or an (n, 3) array
+        :param native_texture_coords: list of (x, y), or an (n, 2) array
+        :param indices: list of ints (or an array), one for each corner of each triangle
         :param map_from_texture_to_atlas: converts points from native_texture_coords to actual atlas coordinates
+        :param texture_page: the atlas page that the model's texture is on
         """
         self._model_id = model_id
 
@@ -355,7 +364,9 @@ class ThreeDeeModel:
         self._indices = indices
 
         self._map_from_texture_to_atlas = map_from_texture_to_atlas
+        self._texture_page = texture_page
         self._cached_atlas_coords = []  # list of (x, y)
+        self._cached_mesh_arrays = None  # (vertices, tex_coords, indices)
 
     def get_model_id(self):
         return self._model_id
@@ -369,78 +380,52 @@ class ThreeDeeModel:
     def get_normals(self):
         return self._normals
 
+    def get_texture_page(self):
+        return self._texture_page
+
     def get_texture_coords(self):
         if len(self._cached_atlas_coords) == 0:
             self._cached_atlas_coords = [self._map_from_texture_to_atlas(xy) for xy in self._native_texture_coords]
         return self._cached_atlas_coords
 
-    def add_urself(self, vertices, tex_coords, indices):
-        for i in range(0, 3 * len(self.get_vertices())):
-            vertices[i] = self.get_vertices()[i // 3][i % 3]
-        for i in range(0, 2 * len(self.get_texture_coords())):
-            tex_coords[i] = self.get_texture_coords()[i // 2][i % 2]
-        for i in range(0, len(self.get_indices())):
-            indices[i] = self.get_indices()[i]
+    def get_mesh_arrays(self):
+        """
+            returns: (vertices, tex_coords, indices), as float32 arrays of shape (n, 3) and (n, 2), and a uint32
+                array. They're computed once and cached, so don't modify them.
+        """
+        if self._cached_mesh_arrays is None:
+            vertices = numpy.asarray(self.get_vertices(), dtype=numpy.float32).reshape(-1, 3)
+            tex_coords = numpy.asarray(self.get_texture_coords(), dtype=numpy.float32).reshape(-1, 2)
+            indices = numpy.asarray(self.get_indices(), dtype=numpy.uint32)
+            self._cached_mesh_arrays = (vertices, tex_coords, indices)
+        return self._cached_mesh_arrays
 
     @staticmethod
-    def load_from_disk(model_id, model_path, map_from_texture_to_atlas):
+    def load_from_disk(model_id, model_path, map_from_texture_to_atlas, use_cache=True, texture_page=0):
+        """
+            Loads a model from an OBJ file. Corners that share the same vertex, texture coords, and normal are
+            merged, and faces with more than three corners are split into triangles. The model's vertices,
+            normals, texture coords and indices are kept as numpy arrays.
+            use_cache: whether to read (and write) the parsed mesh from a binary file in configs.mesh_cache_dir
+                (if it's set), which is ignored if the OBJ file has been modified since.
+        """
         try:
-            raw_vertices = []
-            raw_normals = []
-            raw_native_texture_coords = []
-            triangle_faces = []
-
             safe_path = util.resource_path(model_path)
-            with open(safe_path) as f:
-                for line in f:
-                    line = line.rstrip()  # remove trailing newlines and whitespace
-                    if line.startswith("v "):
-                        xyz = line[2:].split(" ")
-                        vertex = (float(xyz[0]), float(xyz[1]), float(xyz[2]))
-                        raw_vertices.append(vertex)
-
-                    elif line.startswith("vn "):
-                        xyz = line[3:].split(" ")
-                        normal_vec = (float(xyz[0]), float(xyz[1]), float(xyz[2]))
-                        raw_normals.append(normal_vec)
-
-                    elif line.startswith("vt "):
-                        xy = line[3:].split(" ")
-                        texture_coords = (float(xy[0]), float(xy[1]))
-                        raw_native_texture_coords.append(texture_coords)
-
-                    elif line.startswith("f "):
-                        corners = []
-                        for corner in line[2:].split(" "):
-                            vtn = corner.split("/")  # vertex, texture, normal
-                            vertex_idx = int(vtn[0]) - 1
-                            texture_idx = int(vtn[1]) - 1 if len(vtn) > 1 and len(vtn[1]) > 0 else -1
-                            normal_idx = int(vtn[2]) - 1 if len(vtn) > 2 and len(vtn[2]) > 0 else -1
-                            corners.append((vertex_idx, texture_idx, normal_idx))
-                        triangle_faces.append(tuple(corners))
-
-            vertices = []
-            native_texture_coords = []
-            normals = []
-            indices = []
-
-            for tri in triangle_faces:
-                for c in tri:  # TODO use the normals
-                    v_idx, t_idx, norm_idx = c
-                    vertex_xyz = raw_vertices[v_idx]
-                    texture_xy = raw_native_texture_coords[t_idx] if t_idx >= 0 else None
-                    norm_xyz = raw_normals[norm_idx] if norm_idx >= 0 else None
-                    # TODO can probably condense this a bit (only have one index per unique (vertex, texture, normal))
-                    # TODO would that ever matter for most models? probably not?
-                    index = len(indices)
-
-                    vertices.append(vertex_xyz)
-                    native_texture_coords.append(texture_xy)
-                    normals.append(norm_xyz)
-                    indices.append(index)
-            print("INFO: loaded model ({} faces): {}".format(len(triangle_faces), model_path))
+            cache_path = _get_mesh_cache_path(safe_path) if use_cache else None
+            mesh = _load_cached_mesh(safe_path, cache_path) if cache_path is not None else None
+            from_cache = mesh is not None
+            if mesh is None:
+                mesh = _parse_obj_file(safe_path)
+                if cache_path is not None:
+                    _save_cached_mesh(safe_path, cache_path, mesh)
+
+            vertices, normals, native_texture_coords, indices, n_faces = mesh
+            print("INFO: loaded model ({} faces, {} vertices{}): {}".format(
+                n_faces, len(vertices), ", cached" if from_cache else "", model_path))
+
             return ThreeDeeModel(model_id, vertices, normals, native_texture_coords, indices,
-                                 map_from_texture_to_atlas=map_from_texture_to_atlas)
+                                 map_from_texture_to_atlas=map_from_texture_to_atlas,
+                                 texture_page=texture_page)
         except IOError:
             print("ERROR: failed to load model: {}".format(model_path))
             return None
@@ -453,5 +438,195 @@ class ThreeDeeModel:
         normals = [(0, 0, 1)] * 6
         indices = [0, 1, 2, 3, 4, 5]
 
-        return ThreeDeeModel("2d_sprite_" + str(model_2d.uid()), vertices, normals, native_texture_coords, indices)
-
+        return ThreeDeeModel("2d_sprite_" + str(model_2d.uid()), vertices, normals, native_texture_coords, indices,
+                             texture_page=model_2d.page)
+
+
+_MESH_CACHE_VERSION = 2
+
+
+def _parse_floats(lines, n):
+    if len(lines) == 0:
+        return numpy.zeros((0, n), dtype=numpy.float64)
+    values = numpy.array(" ".join(lines).split(), dtype=numpy.float64)  # raises ValueError on malformed numbers
+    if len(values) == n * len(lines):
+        return values.reshape(-1, n)
+    else:
+        # some lines have extra (optional) components
+        return numpy.loadtxt(lines, dtype=numpy.float64, usecols=range(0, n), ndmin=2)
+
+
+def _parse_corner(corner):
+    """returns: the (vertex, texture, normal) indices of an OBJ face corner like "1/2/3" or "1//3", as written
+        in the file (i.e. starting from 1, or negative to count back from the end). 0 = missing."""
+    vtn = corner.split("/")
+    vertex_idx = int(vtn[0])
+    texture_idx = int(vtn[1]) if len(vtn) > 1 and len(vtn[1]) > 0 else 0
+    normal_idx = int(vtn[2]) if len(vtn) > 2 and len(vtn[2]) > 0 else 0
+    return (vertex_idx, texture_idx, normal_idx)
+
+
+def _parse_faces(face_lines):
+    """returns: (corners, counts), where corners is an (n, 3) array of every face's (vertex, texture, normal)
+        indices as written in the file (see _parse_corner), and counts is the number of corners in each face."""
+    face_text = " ".join(face_lines)
+    corner_strs = face_text.split()
+    n_slashes = face_text.count("/")
+
+    if len(corner_strs) == 3 * len(face_lines):
+        counts = numpy.full(len(face_lines), 3, dtype=numpy.int64)  # every face must be a triangle
+    else:
+        counts = numpy.array([len(line.split()) for line in face_lines], dtype=numpy.int64)
+
+    if "//" not in face_text and n_slashes in (0, 2 * len(corner_strs)):
+        # every corner is either "v" or "v/t/n", so they can all be parsed at once
+        n_values = 1 if n_slashes == 0 else 3
+        values = numpy.array(face_text.replace("/", " ").split(), dtype=numpy.int64)  # raises on malformed numbers
+        corners = numpy.zeros((len(corner_strs), 3), dtype=numpy.int64)
+        corners[:, 0:n_values] = values.reshape(-1, n_values)
+    else:
+        # identical corners are spelled identically, so they only need to be parsed once
+        unique_strs, str_to_unique = numpy.unique(numpy.array(corner_strs, dtype=str), return_inverse=True)
+        unique_corners = numpy.array([_parse_corner(c) for c in unique_strs], dtype=numpy.int64).reshape(-1, 3)
+        corners = unique_corners[str_to_unique.reshape(-1)]
+
+    return corners, counts
+
+
+def _count_defined_before_faces(path):
+    """returns: (n_faces, 3) array of how many vertices, texture coords, and normals come before each face."""
+    res = []
+    n_defined = {"v": 0, "vt": 0, "vn": 0}
+    with open(path) as f:
+        for line in f:
+            line_type = line.partition(" ")[0]
+            if line_type == "f":
+                res.append((n_defined["v"], n_defined["vt"], n_defined["vn"]))
+            elif line_type in n_defined:
+                n_defined[line_type] += 1
+    return numpy.array(res, dtype=numpy.int64).reshape(-1, 3)
+
+
+def _resolve_indices(corners, counts, path, n_defined):
+    """
+        Converts the face corners' OBJ indices into indices into the arrays of vertices, texture coords, and
+        normals (with -1 = missing). Negative OBJ indices count back from the last element defined before the face.
+        path: the OBJ file, which is read again to resolve negative indices (only needed if there are any).
+        n_defined: how many vertices, texture coords, and normals there are in total.
+    """
+    res = corners - 1
+    relative = corners < 0
+    if relative.any():
+        n_before_corners = numpy.repeat(_count_defined_before_faces(path), counts, axis=0)
+        res[relative] = (corners + n_before_corners)[relative]
+        if (res[relative] < 0).any():
+            raise ValueError("relative face index points before the start of the file")
+    res[corners == 0] = -1
+    if len(res) > 0 and (res[:, 0] < 0).any():
+        raise ValueError("face index 0 is invalid for a vertex (OBJ indices start from 1)")
+
+    if len(res) > 0 and (res >= numpy.asarray(n_defined)).any():
+        bad_corner = res[numpy.any(res >= n_defined, axis=1)][0] + 1
+        raise ValueError("face index out of range: {}/{}/{}, but there are only {} vertices, {} texture coords, "
+                         "and {} normals".format(*bad_corner, *n_defined))
+    return res
+
+
+def _unique_rows(arr):
+    """returns: (unique_rows, inverse), like numpy.unique(arr, axis=0, return_inverse=True), but faster."""
+    mins = arr.min(axis=0) if len(arr) > 0 else numpy.zeros(arr.shape[1], dtype=numpy.int64)
+    ranges = (arr.max(axis=0) - mins + 1) if len(arr) > 0 else numpy.ones(arr.shape[1], dtype=numpy.int64)
+    if numpy.prod(ranges.astype(numpy.float64)) >= 2 ** 62:
+        unique_rows, inverse = numpy.unique(arr, axis=0, return_inverse=True)
+        return unique_rows, inverse.reshape(-1)
+
+    # pack each row into a single int, which is much quicker to sort
+    keys = numpy.zeros(len(arr), dtype=numpy.int64)
+    for col in range(0, arr.shape[1]):
+        keys = keys * ranges[col] + (arr[:, col] - mins[col])
+    _, first_idxs, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    return arr[first_idxs], inverse.reshape(-1)
+
+
+def _gather(raw_values, idxs, n):
+    res = numpy.zeros((len(idxs), n), dtype=numpy.float64)
+    present = idxs >= 0
+    res[present] = raw_values[idxs[present]]
+    return res
+
+
+def _parse_obj_file(path):
+    """
+        returns: (vertices, normals, texture_coords, indices, n_faces), with one vertex per unique
+            (vertex, texture, normal) corner.
+    """
+    lines_by_type = {"v": [], "vn": [], "vt": [], "f": []}
+    with open(path) as f:
+        for line in f:
+            line_type, _, rest = line.partition(" ")
+            if line_type in lines_by_type:
+                lines_by_type[line_type].append(rest)
+
+    raw_vertices = _parse_floats(lines_by_type["v"], 3)
+    raw_normals = _parse_floats(lines_by_type["vn"], 3)
+    raw_texture_coords = _parse_floats(lines_by_type["vt"], 2)
+    corners, counts = _parse_faces(lines_by_type["f"])
+    n_defined = (len(raw_vertices), len(raw_texture_coords), len(raw_normals))
+    corners = _resolve_indices(corners, counts, path if (corners < 0).any() else None, n_defined)
+
+    # split each face into a fan of triangles, as indices into the list of all corners
+    first_corners = numpy.cumsum(counts) - counts
+    n_triangles = numpy.maximum(counts - 2, 0)
+    tri_face = numpy.repeat(numpy.arange(len(counts)), n_triangles)
+    tri_in_face = numpy.arange(len(tri_face)) - numpy.repeat(numpy.cumsum(n_triangles) - n_triangles, n_triangles)
+    tri_start = first_corners[tri_face]
+    tri_corners = numpy.stack([tri_start, tri_start + tri_in_face + 1, tri_start + tri_in_face + 2], axis=1)
+
+    unique_corners, corner_to_vertex = _unique_rows(corners)
+    indices = corner_to_vertex[tri_corners.reshape(-1)].astype(numpy.uint32)
+
+    vertices = _gather(raw_vertices, unique_corners[:, 0], 3)
+    texture_coords = _gather(raw_texture_coords, unique_corners[:, 1], 2)
+    normals = _gather(raw_normals, unique_corners[:, 2], 3)
+
+    return vertices, normals, texture_coords, indices, len(counts)
+
+
+def _get_mesh_cache_key(path):
+    stat = os.stat(path)
+    return numpy.array([_MESH_CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=numpy.int64)
+
+
+def _get_mesh_cache_path(path):
+    """returns: where the parsed mesh of an OBJ file is cached, or None if configs.mesh_cache_dir isn't set."""
+    if configs.mesh_cache_dir is None:
+        return None
+    path_hash = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(configs.mesh_cache_dir, "mesh_{}_{}.npz".format(os.path.basename(path), path_hash))
+
+
+def _load_cached_mesh(path, cache_path):
+    """returns: the mesh cached for the given OBJ file (see _parse_obj_file), or None if it's missing or stale."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with numpy.load(cache_path) as data:
+            if not numpy.array_equal(data["key"], _get_mesh_cache_key(path)):
+                return None
+            return (data["vertices"], data["normals"], data["texture_coords"], data["indices"], int(data["n_faces"]))
+    except Exception:
+        print("WARN: failed to load cached mesh: {}".format(cache_path))
+        return None
+
+
+def _save_cached_mesh(path, cache_path, mesh):
+    vertices, normals, texture_coords, indices, n_faces = mesh
+    tmp_path = cache_path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            numpy.savez(f, key=_get_mesh_cache_key(path), vertices=vertices, normals=normals,
+                        texture_coords=texture_coords, indices=indices, n_faces=n_faces)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        print("INFO: couldn't write mesh cache (the model will be parsed again next time): {}".format(cache_path))
@@ -1,14 +1,18 @@
+import collections
 import cProfile
+import json
 import pstats
 
 _instance = None
 
+_WAIT_PHASE = "wait"  # see src.engine.frametimers.WAIT
+
 
 def get_instance():
     global _instance
     if _instance is None:
         _instance = Profiler()
-    
+
     return _instance
 
 
@@ -18,7 +22,15 @@ class Profiler:
         self.is_running = False
         self.pr = cProfile.Profile(builtins=False)
 
+        # spike capture mode
+        self.is_capturing_spikes = False
+        self.spike_threshold_ms = 0
+        self.spikes = collections.deque()  # of (frame, pstats.Stats), oldest first
+
     def toggle(self):
+        if self.is_capturing_spikes:
+            self.stop_spike_capture()
+
         self.is_running = not self.is_running
 
         if not self.is_running:
@@ -33,3 +45,178 @@ class Profiler:
             print("INFO\tstarted profiling...")
             self.pr.clear()
             self.pr.enable()
+
+    def start_spike_capture(self, target_frame_ms, threshold=1.5, max_spikes=20):
+        """
+            Keeps the profiler running, but only holds onto its data for frames whose work (i.e. everything but
+            waiting for the next frame) takes longer than threshold * target_frame_ms. The game loop must call
+            end_frame once per frame.
+        """
+        if self.is_running:
+            self.toggle()
+
+        self.is_capturing_spikes = True
+        self.spike_threshold_ms = threshold * target_frame_ms
+        self.spikes = collections.deque(maxlen=max_spikes)
+
+        print("INFO\tcapturing frames longer than {:.1f}ms...".format(self.spike_threshold_ms))
+        self.pr.clear()
+        self.pr.enable()
+
+    def stop_spike_capture(self, n_entries=15):
+        """stops capturing and prints the top entries of each spike that was caught."""
+        self.pr.disable()
+        self.pr.clear()
+        self.is_capturing_spikes = False
+
+        print("INFO\tcaptured {} frame(s) longer than {:.1f}ms".format(len(self.spikes), self.spike_threshold_ms))
+        for frame, stats in self.spikes:
+            print("\nINFO\ttick {}: {:.1f}ms".format(frame["tick"], get_frame_work_duration(frame)))
+            stats.sort_stats('cumulative')
+            stats.print_stats(n_entries)
+
+    def end_frame(self, frame):
+        """
+            Called at the end of each frame while capturing spikes. The profiler's data is kept if the frame
+            was too slow, and cleared either way.
+        :param frame: the frame's timings (see src.engine.frametimers.FrameTimers.get_frames).
+        """
+        if not self.is_capturing_spikes:
+            return
+
+        self.pr.disable()
+        if get_frame_work_duration(frame) > self.spike_threshold_ms:
+            stats = pstats.Stats(self.pr)
+            stats.strip_dirs()
+            self.spikes.append((frame, stats))
+        self.pr.clear()
+        self.pr.enable()
+
+    def get_spike_frames(self):
+        return [frame for frame, _ in self.spikes]
+
+
+def get_frame_duration(frame):
+    """returns: how long a frame took, in milliseconds (from when it began to when its last phase ended)."""
+    return max((offs + dur for offs, dur in frame["phases"].values()), default=0)
+
+
+def get_frame_work_duration(frame):
+    """returns: how long a frame took, in milliseconds, minus the time spent waiting for the next frame (e.g. for
+        vsync or clock.tick), which would otherwise make every idle frame look like a spike."""
+    return get_frame_duration(frame) - frame["phases"].get(_WAIT_PHASE, (0, 0))[1]
+
+
+def _get_spans(frame):
+    """
+        returns: list of (name, start, end, depth) for the frame, its phases, and the layers' rebuilds and renders
+        (in milliseconds since the frame began), ordered so that each span comes before the spans nested in it.
+        A layer's time can be split across a frame (e.g. in dirty-rect mode), in which case it's shown as one span
+        that's cut short if it would overlap the next one.
+    """
+    frame_end = get_frame_duration(frame)
+    res = [("frame", 0, frame_end, 0)]
+
+    for phase, (offs, dur) in frame["phases"].items():
+        if dur <= 0:
+            continue
+        res.append((phase, offs, offs + dur, 1))
+
+        if phase == "render_layers":
+            layer_spans = []
+            for layer_id, layer_phases in frame["layers"].items():
+                for layer_phase, (layer_offs, layer_dur) in layer_phases.items():
+                    layer_spans.append(("{} {}".format(layer_id, layer_phase), layer_offs, layer_offs + layer_dur))
+            layer_spans.sort(key=lambda span: span[1])
+            for i, (name, start, end) in enumerate(layer_spans):
+                limit = offs + dur if i == len(layer_spans) - 1 else layer_spans[i + 1][1]
+                res.append((name, max(start, offs), max(start, min(end, limit)), 2))
+
+    return res
+
+
+def _get_top_entries(stats, n):
+    """returns: the n entries with the most cumulative time, as json-friendly dicts."""
+    entries = []
+    for (filename, line, func_name), (_, n_calls, tot_time, cum_time, _) in stats.stats.items():
+        entries.append({"function": "{} ({}:{})".format(func_name, filename, line), "calls": n_calls,
+                        "tottime_ms": round(1000 * tot_time, 3), "cumtime_ms": round(1000 * cum_time, 3)})
+    entries.sort(key=lambda entry: -entry["cumtime_ms"])
+    return entries[:n]
+
+
+def export_chrome_trace(filepath, frames, spikes=()):
+    """
+        Saves frames as a Chrome trace (viewable in chrome://tracing, Perfetto, or speedscope), with the frames,
+        their phases, and the layers' rebuilds and renders as nested spans.
+    :param frames: list of frame timings (see src.engine.frametimers.FrameTimers.get_frames).
+    :param spikes: list of (frame, pstats.Stats) from spike capture. These frames are included too, and their
+                   most expensive functions are attached to them.
+    """
+    spike_stats = {frame["tick"]: stats for frame, stats in spikes}
+    all_frames = _merge_frames(frames, [frame for frame, _ in spikes])
+
+    events = [{"name": "process_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "game loop"}}]
+    for frame in all_frames:
+        for name, start, end, depth in _get_spans(frame):
+            event = {"name": name, "ph": "X", "pid": 0, "tid": 0,
+                     "ts": round(1000000 * frame["start"] + 1000 * start, 3), "dur": round(1000 * (end - start), 3)}
+            if depth == 0:
+                event["args"] = {"tick": frame["tick"]}
+                if frame["tick"] in spike_stats:
+                    event["args"]["spike"] = True
+                    event["args"]["top_functions"] = _get_top_entries(spike_stats[frame["tick"]], 10)
+            events.append(event)
+
+    with open(filepath, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print("INFO\tsaved a trace of {} frame(s) to {}".format(len(all_frames), filepath))
+
+
+def export_speedscope(filepath, frames, spikes=()):
+    """
+        Saves frames in speedscope's file format (https://www.speedscope.app), as one evented profile with the
+        frames, phases, and layer spans (see export_chrome_trace). Spike frames are named with their tick.
+    """
+    spike_ticks = set(frame["tick"] for frame, _ in spikes)
+    all_frames = _merge_frames(frames, [frame for frame, _ in spikes])
+
+    names = []
+    name_idxs = {}
+    events = []
+    for frame in all_frames:
+        stack = []  # of (name idx, end)
+        for name, start, end, depth in _get_spans(frame):
+            if depth == 0 and frame["tick"] in spike_ticks:
+                name = "spike (tick {})".format(frame["tick"])
+            if name not in name_idxs:
+                name_idxs[name] = len(names)
+                names.append({"name": name})
+            while len(stack) > depth:
+                _add_event(events, "C", *stack.pop())
+            _add_event(events, "O", name_idxs[name], 1000 * frame["start"] + start)
+            stack.append((name_idxs[name], 1000 * frame["start"] + end))
+        while len(stack) > 0:
+            _add_event(events, "C", *stack.pop())
+
+    profile = {"type": "evented", "name": "game loop", "unit": "milliseconds",
+               "startValue": events[0]["at"] if len(events) > 0 else 0,
+               "endValue": events[-1]["at"] if len(events) > 0 else 0, "events": events}
+    with open(filepath, "w") as f:
+        json.dump({"$schema": "https://www.speedscope.app/file-format-schema.json", "shared": {"frames": names},
+                   "profiles": [profile], "name": "frame timings", "exporter": "src.utils.profiling"}, f)
+    print("INFO\tsaved a speedscope profile of {} frame(s) to {}".format(len(all_frames), filepath))
+
+
+def _add_event(events, event_type, name_idx, at):
+    # speedscope needs the events in order, which rounding could break
+    if len(events) > 0:
+        at = max(at, events[-1]["at"])
+    events.append({"type": event_type, "frame": name_idx, "at": at})
+
+
+def _merge_frames(frames, extra_frames):
+    by_tick = {frame["tick"]: frame for frame in extra_frames}
+    for frame in frames:
+        by_tick[frame["tick"]] = frame
+    return sorted(by_tick.values(), key=lambda frame: frame["start"])
@@ -0,0 +1,274 @@
+import math
+
+import src.utils.util as util
+
+
+class RectPacker:
+    """
+        Packs rectangles into a bounding rect, e.g. sprite sheets into a texture atlas.
+    """
+
+    def __init__(self, padding=0, max_size=None):
+        """
+        :param padding: empty space to leave between rects (and after the last ones).
+        :param max_size: (w, h) the largest allowed bounding size, or None for no limit.
+        """
+        self.padding = padding
+        self.max_size = max_size
+
+    def pack(self, sizes):
+        """
+        :param sizes: map of id -> (w, h), where w and h are positive.
+        :return: (
+                    map of id -> rect (x, y, w, h),
+                    (w, h) the size of the bounding rect
+                 )
+        raises ValueError if the rects don't fit within max_size.
+        """
+        raise NotImplementedError()
+
+    def pack_pages(self, sizes):
+        """
+        packs the rects into as many bins ("pages") as it takes for each to fit within max_size.
+        :param sizes: map of id -> (w, h), where w and h are positive.
+        :return: list of (map of id -> rect (x, y, w, h), (w, h) the size of the page's bounding rect). There's
+                 always at least one page, even if it's empty.
+        raises ValueError if a single rect is bigger than max_size.
+        """
+        self._check_sizes(sizes)
+        if self.max_size is not None:
+            for r_id in sizes:
+                if sizes[r_id][0] + self.padding > self.max_size[0] or sizes[r_id][1] + self.padding > self.max_size[1]:
+                    raise ValueError("rect for {} is larger than max size {}: {}".format(r_id, self.max_size, sizes[r_id]))
+
+        # biggest first, so they're spread across the pages
+        remaining = sorted(sizes.keys(), key=lambda r_id: -sizes[r_id][0] * sizes[r_id][1])
+        pages = []
+        while len(pages) == 0 or len(remaining) > 0:
+            # binary search for the most rects that fit on this page
+            lo, hi = 1, len(remaining)
+            best = None
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                try:
+                    best = (mid, self.pack({r_id: sizes[r_id] for r_id in remaining[:mid]}))
+                    lo = mid + 1
+                except ValueError:
+                    hi = mid - 1
+
+            if best is None:
+                best = (0, ({}, (0, 0)))  # only happens when there's nothing to pack
+            pages.append(best[1])
+            remaining = remaining[best[0]:]
+
+        return pages
+
+    def create_free_space(self, size, used_rects):
+        """
+        returns: an object for adding rects to an already-packed bin one at a time. Its insert(w, h) method
+                 returns the (x, y) of the new rect, or None if it doesn't fit. Padding isn't added automatically.
+        :param size: (w, h) the size of the bin.
+        :param used_rects: list of rects (x, y, w, h) that are already taken.
+        """
+        res = _Skyline(size[0], max_height=size[1])
+        for r in used_rects:
+            res.reserve(r[0], r[1], r[2] + self.padding, r[3] + self.padding)
+        return res
+
+    def _check_sizes(self, sizes):
+        for r_id in sizes:
+            s = sizes[r_id]
+            if s[0] <= 0 or s[1] <= 0:
+                raise ValueError("invalid rect size for {}: {}".format(r_id, s))
+
+    def _check_bound(self, bound):
+        if self.max_size is not None and (bound[0] > self.max_size[0] or bound[1] > self.max_size[1]):
+            raise ValueError("rects don't fit within max size {}, they need {}".format(self.max_size, bound))
+
+
+class LegacyPacker(RectPacker):
+    """
+        Wraps util.pack_rects_into_smallest_rect, which finds tight bounds but is about O(n^3).
+    """
+
+    def pack(self, sizes):
+        self._check_sizes(sizes)
+        pad = self.padding
+        packed_rects, bound = util.pack_rects_into_smallest_rect([(s[0] + pad, s[1] + pad) for s in sizes.values()])
+
+        # match the packed rects back to ids by size
+        rects_by_size = {}  # (w, h) -> list of rects
+        for r in packed_rects:
+            size = (r[2] - pad, r[3] - pad)
+            if size not in rects_by_size:
+                rects_by_size[size] = []
+            rects_by_size[size].append(r)
+
+        res = {}
+        for r_id in sizes:
+            r = rects_by_size[tuple(sizes[r_id])].pop()
+            res[r_id] = (r[0], r[1], sizes[r_id][0], sizes[r_id][1])
+
+        self._check_bound(bound)
+        return res, bound
+
+
+class _Skyline:
+    """
+        A bin of fixed width that's filled from the top down. Only the lowest edge of the placed rects (the
+        "skyline") is tracked, so space underneath overhanging rects is lost, but inserting is fast.
+    """
+
+    def __init__(self, width, max_height=None):
+        self.width = width
+        self.max_height = max_height
+        self.segments = [[0, 0, width]]  # list of [x, y, w], ordered by x, covering [0, width)
+        self.height = 0  # the lowest y any rect reaches
+
+    def _fit(self, seg_idx, w, h):
+        """returns: the y that a w x h rect would be placed at if its left edge was on the given segment, or None."""
+        x = self.segments[seg_idx][0]
+        if x + w > self.width:
+            return None
+        y = 0
+        remaining = w
+        i = seg_idx
+        while remaining > 0:
+            y = max(y, self.segments[i][1])
+            remaining -= self.segments[i][2]
+            i += 1
+        if self.max_height is not None and y + h > self.max_height:
+            return None
+        return y
+
+    def find_position(self, w, h):
+        """returns: the (x, y) where a w x h rect would go, or None if it doesn't fit."""
+        best = None
+        best_key = None
+        for i in range(0, len(self.segments)):
+            y = self._fit(i, w, h)
+            if y is not None:
+                key = (y + h, self.segments[i][0])  # bottom-left: lowest bottom edge, then leftmost
+                if best_key is None or key < best_key:
+                    best = (self.segments[i][0], y)
+                    best_key = key
+        return best
+
+    def place(self, x, y, w, h):
+        """adds a rect at a position returned by find_position."""
+        new_segments = []
+        for seg in self.segments:
+            seg_x, seg_y, seg_w = seg
+            if seg_x + seg_w <= x or seg_x >= x + w:
+                new_segments.append(seg)
+            else:
+                if seg_x < x:
+                    new_segments.append([seg_x, seg_y, x - seg_x])
+                if len(new_segments) == 0 or new_segments[-1][0] + new_segments[-1][2] <= x:
+                    new_segments.append([x, y + h, w])
+                if seg_x + seg_w > x + w:
+                    new_segments.append([x + w, seg_y, seg_x + seg_w - (x + w)])
+
+        self.segments = self._merged(new_segments)
+        self.height = max(self.height, y + h)
+
+    @staticmethod
+    def _merged(segments):
+        """merges neighboring segments at the same height."""
+        res = [segments[0]]
+        for seg in segments[1:]:
+            if seg[1] == res[-1][1]:
+                res[-1] = [res[-1][0], res[-1][1], res[-1][2] + seg[2]]
+            else:
+                res.append(seg)
+        return res
+
+    def reserve(self, x, y, w, h):
+        """marks a rect as taken, even if it isn't on the skyline. Any free space underneath it is lost."""
+        x1, x2 = max(0, x), min(self.width, x + w)
+        if x2 <= x1:
+            return
+        new_segments = []
+        for seg in self.segments:
+            seg_x, seg_y, seg_w = seg
+            if seg_x + seg_w <= x1 or seg_x >= x2 or seg_y >= y + h:
+                new_segments.append(seg)
+            else:
+                if seg_x < x1:
+                    new_segments.append([seg_x, seg_y, x1 - seg_x])
+                start, end = max(seg_x, x1), min(seg_x + seg_w, x2)
+                new_segments.append([start, y + h, end - start])
+                if seg_x + seg_w > x2:
+                    new_segments.append([x2, seg_y, seg_x + seg_w - x2])
+        self.segments = self._merged(new_segments)
+        self.height = max(self.height, y + h)
+
+    def insert(self, w, h):
+        """returns: the (x, y) where the rect was placed, or None if it didn't fit."""
+        pos = self.find_position(w, h)
+        if pos is not None:
+            self.place(pos[0], pos[1], w, h)
+        return pos
+
+
+class SkylinePacker(RectPacker):
+    """
+        Packs rects using the skyline bottom-left heuristic, tallest rects first. A few bin widths are tried,
+        and whichever gives the smallest (not too lopsided) bounding area wins. Roughly O(n * k) for k skyline segments, which
+        stays small in practice.
+    """
+
+    def pack(self, sizes):
+        self._check_sizes(sizes)
+        if len(sizes) == 0:
+            return {}, (0, 0)
+
+        pad = self.padding
+        padded = {r_id: (sizes[r_id][0] + pad, sizes[r_id][1] + pad) for r_id in sizes}
+        order = sorted(padded.keys(), key=lambda r_id: (-padded[r_id][1], -padded[r_id][0]))
+
+        best = None  # (score, positions, bound)
+        for width in self._get_candidate_widths(padded):
+            positions = self._pack_with_width(padded, order, width)
+            if positions is None:
+                continue
+            bound = (max(positions[r_id][0] + padded[r_id][0] for r_id in order),
+                     max(positions[r_id][1] + padded[r_id][1] for r_id in order))
+            # prefer the smallest area, but avoid long thin atlases since textures are limited by their longest side
+            score = (max(bound) > 2 * min(bound), bound[0] * bound[1])
+            if best is None or score < best[0]:
+                best = (score, positions, bound)
+
+        if best is None:
+            raise ValueError("rects don't fit within max size {}".format(self.max_size))
+
+        _, positions, bound = best
+        res = {r_id: (positions[r_id][0], positions[r_id][1], sizes[r_id][0], sizes[r_id][1]) for r_id in sizes}
+        return res, bound
+
+    def _get_candidate_widths(self, padded):
+        max_w = max(s[0] for s in padded.values())
+        total_area = sum(s[0] * s[1] for s in padded.values())
+        side = math.ceil(math.sqrt(total_area))
+
+        candidates = {max_w}
+        for i in range(0, 9):
+            candidates.add(max(max_w, side + side * i // 8))
+        w = util.next_power_of_2(max_w)
+        while w <= 4 * side:
+            candidates.add(max(w, max_w))
+            w *= 2
+
+        if self.max_size is not None:
+            candidates = set(min(c, self.max_size[0]) for c in candidates if max_w <= self.max_size[0])
+        return sorted(candidates)
+
+    def _pack_with_width(self, padded, order, width):
+        skyline = _Skyline(width, max_height=None if self.max_size is None else self.max_size[1])
+        positions = {}
+        for r_id in order:
+            pos = skyline.insert(padded[r_id][0], padded[r_id][1])
+            if pos is None:
+                return None
+            positions[r_id] = pos
+        return positions
@@ -1552,8 +1552,8 @@ class SpatialHashMap:
         self._key_to_values = {}  # key -> (rect, value)
 
     def _get_cell_at(self, xy):
-        grid_x = xy[0] // self._cellsize
-        grid_y = xy[1] // self._cellsize
+        grid_x = int(xy[0] // self._cellsize)
+        grid_y = int(xy[1] // self._cellsize)
         return (grid_x, grid_y)
 
     def _all_cells_in_rect(self, rect, include_empty=True):
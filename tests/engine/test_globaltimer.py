@@ -0,0 +1,123 @@
+"""
+    Unit tests for src.engine.globaltimer's frame time stats and frame log.
+"""
+
+import json
+import threading
+
+import pytest
+
+import src.engine.globaltimer as globaltimer
+
+TARGET_DT = 1000 / 60
+
+
+@pytest.fixture(autouse=True)
+def _fresh_frame_history():
+    globaltimer.set_frame_history_length(600)
+    yield
+    globaltimer.stop_frame_log()
+    globaltimer.set_frame_history_length(600)
+
+
+def test_percentiles():
+    for dt in range(100, 0, -1):
+        globaltimer.set_dt(dt, TARGET_DT)
+
+    stats = globaltimer.get_frame_time_stats()
+    assert stats["frames"] == 100
+    assert stats["mean"] == 50.5
+    assert (stats["p50"], stats["p95"], stats["p99"], stats["max"]) == (50, 95, 99, 100)
+    assert globaltimer.get_frame_time_percentile(0) == 1
+    assert globaltimer.get_frame_time_percentile(100) == 100
+
+
+def test_stats_only_cover_recent_frames():
+    globaltimer.set_frame_history_length(10)
+    assert globaltimer.get_frame_time_stats()["frames"] == 0
+    assert globaltimer.get_frame_time_percentile(50) == 0
+
+    for dt in [1000] * 5 + list(range(1, 11)):
+        globaltimer.set_dt(dt, TARGET_DT)
+    stats = globaltimer.get_frame_time_stats()
+    assert stats["frames"] == 10
+    assert (stats["p50"], stats["max"]) == (5, 10)
+    assert globaltimer.get_frame_time_histogram(bucket_ms=5) == {0.0: 4, 5.0: 5, 10.0: 1}
+
+
+def test_dropped_frames():
+    total_before = globaltimer.get_frame_time_stats()["total_dropped"]
+
+    # a frame only drops once it misses a deadline by more than the tolerance
+    dts_and_drops = [(TARGET_DT, 0), (TARGET_DT * 1.04, 0), (TARGET_DT * 1.5, 1), (TARGET_DT * 2, 1),
+                     (TARGET_DT * 2.1, 2), (TARGET_DT * 4, 3), (1, 0)]
+    for dt, expected in dts_and_drops:
+        assert globaltimer._count_dropped_frames(dt, TARGET_DT) == expected, dt
+        globaltimer.set_dt(dt, TARGET_DT)
+
+    stats = globaltimer.get_frame_time_stats()
+    assert stats["dropped"] == 7
+    assert stats["total_dropped"] == total_before + 7
+
+    # frames that fall out of the history still count towards the total
+    globaltimer.set_frame_history_length(2)
+    globaltimer.set_dt(TARGET_DT * 3, TARGET_DT)
+    stats = globaltimer.get_frame_time_stats()
+    assert stats["dropped"] == 2
+    assert stats["total_dropped"] == total_before + 9
+
+
+def test_dropped_frames_use_each_frames_target():
+    globaltimer.set_dt(40, 50)    # e.g. in slow motion, this frame was on time
+    globaltimer.set_dt(40, 1000 / 60)
+    assert globaltimer.get_frame_time_stats()["dropped"] == 2
+
+
+def test_frame_log(tmp_path):
+    filepath = str(tmp_path / "frames.jsonl")
+    globaltimer.start_frame_log(filepath)
+    assert globaltimer.is_logging_frames()
+    for dt in (10, 20, 40):
+        globaltimer.set_dt(dt, TARGET_DT)
+    globaltimer.stop_frame_log()
+    assert not globaltimer.is_logging_frames()
+
+    with open(filepath) as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["dt"], r["dropped"]) for r in records] == [(10, 0), (20, 1), (40, 2)]
+    assert set(records[0].keys()) == {"tick", "time", "dt", "target_dt", "dropped"}
+
+
+def test_frame_log_drops_records_when_the_writer_falls_behind(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(globaltimer._FrameLog, "MAX_QUEUED_RECORDS", 3)
+    writer_can_start = threading.Event()
+    write_records = globaltimer._FrameLog._write_records
+
+    def _slow_write_records(frame_log):
+        writer_can_start.wait(10)
+        write_records(frame_log)
+    monkeypatch.setattr(globaltimer._FrameLog, "_write_records", _slow_write_records)
+
+    filepath = str(tmp_path / "frames.jsonl")
+    globaltimer.start_frame_log(filepath)
+    for dt in range(1, 11):
+        globaltimer.set_dt(dt, TARGET_DT)
+    frame_log = globaltimer._FRAME_LOG
+    assert frame_log.n_dropped == 7
+
+    writer_can_start.set()
+    globaltimer.stop_frame_log()
+    with open(filepath) as f:
+        assert [json.loads(line)["dt"] for line in f] == [1, 2, 3]
+    assert "dropped 7 record(s)" in capsys.readouterr().out
+
+
+def test_frame_log_stops_if_its_writer_dies(tmp_path, capsys):
+    globaltimer.start_frame_log(str(tmp_path / "missing_dir" / "frames.jsonl"))
+    frame_log = globaltimer._FRAME_LOG
+    frame_log._future.wait(poll_rate_secs=0.01, time_limit_secs=10)
+
+    for dt in range(1, 4):
+        globaltimer.set_dt(dt, TARGET_DT)
+    assert not globaltimer.is_logging_frames()
+    assert capsys.readouterr().out.count("WARN: the frame log writer") == 1
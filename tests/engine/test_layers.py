@@ -0,0 +1,167 @@
+"""
+    Unit tests for src.engine.layers: the depth-sorted list of translucent sprites, and how ImageDataArray tracks
+    which of its sprites still need uploading.
+"""
+
+import src.engine.layers as layers
+import src.engine.sprites as sprites
+
+
+def _ids_and_span(ids):
+    span = ids.get_changed_span()
+    ids.clear_changed_span()
+    return list(ids), span
+
+
+def test_depth_sorted_ids_are_back_to_front_with_ties_in_insertion_order():
+    ids = layers._DepthSortedIds()
+    for sprite_id, depth in [("a", 0), ("b", 10), ("c", 0), ("d", -5), ("e", 10)]:
+        ids.insert(sprite_id, depth)
+
+    assert list(ids) == ["b", "e", "a", "c", "d"]
+    assert [ids.index_of(sprite_id) for sprite_id in "abcde"] == [2, 0, 3, 4, 1]
+    assert ids.get_depth("d") == -5
+    assert "c" in ids and "z" not in ids
+
+
+def test_depth_sorted_ids_insert_with_seq_goes_behind_later_ties():
+    ids = layers._DepthSortedIds()
+    ids.insert("a", 0)
+    ids.insert("b", 0)
+    ids.insert("c", 0, seq=-1)
+    assert list(ids) == ["c", "a", "b"]
+
+
+def test_depth_sorted_ids_changed_span():
+    ids = layers._DepthSortedIds()
+    assert ids.get_changed_span() is None
+    for sprite_id, depth in [("a", 40), ("b", 30), ("c", 20), ("d", 10), ("e", 0)]:
+        ids.insert(sprite_id, depth)
+    assert _ids_and_span(ids) == (["a", "b", "c", "d", "e"], (0, 5))
+
+    # inserting shifts everything after it
+    ids.insert("f", 25)
+    assert _ids_and_span(ids) == (["a", "b", "f", "c", "d", "e"], (2, 6))
+
+    # moving only touches the slots between its old and new index
+    ids.move("e", 35)
+    assert _ids_and_span(ids) == (["a", "e", "b", "f", "c", "d"], (1, 6))
+    ids.move("a", 15)
+    assert _ids_and_span(ids) == (["e", "b", "f", "c", "a", "d"], (0, 5))
+
+    # a sprite whose depth didn't change is still rewritten (e.g. it changed model)
+    ids.move("c", 20)
+    assert _ids_and_span(ids) == (["e", "b", "f", "c", "a", "d"], (3, 4))
+
+    # removing shifts everything after it, and the span is clipped to the new length
+    ids.remove("a")
+    assert _ids_and_span(ids) == (["e", "b", "f", "c", "d"], (4, 5))
+    ids.remove_all(["d", "zzz"])
+    assert _ids_and_span(ids) == (["e", "b", "f", "c"], (4, 4))
+
+
+def test_depth_sorted_ids_changed_spans_accumulate():
+    ids = layers._DepthSortedIds()
+    for sprite_id, depth in [("a", 40), ("b", 30), ("c", 20), ("d", 10), ("e", 0)]:
+        ids.insert(sprite_id, depth)
+    ids.clear_changed_span()
+
+    ids.move("b", 30)
+    ids.move("d", 10)
+    assert ids.get_changed_span() == (1, 4)
+    ids.remove("e")
+    assert ids.get_changed_span() == (1, 4)
+    ids.remove("a")
+    assert ids.get_changed_span() == (0, 3)
+
+
+class _RecordingEngine:
+    """just enough of a RenderEngine for ImageDataArray.sync_buffers, which records what gets uploaded."""
+
+    def __init__(self):
+        self.n_buffers = 0
+        self.uploads = []  # of ("all" or "sub", first sprite, n sprites)
+
+    def get_gl_context_id(self):
+        return 1
+
+    def gen_buffer(self):
+        self.n_buffers += 1
+        return self.n_buffers
+
+    def delete_buffers(self, buffer_ids):
+        pass
+
+    def set_buffer_data(self, buffer_id, data, target=None, usage=None):
+        self.uploads.append(("all", 0, data.nbytes // _SPRITE_BYTES))
+
+    def set_buffer_sub_data(self, buffer_id, data, byte_offset, target=None):
+        self.uploads.append(("sub", byte_offset // _SPRITE_BYTES, data.nbytes // _SPRITE_BYTES))
+
+    def pop_uploads(self):
+        res = self.uploads
+        self.uploads = []
+        return res
+
+
+_MODEL = sprites.ImageModel(0, 0, 8, 8, texture_size=(64, 64), page=0)
+_SPRITE_BYTES = layers.ImageDataArray.VERTEX_FORMAT.itemsize * 4  # ImageLayers have 4 vertices per sprite
+
+
+def _make_sprites(n, x=0):
+    return [sprites.ImageSprite(_MODEL, x + i, 0, "layer") for i in range(n)]
+
+
+def test_sync_buffers_only_uploads_the_dirty_range():
+    data = layers.ImageDataArray(layers.ImageLayer("layer", 0), min_capacity=16)
+    engine = _RecordingEngine()
+
+    spr_list = _make_sprites(10)
+    data.update(spr_list)
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == [("all", 0, 16)]  # the first upload allocates the whole capacity
+
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == []
+
+    spr_list[3:5] = _make_sprites(2, x=100)
+    data.update_range(spr_list[3:5], 3, len(spr_list))
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == [("sub", 3, 2)]
+    assert data.vertices[3, 0, 0] == 100
+
+    # growing past the capacity reallocates the storage, which uploads everything again
+    spr_list += _make_sprites(10)
+    data.update(spr_list, start_idx=10)
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == [("all", 0, 32)]
+
+    # shrinking leaves nothing to upload, the removed sprites just aren't drawn
+    data.update_range([], 12, 12)
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == []
+
+
+def test_sync_is_deferred_while_the_layer_is_fully_culled():
+    data = layers.ImageDataArray(layers.ImageLayer("layer", 0), min_capacity=16)
+    engine = _RecordingEngine()
+
+    spr_list = _make_sprites(10)
+    data.update(spr_list)
+    data.sync_buffers(engine)
+    engine.pop_uploads()
+
+    # a frame where none of the layer's sprites are visible, so nothing is drawn (or synced)
+    spr_list[1] = _make_sprites(1, x=50)[0]
+    data.update_range(spr_list[1:2], 1, len(spr_list))
+    data.pass_attributes_and_draw(engine, slots=[])
+    assert engine.pop_uploads() == []
+
+    # the next sync picks up both frames' changes
+    spr_list[6] = _make_sprites(1, x=60)[0]
+    data.update_range(spr_list[6:7], 6, len(spr_list))
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == [("sub", 1, 6)]
+
+    data.sync_buffers(engine)
+    assert engine.pop_uploads() == []
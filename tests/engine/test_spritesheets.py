@@ -0,0 +1,136 @@
+"""
+    Unit tests for the SpriteAtlas's cache, and when its key changes.
+"""
+
+import os
+import time
+
+import pygame
+import pytest
+
+import src.engine.sprites as sprites
+import src.engine.spritesheets as spritesheets
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def _pygame(monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    monkeypatch.chdir(_REPO_ROOT)  # the atlas's built-in fonts are loaded from paths relative to the repo root
+    pygame.init()
+
+
+class _TileSheet(spritesheets.SpriteSheet):
+    """creates its models from hardcoded rects, so it relies on the default restore_from_cached_layout."""
+
+    def __init__(self, filepath, version=0):
+        spritesheets.SpriteSheet.__init__(self, "tiles", filepath)
+        self.version = version
+        self.tile_model = None
+        self.n_draws = 0
+
+    def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
+        super().draw_to_atlas(atlas, sheet, start_pos=start_pos)
+        if atlas is not None:
+            self.n_draws += 1
+        self.tile_model = sprites.ImageModel(0, 0, 8, 8, offset=start_pos)
+
+    def cache_version(self):
+        return self.version
+
+
+def _save_image(path, size, color):
+    img = pygame.Surface(size, pygame.SRCALPHA)
+    img.fill(color)
+    pygame.image.save(img, path)
+
+
+def _make_atlas(img_path, version=0):
+    atlas = spritesheets.SpriteAtlas()
+    sheet = _TileSheet(img_path, version=version)
+    atlas.add_sheet(sheet)
+    return atlas, sheet
+
+
+def _set_mtime(path, secs_from_now):
+    t = int((time.time() + secs_from_now) * 1e9)
+    os.utime(path, ns=(t, t))
+
+
+def test_cache_key_changes_with_the_sheets(tmp_path):
+    img_path = str(tmp_path / "tiles.png")
+    cache_dir = str(tmp_path / "cache")
+    _save_image(img_path, (16, 16), (255, 0, 0, 255))
+    key = _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    assert key == _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+
+    # a new mtime means the image is hashed again, but its contents are the same
+    _set_mtime(img_path, 10)
+    assert key == _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+
+    assert key != _make_atlas(img_path, version=1)[0]._get_cache_key(None, cache_dir)
+    assert key != _make_atlas(img_path)[0]._get_cache_key(1024, cache_dir)
+
+    _save_image(img_path, (16, 16), (0, 255, 0, 255))
+    _set_mtime(img_path, 20)
+    new_key = _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    assert new_key != key
+
+    _save_image(img_path, (32, 16), (0, 255, 0, 255))
+    _set_mtime(img_path, 30)
+    assert _make_atlas(img_path)[0]._get_cache_key(None, cache_dir) not in (key, new_key)
+
+    os.remove(img_path)
+    assert _make_atlas(img_path)[0]._get_cache_key(None, cache_dir) not in (key, new_key)
+
+
+def test_cache_key_only_reads_images_whose_stat_changed(tmp_path, monkeypatch):
+    img_path = str(tmp_path / "tiles.png")
+    cache_dir = str(tmp_path / "cache")
+    _save_image(img_path, (16, 16), (255, 0, 0, 255))
+    _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, spritesheets._IMAGE_STATS_FILENAME))
+
+    n_reads = [0]
+    get_image_size = spritesheets._get_image_size
+
+    def _counting_get_image_size(data, filepath):
+        n_reads[0] += 1
+        return get_image_size(data, filepath)
+    monkeypatch.setattr(spritesheets, "_get_image_size", _counting_get_image_size)
+
+    _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    assert n_reads[0] == 0
+
+    _set_mtime(img_path, 10)
+    _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    _make_atlas(img_path)[0]._get_cache_key(None, cache_dir)
+    assert n_reads[0] == 1
+
+
+def test_atlas_is_restored_from_the_cache(tmp_path):
+    img_path = str(tmp_path / "tiles.png")
+    cache_dir = str(tmp_path / "cache")
+    _save_image(img_path, (16, 16), (255, 0, 0, 255))
+
+    atlas, sheet = _make_atlas(img_path)
+    pages = atlas.create_atlas_pages(cache_dir=cache_dir)
+    assert sheet.n_draws == 1
+    rect = sheet.tile_model.rect()
+
+    # the cached atlas restores the models with draw_to_atlas(None, img), without drawing anything
+    atlas, sheet = _make_atlas(img_path)
+    cached_pages = atlas.create_atlas_pages(cache_dir=cache_dir)
+    assert sheet.n_draws == 0
+    assert sheet.tile_model.rect() == rect
+    assert [p.get_size() for p in cached_pages] == [p.get_size() for p in pages]
+    assert cached_pages[0].get_at(rect[:2]) == pages[0].get_at(rect[:2])
+
+    # once the sheet changes, the atlas is rebuilt
+    _save_image(img_path, (16, 16), (0, 0, 255, 255))
+    _set_mtime(img_path, 10)
+    atlas, sheet = _make_atlas(img_path)
+    rebuilt_pages = atlas.create_atlas_pages(cache_dir=cache_dir)
+    assert sheet.n_draws == 1
+    assert tuple(rebuilt_pages[0].get_at(sheet.tile_model.rect()[:2])) == (0, 0, 255, 255)
@@ -0,0 +1,122 @@
+"""
+    Unit tests for src.engine.threedee's OBJ parser and its mesh cache.
+"""
+
+import os
+
+import numpy
+import pytest
+
+import configs
+import src.engine.threedee as threedee
+
+_QUAD_OBJ = """
+# a unit square, as one quad
+v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vt 0 1
+vn 0 0 1
+f 1/1/1 2/2/1 3/3/1 4/4/1
+"""
+
+
+def _write_obj(tmp_path, text, name="model.obj"):
+    path = str(tmp_path / name)
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def _triangles(mesh):
+    """returns: the mesh's triangles as tuples of ((x, y, z), (u, v), (nx, ny, nz)) corners."""
+    vertices, normals, texture_coords, indices, _ = mesh
+    return [tuple((tuple(vertices[i]), tuple(texture_coords[i]), tuple(normals[i])) for i in indices[t:t + 3])
+            for t in range(0, len(indices), 3)]
+
+
+def test_parse_quad(tmp_path):
+    mesh = threedee._parse_obj_file(_write_obj(tmp_path, _QUAD_OBJ))
+    vertices, normals, texture_coords, indices, n_faces = mesh
+    assert n_faces == 1
+    assert len(vertices) == 4  # the corners the two triangles share are merged
+    assert indices.dtype == numpy.uint32
+    assert _triangles(mesh) == [
+        (((0, 0, 0), (0, 0), (0, 0, 1)), ((1, 0, 0), (1, 0), (0, 0, 1)), ((1, 1, 0), (1, 1), (0, 0, 1))),
+        (((0, 0, 0), (0, 0), (0, 0, 1)), ((1, 1, 0), (1, 1), (0, 0, 1)), ((0, 1, 0), (0, 1), (0, 0, 1)))]
+
+
+def test_parse_corner_formats(tmp_path):
+    text = "\n".join(["v 0 0 0", "v 1 0 0", "v 0 1 0", "vt 0.5 0.5", "vn 0 1 0",
+                      "f 1 2 3",              # vertices only
+                      "f 1//1 2//1 3//1",     # no texture coords
+                      "f 1/1 2/1 3/1",        # no normals
+                      "f 1/1/1 2/1/1 3/1/1"])
+    triangles = _triangles(threedee._parse_obj_file(_write_obj(tmp_path, text)))
+    assert [tri[0] for tri in triangles] == [((0, 0, 0), (0, 0), (0, 0, 0)),
+                                             ((0, 0, 0), (0, 0), (0, 1, 0)),
+                                             ((0, 0, 0), (0.5, 0.5), (0, 0, 0)),
+                                             ((0, 0, 0), (0.5, 0.5), (0, 1, 0))]
+
+
+def test_relative_indices_count_back_from_the_face(tmp_path):
+    absolute = _QUAD_OBJ.replace("vn 0 0 1", "vn 0 0 1\nv 9 9 9\nvt 9 9")  # defined after the face
+    relative = absolute.replace("f 1/1/1 2/2/1 3/3/1 4/4/1", "f -4/-4/-1 -3/-3/-1 -2/-2/-1 -1/-1/-1")
+    relative = relative.replace("v 9 9 9\nvt 9 9", "") + "v 9 9 9\nvt 9 9\n"
+    expected = _triangles(threedee._parse_obj_file(_write_obj(tmp_path, absolute, name="abs.obj")))
+    assert _triangles(threedee._parse_obj_file(_write_obj(tmp_path, relative, name="rel.obj"))) == expected
+
+
+@pytest.mark.parametrize("face", ["f 1 2 5", "f 1/5 2/1 3/1", "f -5 -4 -3", "f 1 2 0"])
+def test_bad_indices_raise(tmp_path, face):
+    text = "\n".join(["v 0 0 0", "v 1 0 0", "v 0 1 0", "v 1 1 0", "vt 0 0", face])
+    with pytest.raises(ValueError):
+        threedee._parse_obj_file(_write_obj(tmp_path, text))
+
+
+def _load(path):
+    return threedee.ThreeDeeModel.load_from_disk("model", path, lambda xy: xy)
+
+
+def test_mesh_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(configs, "mesh_cache_dir", cache_dir)
+    obj_path = _write_obj(tmp_path, _QUAD_OBJ)
+
+    model = _load(obj_path)
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1 and cache_files[0].startswith("mesh_model.obj_")
+    assert [f for f in os.listdir(str(tmp_path)) if f != "cache"] == ["model.obj"]  # nothing next to the asset
+
+    # the second load comes from the cache
+    def _fail(path):
+        raise AssertionError("parsed {} again".format(path))
+    with monkeypatch.context() as m:
+        m.setattr(threedee, "_parse_obj_file", _fail)
+        cached = _load(obj_path)
+    for a, b in zip((model.get_vertices(), model.get_normals(), model.get_indices()),
+                    (cached.get_vertices(), cached.get_normals(), cached.get_indices())):
+        numpy.testing.assert_array_equal(a, b)
+
+    # changing the file invalidates it
+    _write_obj(tmp_path, _QUAD_OBJ.replace("f 1/1/1 2/2/1 3/3/1 4/4/1", "f 1/1/1 2/2/1 3/3/1"))
+    assert len(_load(obj_path).get_indices()) == 3
+
+
+def test_mesh_cache_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(configs, "mesh_cache_dir", None)
+    obj_path = _write_obj(tmp_path, _QUAD_OBJ)
+    assert len(_load(obj_path).get_indices()) == 6
+    assert os.listdir(str(tmp_path)) == ["model.obj"]
+
+
+def test_unwritable_mesh_cache_is_ignored(tmp_path, monkeypatch):
+    not_a_dir = _write_obj(tmp_path, "", name="not_a_dir")
+    monkeypatch.setattr(configs, "mesh_cache_dir", os.path.join(not_a_dir, "cache"))
+    obj_path = _write_obj(tmp_path, _QUAD_OBJ)
+    assert len(_load(obj_path).get_indices()) == 6
+    assert len(_load(obj_path).get_indices()) == 6
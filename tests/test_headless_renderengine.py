@@ -0,0 +1,152 @@
+"""
+    Pixel tests for the layers, run through the HeadlessRenderEngine (which needs neither a display nor a GPU).
+"""
+
+import os
+import random
+
+import numpy
+import pygame
+import pytest
+
+import src.engine.globaltimer as globaltimer
+import src.engine.layers as layers
+import src.engine.renderengine as renderengine
+import src.engine.spritesheets as spritesheets
+import src.engine.sprites as sprites
+from src.example.demogame import DemoGame
+
+W, H = 160, 120
+N_TICKS = 6
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def _headless_env(monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    monkeypatch.chdir(_REPO_ROOT)  # sheets load their images from paths relative to the repo root
+    pygame.init()
+    yield
+    renderengine._SINGLETON = None
+
+
+def _get_atlas():
+    # text sprites find their fonts through the SpriteAtlas singleton, so every test shares it
+    if spritesheets.get_instance() is None:
+        spritesheets.create_instance().add_sheet(DemoGame.demo_sheet)
+    return spritesheets.get_instance()
+
+
+class _Scene:
+    """
+        A fixed scene of image, polygon and text sprites that moves, grows and shrinks a little every tick.
+        Opaque sprites that overlap at the same depth can be drawn in either order, so the entities' depths are
+        kept distinct (mod 100). Translucent sprites share depths, to check that ties are broken the same way
+        however the layer was built (including by a sprite that turns translucent later on).
+    """
+
+    def __init__(self):
+        sheet = DemoGame.demo_sheet
+        rng = random.Random(1234)
+        self.floors = [sprites.ImageSprite(sheet.floor_model if (x + y) % 3 else sheet.wall_model,
+                                           x * 16, y * 16, "FLOOR") for y in range(8) for x in range(11)]
+        self.floors.append(sprites.ImageSprite(spritesheets.get_white_square_img(0.5), 7 * 16, 0, "FLOOR",
+                                               color=(1, 0.3, 0.3)))  # over floors[7], at the same depth
+        self.ents = [sprites.ImageSprite(rng.choice(sheet.player_models + sheet.tv_models),
+                                         rng.randint(-10, 150), rng.randint(-10, 110), "ENT",
+                                         scale=rng.choice([1, 2]), depth=depth,
+                                         xflip=rng.random() < 0.5, rotation=rng.randint(0, 3),
+                                         color=rng.choice([(1, 1, 1), (1, 0.5, 0.5), (0.3, 1, 0.6)]))
+                     for depth in rng.sample(range(90), 30)]
+        self.shadows = [sprites.ImageSprite(sheet.shadow_model, rng.randint(0, 150), rng.randint(0, 110), "SHADOW",
+                                            scale=2, depth=rng.choice([-10, 0, 10])) for _ in range(12)]
+        self.tris = [sprites.TriangleSprite("POLY", p1=(10 + i * 20, 10), p2=(20 + i * 20, 40), p3=(5 + i * 20, 30),
+                                            color=(i / 6, 0.5, 1 - i / 6), depth=i) for i in range(6)]
+        self.text = sprites.TextSprite("UI", 4, 4, "Hello World 0")
+
+    def step(self, t):
+        sheet = DemoGame.demo_sheet
+        rng = random.Random(t)
+        for i in range(0, len(self.ents), 3):
+            ent = self.ents[i]
+            self.ents[i] = ent.update(new_x=ent.x() + 3, new_depth=ent.depth() + rng.choice([-100, 100]))
+        for i in range(0, len(self.shadows), 4):
+            shadow = self.shadows[i]
+            self.shadows[i] = shadow.update(new_y=shadow.y() + 2, new_depth=rng.choice([-10, 0, 10]))
+        if t == 2:
+            del self.ents[5:12]
+            del self.shadows[3:6]
+            self.floors[7] = self.floors[7].update(new_model=spritesheets.get_white_square_img(0.5),
+                                                   new_color=(0.3, 0.3, 1))  # opaque -> translucent
+        if t == 3:
+            self.ents.append(sprites.ImageSprite(sheet.tv_models[0], 100, 100, "ENT", scale=3, depth=-905))
+        self.tris[t % len(self.tris)] = self.tris[t % len(self.tris)].update(new_p1=(50 + t * 5, 60))
+        self.text = self.text.update(new_text="Hello World {}".format(t * 17))
+
+    def all_sprites(self):
+        yield from self.floors
+        yield from self.ents
+        yield from self.shadows
+        yield from self.tris
+        yield self.text
+
+
+def _make_engine(cull_cell_size=None, atlas_cache_dir=None):
+    eng = renderengine.create_headless_instance()
+    for layer in [layers.ImageLayer("FLOOR", 0, cull_cell_size=cull_cell_size),
+                  layers.ImageLayer("SHADOW", 5, cull_cell_size=cull_cell_size),
+                  layers.PolygonLayer("POLY", 8),
+                  layers.ImageLayer("ENT", 10, cull_cell_size=cull_cell_size),
+                  layers.ImageLayer("UI", 20)]:
+        eng.add_layer(layer)
+    eng.init(W, H)
+    eng.set_clear_color((0.2, 0.2, 0.25))
+
+    eng.set_texture_atlas_pages(_get_atlas().create_atlas_pages(cache_dir=atlas_cache_dir))
+    return eng
+
+
+def _render(eng, scene, ent_offset=(0, 0)):
+    for spr in scene.all_sprites():
+        eng.update(spr)
+    eng.set_layer_offset("ENT", *ent_offset)
+    eng.render_layers()
+    return eng.get_framebuffer()
+
+
+def _render_ticks(n_ticks, **engine_kwargs):
+    eng = _make_engine(**engine_kwargs)
+    scene = _Scene()
+    frames = []
+    for t in range(n_ticks):
+        scene.step(t)
+        frames.append(_render(eng, scene, ent_offset=(t * 2, 0)))
+        globaltimer.inc_tick_count()
+    return frames, scene
+
+
+def test_incremental_rebuild_matches_fresh_build():
+    frames, scene = _render_ticks(N_TICKS)
+    assert frames[-1][:, :, :3].any()
+
+    # a new engine that only ever sees the final sprites builds its layers from scratch
+    fresh = _render(_make_engine(), scene, ent_offset=((N_TICKS - 1) * 2, 0))
+    numpy.testing.assert_array_equal(frames[-1], fresh)
+
+
+def test_culled_layers_match_unculled_layers():
+    unculled, _ = _render_ticks(N_TICKS)
+    culled, _ = _render_ticks(N_TICKS, cull_cell_size=32)
+    for t in range(N_TICKS):
+        numpy.testing.assert_array_equal(unculled[t], culled[t], err_msg="tick {}".format(t))
+
+
+def test_cached_atlas_matches_fresh_atlas(tmp_path):
+    uncached, _ = _render_ticks(2)
+    _render_ticks(2, atlas_cache_dir=str(tmp_path))  # writes the cache
+    assert os.listdir(str(tmp_path))
+
+    cached, _ = _render_ticks(2, atlas_cache_dir=str(tmp_path))
+    for t in range(2):
+        numpy.testing.assert_array_equal(uncached[t], cached[t], err_msg="tick {}".format(t))
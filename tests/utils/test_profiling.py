@@ -0,0 +1,132 @@
+"""
+    Unit tests for src.utils.profiling: spike capture, and the Chrome trace and speedscope exports.
+"""
+
+import json
+import pstats
+
+import src.engine.frametimers as frametimers
+import src.utils.profiling as profiling
+
+
+def _make_frame(tick, start, phase_durations, layers=None):
+    """returns: a frame like FrameTimers.get_frames makes, with the phases back to back in PHASES order."""
+    phases = {}
+    offs = 0
+    for phase in frametimers.PHASES:
+        dur = phase_durations.get(phase, 0)
+        phases[phase] = (offs if dur > 0 else 0, dur)
+        offs += dur
+    return {"tick": tick, "start": start, "phases": phases, "layers": layers if layers is not None else {}}
+
+
+def _make_frames():
+    frames = []
+    for tick in range(0, 3):
+        # render_layers starts at 3ms (after events and update), and the layers rebuild and render inside it
+        layers = {"ENT": {frametimers.REBUILD: (3.5, 1.0), frametimers.RENDER: (5.0, 2.0)},
+                  "UI": {frametimers.RENDER: (7.0, 0.5)}}
+        frames.append(_make_frame(tick, 10.0 + tick / 60, {frametimers.EVENTS: 1.0, frametimers.UPDATE: 2.0,
+                                                           frametimers.RENDER_LAYERS: 5.0, frametimers.PRESENT: 0.5,
+                                                           frametimers.WAIT: 8.0}, layers=layers))
+    return frames
+
+
+def _make_stats():
+    profiler = profiling.Profiler()
+    profiler.pr.enable()
+    sorted(range(1000), key=lambda x: -x)
+    profiler.pr.disable()
+    return pstats.Stats(profiler.pr)
+
+
+def test_frame_work_duration_ignores_wait():
+    frame = _make_frames()[0]
+    assert profiling.get_frame_duration(frame) == 16.5
+    assert profiling.get_frame_work_duration(frame) == 8.5
+
+
+def test_spike_capture_keeps_slow_frames_only():
+    profiler = profiling.Profiler()
+    profiler.start_spike_capture(target_frame_ms=10, threshold=1.5)
+    try:
+        idle = _make_frame(0, 0, {frametimers.UPDATE: 2, frametimers.WAIT: 30})  # long, but only from waiting
+        slow = _make_frame(1, 0.1, {frametimers.UPDATE: 20, frametimers.WAIT: 1})
+        fast = _make_frame(2, 0.2, {frametimers.UPDATE: 14.9})
+        for frame in (idle, slow, fast):
+            profiler.end_frame(frame)
+        assert profiler.get_spike_frames() == [slow]
+    finally:
+        profiler.stop_spike_capture()
+    assert not profiler.is_capturing_spikes
+
+
+def test_export_chrome_trace(tmp_path):
+    frames = _make_frames()
+    spike = _make_frame(7, 11.0, {frametimers.UPDATE: 40.0})
+    filepath = str(tmp_path / "trace.json")
+    profiling.export_chrome_trace(filepath, frames, spikes=[(spike, _make_stats())])
+
+    with open(filepath) as f:
+        trace = json.load(f)
+    assert trace["displayTimeUnit"] == "ms"
+    events = trace["traceEvents"]
+    assert events[0]["ph"] == "M"
+    spans = [e for e in events if e["ph"] == "X"]
+    assert all(e["pid"] == 0 and e["tid"] == 0 for e in spans)
+
+    frame_events = [e for e in spans if e["name"] == "frame"]
+    assert [e["args"]["tick"] for e in frame_events] == [0, 1, 2, 7]  # in order of when they started
+    assert frame_events[0]["ts"] == 10.0 * 1000000 and frame_events[0]["dur"] == 16.5 * 1000
+    assert "spike" not in frame_events[0]["args"]
+    assert frame_events[-1]["args"]["spike"] is True
+    assert len(frame_events[-1]["args"]["top_functions"]) > 0
+    assert set(frame_events[-1]["args"]["top_functions"][0].keys()) == {"function", "calls", "tottime_ms",
+                                                                         "cumtime_ms"}
+
+    # every phase and layer span sits inside its frame, and the layers sit inside render_layers
+    first_frame = [e for e in spans if frame_events[0]["ts"] <= e["ts"] < frame_events[1]["ts"]]
+    names = [e["name"] for e in first_frame]
+    assert names == ["frame", "events", "update", "render_layers", "ENT rebuild", "ENT render", "UI render",
+                     "present", "wait"]
+    by_name = {e["name"]: e for e in first_frame}
+    for e in first_frame:
+        parent = by_name["render_layers"] if e["name"].startswith(("ENT", "UI")) else by_name["frame"]
+        assert parent["ts"] <= e["ts"] and e["ts"] + e["dur"] <= parent["ts"] + parent["dur"], e["name"]
+
+
+def test_export_speedscope(tmp_path):
+    frames = _make_frames()
+    spike = _make_frame(7, 11.0, {frametimers.UPDATE: 40.0})
+    filepath = str(tmp_path / "profile.speedscope.json")
+    profiling.export_speedscope(filepath, frames, spikes=[(spike, _make_stats())])
+
+    with open(filepath) as f:
+        doc = json.load(f)
+    assert doc["$schema"] == "https://www.speedscope.app/file-format-schema.json"
+    assert len(doc["profiles"]) == 1
+    profile = doc["profiles"][0]
+    assert profile["type"] == "evented" and profile["unit"] == "milliseconds"
+
+    names = [frame["name"] for frame in doc["shared"]["frames"]]
+    assert len(names) == len(set(names))
+    assert "frame" in names and "ENT rebuild" in names and "spike (tick 7)" in names
+
+    # the events must be in order, and close spans in the reverse order they were opened
+    events = profile["events"]
+    assert profile["startValue"] == events[0]["at"] == 10.0 * 1000
+    assert profile["endValue"] == events[-1]["at"] == 11.0 * 1000 + 40.0
+    stack = []
+    n_frames_opened = 0
+    for prev, event in zip([None] + events, events):
+        if prev is not None:
+            assert event["at"] >= prev["at"]
+        if event["type"] == "O":
+            if len(stack) == 0:
+                n_frames_opened += 1
+            stack.append(event["frame"])
+        else:
+            assert event["type"] == "C"
+            assert stack.pop() == event["frame"]
+    assert len(stack) == 0
+    assert n_frames_opened == 4
@@ -0,0 +1,97 @@
+"""
+    Unit tests for src.utils.rectpacking.SkylinePacker.
+"""
+
+import random
+
+import pytest
+
+import src.utils.rectpacking as rectpacking
+
+
+def _random_sizes(n, seed=5, max_side=40):
+    rng = random.Random(seed)
+    return {"r{}".format(i): (rng.randint(1, max_side), rng.randint(1, max_side)) for i in range(n)}
+
+
+def _check_packing(rects, sizes, bound, padding):
+    """checks that every rect is placed once, at its own size, within bound, and that none overlap (with padding)."""
+    assert set(rects.keys()) == set(sizes.keys())
+    for r_id, (x, y, w, h) in rects.items():
+        assert (w, h) == tuple(sizes[r_id])
+        assert x >= 0 and y >= 0 and x + w + padding <= bound[0] and y + h + padding <= bound[1], r_id
+
+    placed = list(rects.items())
+    for i, (id1, r1) in enumerate(placed):
+        for id2, r2 in placed[i + 1:]:
+            overlaps = (r1[0] < r2[0] + r2[2] + padding and r2[0] < r1[0] + r1[2] + padding
+                        and r1[1] < r2[1] + r2[3] + padding and r2[1] < r1[1] + r1[3] + padding)
+            assert not overlaps, "{} {} overlaps {} {}".format(id1, r1, id2, r2)
+
+
+@pytest.mark.parametrize("padding", [0, 2])
+def test_pack_has_no_overlaps(padding):
+    sizes = _random_sizes(200)
+    rects, bound = rectpacking.SkylinePacker(padding=padding).pack(sizes)
+    _check_packing(rects, sizes, bound, padding)
+
+    # it shouldn't waste much more space than the rects need
+    total_area = sum((w + padding) * (h + padding) for w, h in sizes.values())
+    assert bound[0] * bound[1] < 1.5 * total_area
+
+
+def test_pack_empty():
+    assert rectpacking.SkylinePacker().pack({}) == ({}, (0, 0))
+
+
+def test_pack_rejects_bad_sizes():
+    with pytest.raises(ValueError):
+        rectpacking.SkylinePacker().pack({"a": (4, 4), "b": (0, 4)})
+    with pytest.raises(ValueError):
+        rectpacking.SkylinePacker(max_size=(64, 64)).pack(_random_sizes(200))
+
+
+@pytest.mark.parametrize("padding", [0, 1])
+def test_pack_pages_stay_within_the_limit(padding):
+    sizes = _random_sizes(300)
+    max_size = (128, 96)
+    pages = rectpacking.SkylinePacker(padding=padding, max_size=max_size).pack_pages(sizes)
+    assert len(pages) > 1
+
+    placed = {}
+    for rects, bound in pages:
+        assert 0 < bound[0] <= max_size[0] and 0 < bound[1] <= max_size[1]
+        _check_packing(rects, {r_id: sizes[r_id] for r_id in rects}, bound, padding)
+        for r_id in rects:
+            assert r_id not in placed, "{} is on more than one page".format(r_id)
+            placed[r_id] = rects[r_id]
+    assert set(placed.keys()) == set(sizes.keys())
+
+
+def test_pack_pages_edge_cases():
+    packer = rectpacking.SkylinePacker(max_size=(32, 32))
+    assert packer.pack_pages({}) == [({}, (0, 0))]
+    assert packer.pack_pages({"a": (32, 32), "b": (32, 32)}) == [({"a": (0, 0, 32, 32)}, (32, 32)),
+                                                                 ({"b": (0, 0, 32, 32)}, (32, 32))]
+    with pytest.raises(ValueError):
+        packer.pack_pages({"a": (33, 8)})
+
+
+def test_free_space_avoids_used_rects():
+    padding = 1
+    packer = rectpacking.SkylinePacker(padding=padding, max_size=(128, 128))
+    sizes = _random_sizes(20, max_side=24)
+    rects, bound = packer.pack(sizes)
+
+    free_space = packer.create_free_space((128, 128), list(rects.values()))
+    n_inserted = 0
+    while n_inserted < 50:
+        w, h = 10, 7
+        pos = free_space.insert(w + padding, h + padding)
+        if pos is None:
+            break
+        rects["new{}".format(n_inserted)] = (pos[0], pos[1], w, h)
+        sizes["new{}".format(n_inserted)] = (w, h)
+        n_inserted += 1
+    assert n_inserted > 0
+    _check_packing(rects, sizes, (128, 128), padding)